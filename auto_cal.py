@@ -1,19 +1,29 @@
 #!/usr/bin/python
 
-from serial import Serial, SerialException, PARITY_ODD, PARITY_NONE
+from serial import Serial, SerialException, PARITY_ODD, PARITY_NONE, serial_for_url
 import sys
 import argparse
 import traceback
+import math
+from mpmd_serial import PrinterConnection, negotiate_speed, deadline_in, PROBE, LEVELING, SETTINGS
+from mpmd_trace import tracer, HostProfiler
+from mpmd_dryrun import SimulatedPort, dry_run_model, g29_p2_points, print_time_budget
+from mpmd_log import session, console, fsync_policies
+from mpmd_stats import confidence_zscore
 
 # Most Commands from: https://reprap.org/wiki/G-code
 # Some Commands from: https://www.mpminidelta.com/g29
 class MpmdConnection:
 
+    # port: a device path, or a pyserial URL for a network serial bridge (socket://host:port, rfc2217://host:port)
     @staticmethod
-    def establishSerialConnection(port, speed=115200, timeout=10, writeTimeout=10000):
+    def establishSerialConnection(port, speed=115200, timeout=10, writeTimeout=10000, speeds=None):
         # Hack for USB connection
         # There must be a way to do it cleaner, but I can't seem to find it
-        try:
+        def openPort(speed):
+            if '://' in port:
+                # Nothing to reset on a network port
+                return serial_for_url(port, speed, timeout=timeout, write_timeout=writeTimeout)
             temp = Serial(port, speed, timeout=timeout, writeTimeout=writeTimeout, parity=PARITY_ODD)
             if sys.platform == 'win32':
                 temp.close()
@@ -22,35 +32,72 @@ class MpmdConnection:
             if sys.platform != 'win32':
                 temp.close()
             return conn
+
+        try:
+            if speeds is not None and len(speeds) > 1:
+                # Use the fastest baudrate the printer answers at
+                conn, speed = negotiate_speed(openPort, speeds)
+                if conn is None:
+                    raise SerialException("No response at any of the baudrates {0}".format(speeds))
+                console.info("Connected at baudrate {0}".format(speed))
+                return conn
+            if speeds:
+                speed = speeds[0]
+            return openPort(speed)
         except SerialException as e:
-            print ("Could not connect to {0} at baudrate {1}\nSerial error: {2}".format(port, str(speed), e))
+            console.warning("Could not connect to {0} at baudrate {1}\nSerial error: {2}".format(port, str(speed), e))
             raise e
         except IOError as e:
-            print ("Could not connect to {0} at baudrate {1}\nIO error: {2}".format(port, str(speed), e))
+            console.warning("Could not connect to {0} at baudrate {1}\nIO error: {2}".format(port, str(speed), e))
             raise e
 
-    def __init__(self, port):
-        self.connection = MpmdConnection.establishSerialConnection(port=port)
+    # serialPort: an already open port to use instead of opening 'port' (e.g. the dry run's SimulatedPort)
+    # connection: an open PrinterConnection to use instead of opening the port
+    def __init__(self, port, speeds=None, reliable=False, serialPort=None, connection=None):
+        if connection is not None:
+            self.connection = connection
+            return
+        if serialPort is None:
+            serialPort = MpmdConnection.establishSerialConnection(port=port, speeds=speeds)
+        # Lines are read on a background thread and handed out by type, see mpmd_serial
+        # reliable sends line numbers and checksums so lines garbled on the wire get resent
+        self.connection = PrinterConnection(serialPort, on_line=self.printLine, reliable=reliable, on_write=session.sent)
+
+    # Serial traffic goes to the session log, and to the console at debug level
+    def printLine(self, line):
+        session.received(line)
+        console.debug("MPMD: " + line)
 
     def write(self, command):
         command = command.strip();
-        print("Send: " + command)
-        self.connection.write((command + '\n').encode())
+        console.debug("Send: " + command)
+        self.connection.write(command)
 
-    def readline(self):
-        line = self.connection.readline().decode().strip()
-        print("MPMD: " + line)
-        return line
+    # Wait until the printer has acknowledged every command sent so far
+    # deadline: time.time() to give up at, see mpmd_serial.deadline_in (default: the connection's timeout)
+    def waitForOk(self, deadline=None):
+        self.connection.wait_for_ok(deadline)
 
-    def readNonBlankLine(self):
-        out = ''
-        while out == '':
-            out = self.readline()
-        return out;
+    # Wait for the next line of the given type(s) (see mpmd_serial), optionally containing a string
+    # Raises mpmd_serial.Timeout when it doesn't come before the deadline
+    def waitFor(self, types, contains=None, deadline=None):
+        return self.connection.wait_for(types, contains, deadline)
 
     def close(self):
         self.connection.close()
 
+    # M503: Read the printer settings into the connection's mirror of them
+    def readState(self, deadline=None):
+        return self.connection.read_state(deadline)
+
+    # Send only the parameters that differ from the printer's current settings, in one line
+    def setParameters(self, code, values):
+        command = self.connection.set_parameters(code, **values)
+        if command is None:
+            console.debug("Unchanged: " + code)
+        else:
+            console.debug("Send: " + command)
+
     # M92: Set axis_steps_per_unit
     # Xnnn Steps per unit for the X drive
     # Ynnn Steps per unit for the Y drive
@@ -58,20 +105,20 @@ class MpmdConnection:
     # Ennn Steps per unit for the extruder drive(s)
     def setAxisStepsPerUnit(self, x=None, y=None, z=None, e=None):
         if (x == None and y == None and z == None and e == None):
-            print("No arguments passed, not sending anything.")
+            console.warning("No arguments passed, not sending anything.")
             return
 
-        print("Configuring Axis Steps Per Unit.")
-        command = 'M92';
+        console.info("Configuring Axis Steps Per Unit.")
+        values = {}
         if (x != None):
-            command = command + ' X' + str(x)
+            values['X'] = x
         if (y != None):
-            command = command + ' Y' + str(y)
+            values['Y'] = y
         if (z != None):
-            command = command + ' Z' + str(z)
+            values['Z'] = z
         if (e != None):
-            command = command + ' E' + str(e)
-        self.write(command)
+            values['E'] = e
+        self.setParameters('M92', values)
 
     # Xnnn X axis endstop adjustment
     # Ynnn Y axis endstop adjustment
@@ -81,24 +128,24 @@ class MpmdConnection:
     # consumeOutput: Have this function read (and ignore) the output/response from the printer. Hence calling code can assume there is no response.
     def setDeltaEndstopAdjustment(self, x=None, y=None, z=None, a=None, b=None, consumeOutput=False):
         if (x == None and y == None and z == None and a == None and b == None):
-            print("No arguments passed, not sending anything.")
+            console.warning("No arguments passed, not sending anything.")
             return
 
-        print("Configuring Delta Endstop Adjustment")
-        command = 'M666';
+        console.info("Configuring Delta Endstop Adjustment")
+        values = {}
         if (x != None):
-            command = command + ' X' + str(x)
+            values['X'] = x
         if (y != None):
-            command = command + ' Y' + str(y)
+            values['Y'] = y
         if (z != None):
-            command = command + ' Z' + str(z)
+            values['Z'] = z
         if (a != None):
-            command = command + ' A' + str(a)
+            values['A'] = a
         if (b != None):
-            command = command + ' B' + str(b)
-        self.write(command)
+            values['B'] = b
+        self.setParameters('M666', values)
         if consumeOutput:
-            self.readline() # Read & Ignore the response
+            self.waitForOk() # Wait for & Ignore the response
 
     # Lnnn Diagonal rod length
     # Rnnn Delta radius
@@ -111,32 +158,32 @@ class MpmdConnection:
     # consumeOutput: Have this function read (and ignore) the output/response from the printer. Hence calling code can assume there is no response.
     def setDeltaConfiguration(self, l=None, r=None, s=None, b=None, h=None, x=None, y=None, z=None, consumeOutput=False):
         if (l == None and r == None and s == None and b == None and h == None and x == None and y == None and z == None):
-            print("No arguments passed, not sending anything.")
+            console.warning("No arguments passed, not sending anything.")
             return
 
-        print("Setting Delta Configuration")
-        command = 'M665';
+        console.info("Setting Delta Configuration")
+        values = {}
 
         if (l != None):
-            command = command + ' L' + str(l)
+            values['L'] = l
         if (r != None):
-            command = command + ' R' + str(r)
+            values['R'] = r
         if (s != None):
-            command = command + ' S' + str(s)
+            values['S'] = s
         if (b != None):
-            command = command + ' B' + str(b)
+            values['B'] = b
         if (h != None):
-            command = command + ' H' + str(h)
+            values['H'] = h
 
         if (x != None):
-            command = command + ' X' + str(x)
+            values['X'] = x
         if (y != None):
-            command = command + ' Y' + str(y)
+            values['Y'] = y
         if (z != None):
-            command = command + ' Z' + str(z)
-        self.write(command)
+            values['Z'] = z
+        self.setParameters('M665', values)
         if consumeOutput:
-            self.readline() # Read & Ignore the response
+            self.waitForOk() # Wait for & Ignore the response
 
     # G28: Move to Origin (Home)
     # Parameters
@@ -145,7 +192,7 @@ class MpmdConnection:
     # Y Flag to go back to the Y axis origin
     # Z Flag to go back to the Z axis origin
     def moveToHome(self, x=False, y=False, z=False):
-        print("Moving to Home/Origin")
+        console.info("Moving to Home/Origin")
         command = 'G28'
         if (x):
             command = command + ' X'
@@ -169,9 +216,9 @@ class MpmdConnection:
     # G29 Z[offset] P[mesh] = G29 P[mesh] Z[offset] ; Parameter order does not matter
     def automaticBedLeveling(self, program=1, c=None, z=None, p=None, reportProbeValues=False):
         if (program < 1 or program > 6):
-            print("Unknown program number, only 1-6 are supported. Found: " + str(program))
+            console.warning("Unknown program number, only 1-6 are supported. Found: " + str(program))
             return
-        print("Starting Automatic Bed Leveling" + (", with probe value reporting." if reportProbeValues else "."))
+        console.info("Starting Automatic Bed Leveling" + (", with probe value reporting." if reportProbeValues else "."))
         command = "G29 P" + str(program)
         if (c != None):
             command = command + ' C' + str(c)
@@ -210,18 +257,37 @@ class MpmdAutomaticCalibration:
     _defaultStepMm = 114.28
     # Not sure how it's found/calculated, but it seems to work for my MPMD. Would be good to update this comment if you know.
     _defaultLValue = 123.8
+    # Confidence level for the statistical stopping rule, 0 keeps the fixed max-error threshold.
+    _defaultStatConfidence = 0.0
+    # Seconds homing (G28) and probing (G29 P2, all 4 points) may take before giving up, rather than hanging on a lost line.
+    _homeTimeout = 60.0
+    _probeTimeout = 60.0
 
-    def parseArgs (self):
+    def parseArgs (self, argv=None):
         parser = argparse.ArgumentParser(description='Auto-Bed Calibration for Monoprice Mini Delta')
-        parser.add_argument('-p', '--port', help='Serial port', required=True)
+        parser.add_argument('-p', '--port', help='Serial port, or socket://host:port / rfc2217://host:port for a network serial bridge (not needed for a dry run)')
         parser.add_argument('-r', '--r-value', type=float, default=self._defaultRValue, help='Starting r-value')
         parser.add_argument('-s', '--step-mm', type=float, default=self._defaultStepMm, help='Set steps-/mm')
         parser.add_argument('-l','--l-value', type=float, default=self._defaultLValue, help='Starting l-value')
         parser.add_argument('-me','--max-error',type=float, default=self._defaultMaxError, help='Maximum acceptable calibration error on non-first run')
         parser.add_argument('-mr','--max-runs',type=int, default=self._defaultMaxRuns, help='Maximum attempts to calibrate printer')
+        parser.add_argument('-sc','--stat-confidence',type=float, default=self._defaultStatConfidence, help='Stop when the errors are within this confidence level (e.g. 0.95) of the probe noise measured from the double taps, instead of using max-error.')
         parser.add_argument('-lo', '--load-from-eeprom', type=bool, default=False, help='Loads the initial values for X,Y,Z and R from EEPROM, rather than starting from 0. This is especially useful if you have ever calibrated your printer before and just want a tune-up. This will override r-value arg.')
         parser.add_argument('-w', '--write-to-eeprom', type=bool, default=False, help="Write the values to the printer's non-volitile storage after finding them.")
-        args = parser.parse_args()
+        parser.add_argument('-br', '--baud-rates', type=int, nargs='+', default=[115200], help='Baudrate, or several to use the fastest one the printer answers at (e.g. 250000 115200).')
+        parser.add_argument('-rt', '--reliable-transport', type=int, default=0, help='Send line numbers and checksums and resend any line the printer rejects (0 = off; 1 = on). Makes higher baudrates safe to use.')
+        parser.add_argument('-dr', '--dry-run', type=int, default=0, help='Run against a simulated printer and print the predicted time per phase, without opening the serial port (0 = off; 1 = on).')
+        parser.add_argument('--profile', type=str, default=None, help='Profile the host computation, leaving out the time spent waiting on the printer. Writes <prefix>.prof (cProfile stats) and <prefix>.folded (collapsed stacks for flame graphs).')
+        parser.add_argument('--log', type=str, default=None, help='Append a JSON lines session log (commands, responses and the values of every run) to this file. Dry runs only read it, to measure the command round trip.')
+        parser.add_argument('--archive', type=str, default=None, help='Also add every run to this probe archive directory (see mpmd_archive.py).')
+        parser.add_argument('--printer-name', type=str, default=None, help='Name of this printer in the probe archive (default: the port).')
+        parser.add_argument('--log-fsync', type=str, default='pass', choices=fsync_policies, help='When to force the session log to disk: never, after every run (pass) or after every record (always).')
+        parser.add_argument('--console-level', type=str, default='info', choices=['debug', 'info', 'warning'], help='Console verbosity, debug also shows the serial traffic.')
+        parser.add_argument('--console-rate', type=float, default=50, help='Maximum console lines per second below warning level, the rest are counted as suppressed (0 = unlimited).')
+        parser.add_argument('--trace', type=str, default=None, help='Write a timeline of every phase and run to this file, in Chrome trace format (open in chrome://tracing or ui.perfetto.dev).')
+        args = parser.parse_args(argv)
+        if args.port is None and args.dry_run != 1 and self._connection is None:
+            parser.error('the following arguments are required: -p/--port')
         # self.logger.info(args)
         return args
 
@@ -230,51 +296,39 @@ class MpmdAutomaticCalibration:
     # but I am not sure if writing it in regex or improving it any other way would make any difference
     # as this is unique for printer with this code and may not work for anything else
     def getCurrentValues(self):
-        self.printer.moveToHome()
-        self.printer.automaticBedLeveling(program=2, reportProbeValues=True)
-
-        while True:
-            out = self.printer.readNonBlankLine()
-            if 'G29 Auto Bed Leveling' in out:
-                break
-
-        x_avg = self.calibrateAxis('X-Axis')
-        y_avg = self.calibrateAxis('Y-Axis')
-        z_avg = self.calibrateAxis('Z-Axis')
-        c_avg = self.calibrateAxis('Center')
+        self._tapDifferences = []
+        with tracer.span('home'):
+            self.printer.moveToHome()
+            self.printer.waitForOk(deadline_in(self._homeTimeout))
+
+        with tracer.span('probe'):
+            deadline = deadline_in(self._probeTimeout)
+            self.printer.automaticBedLeveling(program=2, reportProbeValues=True)
+            self.printer.waitFor(LEVELING, deadline=deadline)
+
+            x_avg = self.calibrateAxis('X-Axis', deadline)
+            y_avg = self.calibrateAxis('Y-Axis', deadline)
+            z_avg = self.calibrateAxis('Z-Axis', deadline)
+            c_avg = self.calibrateAxis('Center', deadline)
         return x_avg, y_avg, z_avg, c_avg
 
-    def calibrateAxis(self, axisName):
-        out = self.printer.readNonBlankLine()
+    def calibrateAxis(self, axisName, deadline=None):
+        out = self.printer.waitFor(PROBE, deadline=deadline)
         touch1 = out.split(' ')
-        out = self.printer.readNonBlankLine()
+        out = self.printer.waitFor(PROBE, deadline=deadline)
         touch2 = out.split(' ')
         avg = float("{0:.3f}".format((float(touch1[6]) + float(touch2[6])) / 2))
-        print('{0} :{1}, {2} Average:{3}'.format(axisName, touch1[6].rstrip(), touch2[6].rstrip(), str(avg)))
+        self._tapDifferences.append(float(touch2[6]) - float(touch1[6]))
+        self._pooledTapDifferences.append(float(touch2[6]) - float(touch1[6]))
+        console.info('{0} :{1}, {2} Average:{3}'.format(axisName, touch1[6].rstrip(), touch2[6].rstrip(), str(avg)))
         return avg
 
-    def loadConfigFromEeprom(self):
-        self.printer.printSettings(settingsAsGCodeOnly=True)
-        out = self.printer.readline()
-        x = 0.0
-        y = 0.0
-        z = 0.0
-        r = 0.0
-        while True:
-            if 'echo: ' in out:
-                # Skip over 'echo' lines, we want the PURE lines (so that our indexes are correct)
-                continue
-            if 'M666' in out:
-                parts = out.split(' ')
-                x = float(parts[1][1:])
-                y = float(parts[2][1:])
-                z = float(parts[3][1:])
-            if 'M665' in out:
-                parts = out.split(' ')
-                r = float(parts[2][1:])
-                # M665 is also the last line, so we can sto reading the config now.
-                break
-            out = self.printer.readline()
+    # state: the printer settings read by readState (mpmd_settings.PrinterSettings)
+    def loadConfigFromEeprom(self, state):
+        (x, y, z) = (state.get('M666', axis, 0.0) for axis in 'XYZ')
+        r = state.get('M665', 'R', 0.0)
+        if state.delta_radius is None:
+            console.warning("No M665 R in the printer settings, using r=0.0.")
         return (x, y, z, r)
 
     def determineError(self, x_avg, y_avg, z_avg, c_avg):
@@ -286,118 +340,213 @@ class MpmdAutomaticCalibration:
         y_error = float("{0:.4f}".format(y_avg - max_average))
         z_error = float("{0:.4f}".format(z_avg - max_average))
         c_error = float("{0:.4f}".format(c_avg - ((x_avg + y_avg + z_avg) / 3)))
-        print('X-Error: ' + str(x_error) + ' Y-Error: ' + str(y_error) + ' Z-Error: ' + str(z_error) + ' C-Error: ' + str(c_error))
+        console.info('X-Error: ' + str(x_error) + ' Y-Error: ' + str(y_error) + ' Z-Error: ' + str(z_error) + ' C-Error: ' + str(c_error))
 
         return x_error, y_error, z_error, c_error
 
+    # Standard errors of the x, y, z and c errors, estimated from the spread between the double taps.
+    # Each tap difference carries the noise of two taps, and each average halves the single tap variance.
+    # The probe noise doesn't change from run to run, so the differences of every run so far are pooled,
+    # four of them (one run) say little about it.
+    def determineStandardErrors(self):
+        differences = self._pooledTapDifferences
+        sigma = math.sqrt(sum([d * d for d in differences]) / len(differences) / 2)
+        # axis - max axis: the difference of two averages
+        axis_se = sigma
+        # center - mean of the three axes
+        c_se = sigma * math.sqrt(2.0 / 3.0)
+        return axis_se, axis_se, axis_se, c_se
+
+    def determineThresholds(self):
+        if self._stat_confidence <= 0:
+            return self._max_error, self._max_error, self._max_error, self._max_error
+
+        self._std_errors = self.determineStandardErrors()
+        # Student's t, sigma comes from the pooled tap differences
+        self._zscore = confidence_zscore(self._stat_confidence, len(self._pooledTapDifferences))
+        # Nothing smaller than a single motor step can be corrected anyway
+        step = 1.0 / self._step_mm
+        thresholds = [max(self._zscore * se, step) for se in self._std_errors]
+        console.info('Error thresholds: X ' + str(round(thresholds[0], 4)) + ' Y ' + str(round(thresholds[1], 4)) + ' Z ' + str(round(thresholds[2], 4)) + ' C ' + str(round(thresholds[3], 4)))
+        return thresholds
+
     def runCalibrationLoop(self, run_count, trial_x, trial_y, trial_z, trial_r):
-        print('\nCalibration run : ' + str(run_count) + '\n')
+        console.info('\nCalibration run : ' + str(run_count) + '\n')
 
         x_avg, y_avg, z_avg, c_avg = self.getCurrentValues()
-        x_error, y_error, z_error, c_error = self.determineError(x_avg, y_avg, z_avg, c_avg)
+        with tracer.span('error', 'compute'):
+            x_error, y_error, z_error, c_error = self.determineError(x_avg, y_avg, z_avg, c_avg)
+            x_threshold, y_threshold, z_threshold, c_threshold = self.determineThresholds()
 
         calibrated = True
-        if abs(z_error) >= self._max_error:
+        if abs(z_error) >= z_threshold:
             new_z = z_error + trial_z if run_count < (self._max_runs / 2) else (z_error / 2) + trial_z
             calibrated = False
         else:
             new_z = trial_z
 
-        if abs(x_error) >= self._max_error:
+        if abs(x_error) >= x_threshold:
             new_x = x_error + trial_x if run_count < (self._max_runs / 2) else (x_error / 2) + trial_x
             calibrated = False
         else:
             new_x = trial_x
 
-        if abs(y_error) >= self._max_error:
+        if abs(y_error) >= y_threshold:
             new_y = y_error + trial_y if run_count < (self._max_runs / 2) else (y_error / 2) + trial_y
             calibrated = False
         else:
             new_y = trial_y
 
-        if abs(c_error) >= self._max_error:
+        if abs(c_error) >= c_threshold:
             new_r = float("{0:.4f}".format(trial_r + c_error / -0.5))
             calibrated = False
         else:
             new_r = trial_r
 
-        self.printer.setDeltaEndstopAdjustment(x=new_x, y=new_y, z=new_z, consumeOutput=True)
-        self.printer.setDeltaConfiguration(r=new_r, consumeOutput=True)
+        with tracer.span('push config'):
+            self.printer.setDeltaEndstopAdjustment(x=new_x, y=new_y, z=new_z, consumeOutput=True)
+            self.printer.setDeltaConfiguration(r=new_r, consumeOutput=True)
+
+        session.record('pass', run=run_count, averages=[x_avg, y_avg, z_avg, c_avg], taps=self._tapDifferences,
+                       errors=[x_error, y_error, z_error, c_error], thresholds=[x_threshold, y_threshold, z_threshold, c_threshold],
+                       trial=[trial_x, trial_y, trial_z, trial_r], new=[new_x, new_y, new_z, new_r], calibrated=calibrated)
+        session.checkpoint()
 
         return new_x, new_y, new_z, new_r, calibrated
 
-    def calibrate(self):
-        args = self.parseArgs()
-        self.printer = MpmdConnection(args.port)
+    # argv: the command line arguments (default sys.argv)
+    # connection: an open PrinterConnection to use instead of opening the port, it's left open
+    def calibrate(self, argv=None, connection=None):
+        self._connection = connection
+        args = self.parseArgs(argv)
+        console.configure(args.console_level, args.console_rate)
+        # A dry run has nothing of the printer to log, it only reads the log for the round trip
+        if args.log and args.dry_run != 1:
+            session.open(args.log, args.log_fsync)
+            session.record('session', script='auto_cal.py', args=vars(args))
+        # A dry run keeps the timeline on the simulated printer clock, the time budget is read from it
+        self._simulatedPort = None
+        if args.dry_run == 1:
+            self._simulatedPort = SimulatedPort(dry_run_model(args.log), g29_grids={2: g29_p2_points}, step_mm=args.step_mm)
+            tracer.enable(clock=self._simulatedPort.clock)
+        elif args.trace:
+            tracer.enable()
+        if args.profile:
+            tracer.profiler = HostProfiler()
+        archivePass = None
+        if args.archive and self._simulatedPort is None:
+            # Needs NumPy, the rest of the script doesn't
+            from mpmd_archive import ProbeArchive
+            archivePass = ProbeArchive(args.archive).listener(args.printer_name or args.port)
+            session.listeners.append(archivePass)
+        try:
+            with tracer.span('session'):
+                self.calibrateSession(args)
+        finally:
+            # Keep the timeline of failed runs too, those are the interesting ones
+            if self._simulatedPort is not None:
+                print_time_budget(tracer, self._simulatedPort, args.max_runs, 'run')
+            if args.trace:
+                tracer.save(args.trace)
+                console.info("Wrote trace to " + args.trace)
+            if archivePass is not None:
+                session.listeners.remove(archivePass)
+            session.close()
+            if args.profile:
+                console.flush()
+                tracer.profiler.print_stats()
+                tracer.profiler.save(args.profile)
+                console.info("Wrote profile to " + args.profile + ".prof and " + args.profile + ".folded")
+
+    def calibrateSession(self, args):
+        with tracer.span('connect'):
+            self.printer = MpmdConnection(args.port, speeds=args.baud_rates, reliable=args.reliable_transport == 1, serialPort=self._simulatedPort,
+                                          connection=None if self._simulatedPort is not None else self._connection)
 
         self._max_error = args.max_error
         self._max_runs = args.max_runs
+        self._stat_confidence = args.stat_confidence
+        self._std_errors = None
+        self._zscore = None
+        self._pooledTapDifferences = []
         step_mm = args.step_mm
+        self._step_mm = step_mm
 
         initial_x = 0.0
         initial_y = 0.0
         initial_z = 0.0
         initial_r = args.r_value
+        with tracer.span('read state'):
+            state = self.printer.readState()
         if (args.load_from_eeprom):
-            print("Loading initial values from printer EEPROM.")
-            (initial_x, initial_y, initial_z, initial_r) = self.loadConfigFromEeprom()
+            console.info("Loading initial values from printer EEPROM.")
+            with tracer.span('load config'):
+                (initial_x, initial_y, initial_z, initial_r) = self.loadConfigFromEeprom(state)
 
-        print("Initial values will be: x=" + str(initial_x) + ", y=" + str(initial_y) + ", z=" + str(initial_z) + ", r=" + str(initial_r))
+        console.info("Initial values will be: x=" + str(initial_x) + ", y=" + str(initial_y) + ", z=" + str(initial_z) + ", r=" + str(initial_r))
 
         trial_x = initial_x
         trial_y = initial_y
         trial_z = initial_z
         trial_r = initial_r
 
-        print("Initializing printer with default values.")
-        # Shouldn't need 'setAxisStepsPerUnit' once firmware bug is fixed
-        self.printer.setAxisStepsPerUnit(x=step_mm, y=step_mm, z=step_mm)
-        self.printer.setDeltaEndstopAdjustment(x=trial_x, y=trial_y, z=trial_z)
-        self.printer.setDeltaConfiguration(r=trial_r, l=args.l_value)
-        print(' ')
+        console.info("Initializing printer with default values.")
+        with tracer.span('setup'):
+            # Shouldn't need 'setAxisStepsPerUnit' once firmware bug is fixed
+            self.printer.setAxisStepsPerUnit(x=step_mm, y=step_mm, z=step_mm)
+            self.printer.setDeltaEndstopAdjustment(x=trial_x, y=trial_y, z=trial_z)
+            self.printer.setDeltaConfiguration(r=trial_r, l=args.l_value)
+            self.printer.waitForOk()
+        console.info(' ')
 
         run_count = 0
         while True:
             run_count += 1
             if run_count > self._max_runs:
-                print('Max-Runs(' + str(self._max_runs) + ') exceeded without settling on final values. Finishing.')
+                console.warning('Max-Runs(' + str(self._max_runs) + ') exceeded without settling on final values. Finishing.')
                 break
 
-            trial_x, trial_y, trial_z, trial_r, calibrated = self.runCalibrationLoop(run_count, trial_x, trial_y, trial_z, trial_r)
+            with tracer.span('run ' + str(run_count)):
+                trial_x, trial_y, trial_z, trial_r, calibrated = self.runCalibrationLoop(run_count, trial_x, trial_y, trial_z, trial_r)
 
             if calibrated:
                 break
 
-        self.printer.printSettings()
-        while True:
-            out = self.printer.readline()
-            if 'M665' in out:
-                break
+        self.printer.readState()
 
         if args.write_to_eeprom:
-            self.printer.storeParametersInNonVolatileStorage()
-            while True:
-                out = self.printer.readline()
-                if 'Settings Stored' in out:
-                    break
+            with tracer.span('store eeprom'):
+                self.printer.storeParametersInNonVolatileStorage()
+                self.printer.waitFor(SETTINGS, 'Settings Stored')
         else:
-            print("Did not store settings to printer EEPROM.")
+            console.info("Did not store settings to printer EEPROM.")
 
         self.printer.moveToHome()
 
-        print("\n")
-        print("Finished calibration after " + str(run_count) + " runs.")
-        print("Initial values were: x=" + str(initial_x) + ", y=" + str(initial_y) + ", z=" + str(initial_z) + ", r=" + str(initial_r))
-        print("Final values are: x=" + str(trial_x) + ", y=" + str(trial_y) + ", z=" + str(trial_z) + ", r=" + str(trial_r))
-        print("\n")
-        self.printer.close()
+        console.info("\n")
+        console.info("Finished calibration after " + str(run_count) + " runs.")
+        console.info("Initial values were: x=" + str(initial_x) + ", y=" + str(initial_y) + ", z=" + str(initial_z) + ", r=" + str(initial_r))
+        console.info("Final values are: x=" + str(trial_x) + ", y=" + str(trial_y) + ", z=" + str(trial_z) + ", r=" + str(trial_r))
+        session.record('result', runs=run_count, calibrated=calibrated, x=trial_x, y=trial_y, z=trial_z, r=trial_r, std_errors=self._std_errors)
+        if self._std_errors is not None:
+            # Endstops follow their axis error 1:1, r moves by c-error / -0.5
+            zscore = self._zscore
+            x_se, y_se, z_se, c_se = self._std_errors
+            console.info(str(self._stat_confidence * 100) + "% confidence interval: x=+/-" + str(round(zscore * x_se, 4)) + ", y=+/-" + str(round(zscore * y_se, 4)) + ", z=+/-" + str(round(zscore * z_se, 4)) + ", r=+/-" + str(round(zscore * c_se * 2, 4)))
+        console.info("\n")
+        if self.printer.connection is not self._connection:
+            self.printer.close()
 
 def main():
     try:
         calibrator = MpmdAutomaticCalibration()
         calibrator.calibrate()
     except:
+        # The console prints in the background, everything before the exception goes out first
+        console.flush()
         sys.stderr.write("Exception occurred: " + traceback.format_exc())
+    finally:
+        console.flush()
 
 if __name__ == '__main__':
     main()
@@ -9,6 +9,7 @@ from serial import Serial, SerialException, PARITY_ODD, PARITY_NONE
 import sys
 import argparse
 import json
+from mpmd_trace import tracer, HostProfiler
 
 def establish_serial_connection(port, speed=115200, timeout=10, writeTimeout=10000):
     # Hack for USB connection
@@ -162,9 +163,10 @@ def run_calibration(port, trial_x, trial_y, trial_z,r_value, max_runs, max_error
 
     z_ave, x_ave, y_ave, c_ave = get_current_values(port)
 
-    max_value = find_max_value([z_ave, x_ave, y_ave])
+    with tracer.span('error', 'compute'):
+        max_value = find_max_value([z_ave, x_ave, y_ave])
 
-    z_error, x_error, y_error, c_error = determine_error(z_ave, x_ave, y_ave, c_ave, max_value)
+        z_error, x_error, y_error, c_error = determine_error(z_ave, x_ave, y_ave, c_ave, max_value)
 
     if abs(max([z_error, x_error, y_error, c_error], key=abs)) > max_error and runs > 1:
         sys.exit("Calibration error on non-first run exceeds set limit")
@@ -200,8 +202,12 @@ def main():
     parser.add_argument('-mr','--max-runs',type=int,default=max_runs,help='Maximum attempts to calibrate printer')
     parser.add_argument('-f','--file',type=str,dest='file',default=None,
         help='File with settings, will be updated with latest settings at the end of the run')
+    parser.add_argument('--profile',type=str,default=None,help='Profile the host computation (not the time waiting on the printer) and write <prefix>.prof and <prefix>.folded (flame graph stacks)')
     args = parser.parse_args()
 
+    if args.profile:
+        tracer.profiler = HostProfiler()
+
     port = establish_serial_connection(args.port)
 
     if args.file:
@@ -249,7 +255,13 @@ def main():
 
         print ('\nStarting calibration')
 
-        calibrated, new_z, new_x, new_y, new_r = run_calibration(port, trial_x, trial_y, trial_z,r_value, max_runs, args.max_error)
+        try:
+            calibrated, new_z, new_x, new_y, new_r = run_calibration(port, trial_x, trial_y, trial_z,r_value, max_runs, args.max_error)
+        finally:
+            if args.profile:
+                tracer.profiler.print_stats()
+                tracer.profiler.save(args.profile)
+                print ('Wrote profile to {0}.prof and {0}.folded'.format(args.profile))
 
         port.close()
 
@@ -25,21 +25,37 @@
 #
 # For Marlin, use the appropriate line for your stock firmware and replace "-ff 0" with "-ff 1"
 
-from serial import Serial, SerialException, PARITY_ODD, PARITY_NONE
+from serial import Serial, SerialException, PARITY_ODD, PARITY_NONE, serial_for_url
 import sys
 import argparse
 import traceback
 import json
+import time
 import statistics
+import concurrent.futures
 import numpy as np
-from scipy.interpolate import griddata
+from numpy.lib.recfunctions import structured_to_unstructured
+from scipy.interpolate import griddata, LinearNDInterpolator, NearestNDInterpolator
+from scipy.spatial import cKDTree
+from mpmd_serial import PrinterConnection, negotiate_speed, deadline_in, Timeout, PROBE, LEVELING
+from mpmd_trace import tracer, HostProfiler
+from mpmd_dryrun import SimulatedPort, dry_run_model, print_time_budget, g29_p2_points
+from mpmd_log import session, console, read_session, fsync_policies
+from mpmd_archive import ProbeArchive
+from mpmd_stats import confidence_zscore
 
 
 
-def establish_serial_connection(port, speed=115200, timeout=10, writeTimeout=10000):
+# port: a device path, or a pyserial URL for printers behind a network serial bridge
+# (socket://host:port for ser2net raw mode, rfc2217://host:port)
+# window: commands sent ahead of the printer's acknowledgements (see PrinterConnection)
+def establish_serial_connection(port, speed=115200, timeout=10, writeTimeout=10000, speeds=None, reliable=False, window=4):
     # Hack for USB connection
     # There must be a way to do it cleaner, but I can't seem to find it
-    try:
+    def open_port(speed):
+        if '://' in port:
+            # Nothing to reset on a network port
+            return serial_for_url(port, speed, timeout=timeout, write_timeout=writeTimeout)
         temp = Serial(port, speed, timeout=timeout, writeTimeout=writeTimeout, parity=PARITY_ODD)
         if sys.platform == 'win32':
             temp.close()
@@ -48,155 +64,214 @@ def establish_serial_connection(port, speed=115200, timeout=10, writeTimeout=100
         if sys.platform != 'win32':
             temp.close()
         return conn
+
+    try:
+        if speeds is not None and len(speeds) > 1:
+            conn, speed = negotiate_speed(open_port, speeds)
+            if conn is None:
+                console.warning("No response from {0} at any of the baudrates {1}".format(port, speeds))
+                return None
+            console.info("Connected at baudrate {0}".format(speed))
+        else:
+            if speeds:
+                speed = speeds[0]
+            conn = open_port(speed)
+        return PrinterConnection(conn, reliable=reliable, on_line=session.received, on_write=session.sent, window=window)
     except SerialException as e:
-        print ("Could not connect to {0} at baudrate {1}\nSerial error: {2}".format(port, str(speed), e))
+        console.warning("Could not connect to {0} at baudrate {1}\nSerial error: {2}".format(port, str(speed), e))
         return None
     except IOError as e:
-        print ("Could not connect to {0} at baudrate {1}\nIO error: {2}".format(port, str(speed), e))
+        console.warning("Could not connect to {0} at baudrate {1}\nIO error: {2}".format(port, str(speed), e))
         return None
 
-def get_points(port):
-    while True:
-        out = port.readline().decode()
-        if 'Bed ' in out:
-            break
+# Deadlines (s) of the printer operations, a line lost on the way raises Timeout instead of hanging
+home_timeout = 60.0     # G28
+heat_timeout = 900.0    # M190, bed heating or cooling to the next sweep temperature
+point_timeout = 15.0    # travel and both taps of one probe point, G29 included
+
+def get_points(port, deadline=None):
+    return port.wait_for(PROBE, deadline=deadline).split(' ')
 
-    return out.split(' ')
+# Motion profile for the Marlin probe moves (the stock firmware moves by itself during G29)
+# Every G30 descends at the firmware's probe speed from wherever it starts, so the less height
+# there is above the bed the faster the probing. Travel happens at the lowest height that clears
+# the bed measured in the previous pass, in one combined XYZ move per point at an explicit feed rate.
+safe_height = 15.0      # height (mm) of the first move after homing
+travel_clearance = 3.0  # clearance (mm) above the highest previous probe, covers the endstop/radius changes between passes
+travel_feed = 6000      # mm/min
 
-def get_current_values(port, firmFlag):
+# None while there is no previous mesh, the moves then stay at whatever height G30 leaves the nozzle
+def travel_height(prev_table=None, clearance=travel_clearance, ceiling=safe_height):
+    if prev_table is None:
+        return None
+    highest = max(np.max(prev_table['z1']), np.max(prev_table['z2']))
+    return round(min(ceiling, float(highest) + clearance), 2)
+
+def probe_moves(grid, z_travel=None, feed=travel_feed):
+    moves = []
+    for ii, (x, y) in enumerate(grid):
+        if z_travel is not None:
+            moves.append('G1 X{0} Y{1} Z{2} F{3}'.format(x, y, z_travel, feed))
+        elif ii == 0:
+            moves.append('G1 X{0} Y{1} Z{2} F{3}'.format(x, y, safe_height, feed))
+        else:
+            moves.append('G1 X{0} Y{1} F{2}'.format(x, y, feed))
+    return moves
+
+# timeout: seconds the probing may take (default point_timeout per point), homing has its own home_timeout
+# home: False when the G28 has already been queued (overlap mode), the probe commands then go right behind it
+def get_current_values(port, firmFlag, grid, z_travel=None, timeout=None, home=True):
     # Replacing G29 P5 with manual probe points for cross-firmware compatibility
     # G28 ; home
-    # G1 Z15 F6000; go to safe distance
     # Start Loop
-    #     G1 X## Y##; go to specified location
+    #     G1 X## Y## Z## F6000; go to specified location at the travel height (see travel_height)
     #     G30 ;probe bed for z values
     #     G30 ;probe bed again for z values
     # End Loop
     # G28 ; return home
+    #
+    # The probe commands are all queued up front, the connection's window keeps them from
+    # overrunning the firmware's buffer, and the taps are read back in order. The printer never
+    # waits for the host between points, however long the round trip is.
     
-    # Initialize G29 P5 V4 Table
-    number_cols = 7 
-    number_rows = 21
-    x_list = [None]*number_rows
-    y_list = [None]*number_rows
-    z1_list = [None]*number_rows
-    z2_list = [None]*number_rows
-    z_avg_list = [None]*number_rows
-    dtap_list = [None]*number_rows
-    dz_list = [None]*number_rows
-    dz_test = [None]*number_rows
-    
-    # Define Table Indices
-    ix = 0
-    iy = 1
-    iz1 = 2
-    iz2 = 3
-    izavg = 4 
-    idtap = 5
-    idz = 6
-    
-    # Assign X Coordinates (G29 P5)
-    x_list[0] = -25
-    x_list[1] = 0
-    x_list[2] = 25
-    x_list[3] = 50
-    x_list[4] = 25
-    x_list[5] = 0
-    x_list[6] = -25
-    x_list[7] = -50
-    x_list[8] = -50
-    x_list[9] = -25
-    x_list[10] = 0
-    x_list[11] = 25
-    x_list[12] = 50
-    x_list[13] = 50
-    x_list[14] = 25
-    x_list[15] = 0
-    x_list[16] = -25
-    x_list[17] = -50
-    x_list[18] = -25
-    x_list[19] = 0
-    x_list[20] = 25
-    
-    # Assign Y Coordinates (G29 P5)
-    y_list[0] = -50
-    y_list[1] = -50
-    y_list[2] = -50
-    y_list[3] = -25
-    y_list[4] = -25
-    y_list[5] = -25
-    y_list[6] = -25
-    y_list[7] = -25
-    y_list[8] = 0
-    y_list[9] = 0
-    y_list[10] = 0
-    y_list[11] = 0
-    y_list[12] = 0
-    y_list[13] = 25
-    y_list[14] = 25
-    y_list[15] = 25
-    y_list[16] = 25
-    y_list[17] = 25
-    y_list[18] = 50
-    y_list[19] = 50
-    y_list[20] = 50
+    # Initialize the probe table from the grid definition
+    table = new_probe_table(grid)
 
     # Send Gcodes
-    port.write(('G28\n').encode()) # Home
+    if home:
+        with tracer.span('home'):
+            port.write('G28') # Home
+            port.wait_for_ok(deadline_in(home_timeout))
     
+    deadline = deadline_in((timeout if timeout is not None else point_timeout*len(grid)) + (0 if home else home_timeout))
+    tracer.begin('probe', points=len(table), z_travel=z_travel)
     if firmFlag == 1: 
         # Marlin
-        port.write(('G1 Z15 F6000\n').encode()) # Move to safe distance
+        for move in probe_moves(grid, z_travel):
+            # Move to desired position
+            port.write(move)
+            #print('Sending ' + move + '\n')
+
+            # Probe Z values
+            port.write('G30')
+            port.write('G30')
     else:
         # Stock Firmware
-        port.write(('G29 P5 V4\n').encode())
-
-        while True:
-            out = port.readline().decode()
-            #print("{0}\n".format(out))
-            if 'G29 Auto Bed Leveling' in out:
-                break
+        port.write('G29 P2 V4' if grid == probe_grids['P2'] else 'G29 P5 V4')
+        port.wait_for(LEVELING, deadline=deadline)
         
     # Loop through all 
-    for ii in range(len(x_list)):
+    for ii in range(len(table)):
         
-        if firmFlag == 1: 
-            # Marlin
-            
-            # Move to desired position
-            port.write(('G1 X{0} Y{1}\n'.format(x_list[ii], y_list[ii])).encode()) 
-            #print('Sending G1 X{0} Y{1}\n'.format(x_list[ii], y_list[ii]))
-            
-            # Probe Z values
-            port.write(('G30\n').encode())
-            z_axis_1 = get_points(port)
-            port.write(('G30\n').encode())
-            z_axis_2 = get_points(port)
-        else:
-            # Stock Firmware
-            z_axis_1 = get_points(port)
-            z_axis_2 = get_points(port)
+        z_axis_1 = get_points(port, deadline)
+        z_axis_2 = get_points(port, deadline)
         
         # Populate most of the table values
-        z1_list[ii] = float(z_axis_1[6])
-        z2_list[ii] = float(z_axis_2[6])
-        z_avg_list[ii] = float("{0:.4f}".format((z1_list[ii] + z2_list[ii]) / 2.0))
-        dtap_list[ii] = z2_list[ii] - z1_list[ii]
-        #print('Received: X:{0} X:{1} Y:{2} Y:{3} Z1:{4} Z2:{5}\n\n'.format(str(x_list[ii]), str(z_axis_1[2]), str(y_list[ii]), str(z_axis_1[4]), z1_list[ii], z2_list[ii]))
+        row = table[ii]
+        row['z1'] = float(z_axis_1[6])
+        row['z2'] = float(z_axis_2[6])
+        row['z_avg'] = float("{0:.4f}".format((row['z1'] + row['z2']) / 2.0))
+        row['dtap'] = row['z2'] - row['z1']
+        #print('Received: X:{0} X:{1} Y:{2} Y:{3} Z1:{4} Z2:{5}\n\n'.format(str(row['x']), str(z_axis_1[2]), str(row['y']), str(z_axis_1[4]), row['z1'], row['z2']))
     
     # Find the Median Reference
-    z_med = statistics.median(z_avg_list)
+    z_med = np.median(table['z_avg'])
     
     # Calculate z diff
-    for ii in range(len(x_list)):
-        dz_list[ii] = z_avg_list[ii] - z_med
+    table['dz'] = table['z_avg'] - z_med
         
-    # Empty out remaining lines for stock firmware
-    if firmFlag == 0: 
-        for ii in range(6):
-            out = port.readline().decode()
+    # Let the printer finish (stock firmware prints a few more lines after the grid, they are just left queued)
+    port.wait_for_ok(deadline)
+    tracer.end('probe')
     
-    return x_list, y_list, z1_list, z2_list, z_avg_list, dtap_list, dz_list
+    return table
+
+# Probe table, one row per probe point, filled in place while probing and shared by every later stage
+# x and y sit next to each other so probe_xy can hand them out as an (n, 2) view
+probe_table_dtype = np.dtype([('x', 'f8'), ('y', 'f8'), ('z1', 'f8'), ('z2', 'f8'), ('z_avg', 'f8'), ('dtap', 'f8'), ('dz', 'f8')])
+
+def new_probe_table(grid):
+    table = np.zeros(len(grid), dtype=probe_table_dtype)
+    for ii in range(len(grid)):
+        table[ii]['x'] = grid[ii][0]
+        table[ii]['y'] = grid[ii][1]
+    return table
+
+def probe_xy(table):
+    return structured_to_unstructured(table[['x', 'y']], copy=False)
+
+# Probe grids, lists of [X, Y] points in probing order
+# Square grids follow G29 Pn (n x n points walked in a serpentine, trimmed to the probe radius),
+# P5 comes out in the same order as G29 P5 V4 reports on the stock firmware, P2 is G29 P2
+# (X, Y and Z towers and the center)
+probe_extent = 50.0
+probe_radius = 56.0
+
+def square_grid(n, extent=probe_extent, radius=probe_radius):
+    coords = [float("{0:.3f}".format(-extent + 2.0*extent*ii/(n-1))) for ii in range(n)]
+    points = []
+    for iy in range(n):
+        row = coords if iy % 2 == 0 else coords[::-1]
+        for x in row:
+            if np.hypot(x, coords[iy]) <= radius:
+                points.append([x, coords[iy]])
+    return points
+
+def hex_grid(spacing, radius=probe_radius):
+    # Rows of equilateral triangles, every other row shifted by half a spacing
+    dy = spacing*np.sqrt(3.0)/2.0
+    nrows = int(radius/dy)
+    points = []
+    for iy in range(-nrows, nrows+1):
+        y = float("{0:.3f}".format(iy*dy))
+        shift = spacing/2.0 if iy % 2 else 0.0
+        ncols = int(radius/spacing) + 1
+        row = [float("{0:.3f}".format(ix*spacing + shift)) for ix in range(-ncols, ncols+1)]
+        if (iy + nrows) % 2:
+            row = row[::-1]
+        for x in row:
+            if np.hypot(x, y) <= radius:
+                points.append([x, y])
+    return points
+
+def radial_grid(rings, radius=probe_extent):
+    # Center point plus rings of 6, 12, 18... points, first point of every ring on the Z tower side
+    points = [[0.0, 0.0]]
+    for ir in range(1, rings+1):
+        ring_radius = radius*ir/rings
+        for ia in range(6*ir):
+            angle = np.radians(90.0 + 360.0*ia/(6*ir))
+            points.append([float("{0:.3f}".format(ring_radius*np.cos(angle))), float("{0:.3f}".format(ring_radius*np.sin(angle)))])
+    return points
+
+probe_grids = {'P2': [list(point) for point in g29_p2_points], 'P3': square_grid(3), 'P4': square_grid(4), 'P5': square_grid(5), 'P6': square_grid(6)}
+
+# Fewest points that still determine the three endstops and R
+min_grid_points = 4
+
+def get_grid(grid_name):
+    # P2-P6, any other Pn (n x n), hex<spacing>, radial<rings> or a json file with a list of [X, Y] points
+    try:
+        if grid_name in probe_grids:
+            grid = probe_grids[grid_name]
+        elif grid_name.endswith('.json'):
+            with open(grid_name) as grid_file:
+                grid = [[float(point[0]), float(point[1])] for point in json.load(grid_file)]
+        elif grid_name.startswith('P') and int(grid_name[1:]) >= 2:
+            grid = square_grid(int(grid_name[1:]))
+        elif grid_name.startswith('hex') and float(grid_name[3:]) > 0:
+            grid = hex_grid(float(grid_name[3:]))
+        elif grid_name.startswith('radial') and int(grid_name[6:]) >= 1:
+            grid = radial_grid(int(grid_name[6:]))
+        else:
+            sys.exit("Unknown probe grid {0}".format(grid_name))
+    except ValueError:
+        # P2x, hexfoo
+        sys.exit("Unknown probe grid {0}".format(grid_name))
+    # The radius trim can leave a grid (nearly) empty, e.g. a 2 x 2 square has all its corners outside
+    if len(grid) < min_grid_points:
+        sys.exit("Probe grid {0} has {1} point(s) inside the probe radius, it needs at least {2}".format(grid_name, len(grid), min_grid_points))
+    return grid
 
 def xyz_list2array(xl,yl,zl):
     # Create Contour Lookup/Interpolation Function
@@ -215,32 +290,76 @@ def xyz_list2array(xl,yl,zl):
 def linear_interp(x0, x1, z0, z1, xq):
     zq = z0 + (xq-x0)*(z1-z0)/(x1-x0)
     return zq
+
+# Zernike terms used by the surface fit (-im 2), polar coordinates on the unit disk
+# Up to trefoil plus spherical, trefoil being what the three towers leave behind on a delta
+zernike_terms = [
+    lambda rho, theta: np.ones_like(rho),                    # Piston
+    lambda rho, theta: rho*np.cos(theta),                    # Tilt X
+    lambda rho, theta: rho*np.sin(theta),                    # Tilt Y
+    lambda rho, theta: 2.0*rho**2 - 1.0,                     # Defocus (bowl)
+    lambda rho, theta: rho**2*np.cos(2.0*theta),             # Astigmatism
+    lambda rho, theta: rho**2*np.sin(2.0*theta),             # Astigmatism 45
+    lambda rho, theta: (3.0*rho**3 - 2.0*rho)*np.cos(theta), # Coma X
+    lambda rho, theta: (3.0*rho**3 - 2.0*rho)*np.sin(theta), # Coma Y
+    lambda rho, theta: rho**3*np.cos(3.0*theta),             # Trefoil
+    lambda rho, theta: rho**3*np.sin(3.0*theta),             # Trefoil 30
+    lambda rho, theta: 6.0*rho**4 - 6.0*rho**2 + 1.0,        # Spherical
+]
+
+def zernike_matrix(x, y, scale):
+    rho = np.hypot(x, y)/scale
+    theta = np.arctan2(y, x)
+    return np.column_stack([term(rho, theta) for term in zernike_terms])
+
+def fit_surface(x_list, y_list, dz_list):
+    # Least squares Zernike fit to all probe points, scaled so the outermost point sits on the unit circle
+    x = np.asarray(x_list, dtype=float)
+    y = np.asarray(y_list, dtype=float)
+    scale = float(np.max(np.hypot(x, y)))
+    coeffs = np.linalg.lstsq(zernike_matrix(x, y, scale), np.asarray(dz_list, dtype=float), rcond=None)[0]
+    return coeffs, scale
+
+def surface_height(coeffs, scale, x, y):
+    return float((zernike_matrix(np.atleast_1d(float(x)), np.atleast_1d(float(y)), scale) @ coeffs)[0])
     
-def calculate_contour(x_list, y_list, dz_list, runs, xhigh, yhigh, zhigh, minterp, tower_flag):
-    
-    # Redefine Lists
-    x_list_new = x_list.copy()
-    y_list_new = y_list.copy()
-    dz_list_new = dz_list.copy()
+def probe_spacing(xy):
+    # Typical distance between neighbouring probe points (25 for P5)
+    dist, idx = cKDTree(xy).query(xy, k=2)
+    return float(np.median(dist[:, 1]))
+
+def calculate_contour(table, runs, xhigh, yhigh, zhigh, minterp, tower_flag):
     
     # Define contour boundaries and steps
-    xmin = min(x_list_new)
-    xmax = max(x_list_new)
-    ymin = min(y_list_new)
-    ymax = max(y_list_new)
-    dprobe = 25.0; # Distance Betqeen Probe Points
+    xmin = float(np.min(table['x']))
+    xmax = float(np.max(table['x']))
+    ymin = float(np.min(table['y']))
+    ymax = float(np.max(table['y']))
+    coord_xy = probe_xy(table)
+    coord_z = table['dz']
+    dprobe = probe_spacing(coord_xy) # Distance Between Probe Points
     ngrid = 3.0 # Grid Cell Spacing for the Contour
     dx = dprobe/ngrid
     dy = dx
     nmax = int(round((ymax-ymin)/dy))
     
-    # Create Contour Lookup/Interpolation Function
-    coord_xy, coord_z = xyz_list2array(x_list_new,y_list_new,dz_list_new)
-    
     # Copy Equations from Dennis's Spreadsheet and put them in the lookup grid
     # Put inside if statement incase we want to try other interpolation methods
     # Anything other than 1 simply uses Python's griddata with the probed points.
     if minterp == 1: 
+
+        # The spreadsheet's sample points sit on the outer ring of the grid and half way out to it
+        # (+/-50 and +/-25 on the P5 grid), those off the probed area (hex, radial) take the nearest probe
+        def lookup(xy, z, xq, yq):
+            zq = float(griddata(xy, z, (xq, yq)))
+            if np.isnan(zq):
+                zq = float(griddata(xy, z, (xq, yq), method='nearest'))
+            return zq
+
+        # The spreadsheet adds its own points, so work on lists of the probe table
+        x_list_new = table['x'].tolist()
+        y_list_new = table['y'].tolist()
+        dz_list_new = table['dz'].tolist()
     
         # Fill in based on known values across the horizontal
         iside = -1
@@ -274,8 +393,8 @@ def calculate_contour(x_list, y_list, dz_list, runs, xhigh, yhigh, zhigh, minter
                             x1 = x0 + dprobe
                             #print("Known Point\n")
                             #print("Known Point x0 = {0}".format(str(x0)))
-                        z0 = float(griddata(coord_xy, coord_z, (x0   , y0)))
-                        z1 = float(griddata(coord_xy, coord_z, (x1   , y1)))
+                        z0 = lookup(coord_xy, coord_z, x0, y0)
+                        z1 = lookup(coord_xy, coord_z, x1, y1)
                     else: #  Interpolate Between Known Values
                         zq = linear_interp(x0, x1, z0, z1, xq)
                         x_list_new.append(xq)
@@ -317,9 +436,9 @@ def calculate_contour(x_list, y_list, dz_list, runs, xhigh, yhigh, zhigh, minter
                             y1 = y0 + dprobe
                             #print("Known Point\n")
                             #print("Known Point y0 = {0} y1 = {1} yq = {2}".format(str(y0), str(y1), str(yq)))
-                        z0 = float(griddata(coord_xy, coord_z, (x0   , y0)))
+                        z0 = lookup(coord_xy, coord_z, x0, y0)
                         #print("x0={0} y0={1} z0={2}".format(str(x0), str(y0), str(z0)))
-                        z1 = float(griddata(coord_xy, coord_z, (x1   , y1)))
+                        z1 = lookup(coord_xy, coord_z, x1, y1)
                         #print("x1={0} y1={1} z1={2}".format(str(x1), str(y1), str(z1)))
                     else: #  Interpolate Between Known Values
                         zq = linear_interp(y0, y1, z0, z1, yq)
@@ -335,40 +454,40 @@ def calculate_contour(x_list, y_list, dz_list, runs, xhigh, yhigh, zhigh, minter
   
         # Manually set corner points
         # Top Left
-        L6 = float(griddata(coord_xy, coord_z, (-50.0, 25.0)))
-        O3 = float(griddata(coord_xy, coord_z, (-25.0, 50.0)))
-        x_list_new.append(-50.0+dx)
-        y_list_new.append(25.0+dy)
+        L6 = lookup(coord_xy, coord_z, xmin, ymax/2.0)
+        O3 = lookup(coord_xy, coord_z, xmin/2.0, ymax)
+        x_list_new.append(xmin+dx)
+        y_list_new.append(ymax/2.0+dy)
         dz_list_new.append((O3-L6)/3.0+L6)
-        x_list_new.append(-50.0+2.0*dx)
-        y_list_new.append(25.0+2.0*dy)
+        x_list_new.append(xmin+2.0*dx)
+        y_list_new.append(ymax/2.0+2.0*dy)
         dz_list_new.append((L6-O3)/3+O3)
         # Top Right
-        X6 = float(griddata(coord_xy, coord_z, (50.0, 25.0)))
-        U3 = float(griddata(coord_xy, coord_z, (25.0, 50.0)))
-        x_list_new.append(50.0-dx)
-        y_list_new.append(25.0+dy)
+        X6 = lookup(coord_xy, coord_z, xmax, ymax/2.0)
+        U3 = lookup(coord_xy, coord_z, xmax/2.0, ymax)
+        x_list_new.append(xmax-dx)
+        y_list_new.append(ymax/2.0+dy)
         dz_list_new.append((U3-X6)/3+X6)
-        x_list_new.append(50.0-2.0*dx)
-        y_list_new.append(25.0+2.0*dy)
+        x_list_new.append(xmax-2.0*dx)
+        y_list_new.append(ymax/2.0+2.0*dy)
         dz_list_new.append((X6-U3)/3+U3)
         # Bottom Right
-        X12 = float(griddata(coord_xy, coord_z, (50.0, -25.0)))
-        U15 = float(griddata(coord_xy, coord_z, (25.0, -50.0)))
-        x_list_new.append(50.0-dx)
-        y_list_new.append(-25.0-dy)
+        X12 = lookup(coord_xy, coord_z, xmax, ymin/2.0)
+        U15 = lookup(coord_xy, coord_z, xmax/2.0, ymin)
+        x_list_new.append(xmax-dx)
+        y_list_new.append(ymin/2.0-dy)
         dz_list_new.append((U15-X12)/3+X12)
-        x_list_new.append(50.0-2.0*dx)
-        y_list_new.append(-25.0-2.0*dy)
+        x_list_new.append(xmax-2.0*dx)
+        y_list_new.append(ymin/2.0-2.0*dy)
         dz_list_new.append((X12-U15)/3+U15)
         # Bottom Left
-        L12 = float(griddata(coord_xy, coord_z, (-50.0, -25.0)))
-        O15 = float(griddata(coord_xy, coord_z, (-25.0, -50.0)))
-        x_list_new.append(-50.0+dx)
-        y_list_new.append(-25.0-dy)
+        L12 = lookup(coord_xy, coord_z, xmin, ymin/2.0)
+        O15 = lookup(coord_xy, coord_z, xmin/2.0, ymin)
+        x_list_new.append(xmin+dx)
+        y_list_new.append(ymin/2.0-dy)
         dz_list_new.append((O15-L12)/3+L12)
-        x_list_new.append(-50.0+2.0*dx)
-        y_list_new.append(-25.0-2.0*dy)
+        x_list_new.append(xmin+2.0*dx)
+        y_list_new.append(ymin/2.0-2.0*dy)
         dz_list_new.append((L12-O15)/3+O15)
         
         # Reset gridddata arrays now that we're using calculated values
@@ -377,45 +496,45 @@ def calculate_contour(x_list, y_list, dz_list, runs, xhigh, yhigh, zhigh, minter
         # Fill in remaining points used in actual calculations
         
         # Tower X
-        M9 = float(griddata(coord_xy, coord_z, (-50.0+dx, 0.0)))
-        M12 = float(griddata(coord_xy, coord_z, (-50.0+dx, -25.0)))
-        x_list_new.append(-50.0+dx)
-        y_list_new.append(-25.0+dy)
+        M9 = lookup(coord_xy, coord_z, xmin+dx, 0.0)
+        M12 = lookup(coord_xy, coord_z, xmin+dx, ymin/2.0)
+        x_list_new.append(xmin+dx)
+        y_list_new.append(ymin/2.0+dy)
         dz_list_new.append((M9-M12)/3.0+M12)
-        #print("M9={0} M12={1} x={2} y={3} z={4}".format(str(M9),str(M12),str(-50.0+dx),str(-25.0+dy),str((M9-M12)/3.0+M12)))
+        #print("M9={0} M12={1} x={2} y={3} z={4}".format(str(M9),str(M12),str(xmin+dx),str(ymin/2.0+dy),str((M9-M12)/3.0+M12)))
         
         # Tower Y
-        W9 = float(griddata(coord_xy, coord_z, (50.0-dx, 0.0)))
-        W12 = float(griddata(coord_xy, coord_z, (50.0-dx, -25.0)))
-        x_list_new.append(50.0-dx)
-        y_list_new.append(-25.0+dy)
+        W9 = lookup(coord_xy, coord_z, xmax-dx, 0.0)
+        W12 = lookup(coord_xy, coord_z, xmax-dx, ymin/2.0)
+        x_list_new.append(xmax-dx)
+        y_list_new.append(ymin/2.0+dy)
         dz_list_new.append((W9-W12)/3.0+W12)
-        #print("W9={0} W12={1} x={2} y={3} z={4}".format(str(W9),str(W12),str(50.0-dx),str(-25.0+dy),str((W9-W12)/3.0+W12)))
+        #print("W9={0} W12={1} x={2} y={3} z={4}".format(str(W9),str(W12),str(xmax-dx),str(ymin/2.0+dy),str((W9-W12)/3.0+W12)))
         
         # Tower Z
-        Q3 = float(griddata(coord_xy, coord_z, (0.0-dx, 50.0)))
-        Q6 = float(griddata(coord_xy, coord_z, (0.0-dx, 25.0)))
+        Q3 = lookup(coord_xy, coord_z, 0.0-dx, ymax)
+        Q6 = lookup(coord_xy, coord_z, 0.0-dx, ymax/2.0)
         x_list_new.append(0.0-dx)
-        y_list_new.append(50.0-dy)
+        y_list_new.append(ymax-dy)
         dz_list_new.append((Q6-Q3)/3.0+Q3)
-        #print("Q3={0} Q6={1} x={2} y={3} z={4}".format(str(Q3),str(Q6),str(0.0-dx),str(50.0-dy),str((Q6-Q3)/3.0+Q3)))
-        S3 = float(griddata(coord_xy, coord_z, (0.0+dx, 50.0)))
-        S6 = float(griddata(coord_xy, coord_z, (0.0+dx, 25.0)))
+        #print("Q3={0} Q6={1} x={2} y={3} z={4}".format(str(Q3),str(Q6),str(0.0-dx),str(ymax-dy),str((Q6-Q3)/3.0+Q3)))
+        S3 = lookup(coord_xy, coord_z, 0.0+dx, ymax)
+        S6 = lookup(coord_xy, coord_z, 0.0+dx, ymax/2.0)
         x_list_new.append(0.0+dx)
-        y_list_new.append(50.0-dy)
+        y_list_new.append(ymax-dy)
         dz_list_new.append((S6-S3)/3.0+S3)
-        #print("S3={0} S6={1} x={2} y={3} z={4}".format(str(Q3),str(Q6),str(0.0+dx),str(50.0-dy),str((S6-S3)/3.0+S3)))
+        #print("S3={0} S6={1} x={2} y={3} z={4}".format(str(Q3),str(Q6),str(0.0+dx),str(ymax-dy),str((S6-S3)/3.0+S3)))
         
         # Outside Ring
         # No additional points
         
         # Center
-        Q9 = float(griddata(coord_xy, coord_z, (0.0-dx, 0.0)))
-        S9 = float(griddata(coord_xy, coord_z, (0.0+dx, 0.0)))
+        Q9 = lookup(coord_xy, coord_z, 0.0-dx, 0.0)
+        S9 = lookup(coord_xy, coord_z, 0.0+dx, 0.0)
         Q7 = (Q9-Q6)/3.0+Q6
         S7 = (S9-S6)/3.0+S6
-        Q12 = float(griddata(coord_xy, coord_z, (0.0-dx, -25.0)))
-        S12 = float(griddata(coord_xy, coord_z, (0.0+dx, -25.0)))
+        Q12 = lookup(coord_xy, coord_z, 0.0-dx, ymin/2.0)
+        S12 = lookup(coord_xy, coord_z, 0.0+dx, ymin/2.0)
         x_list_new.append(0.0-dx)
         y_list_new.append(0.0+dy)
         dz_list_new.append((Q7-Q9)/2.0+Q9)
@@ -432,17 +551,33 @@ def calculate_contour(x_list, y_list, dz_list, runs, xhigh, yhigh, zhigh, minter
         # Convert final values to Array
         coord_xy, coord_z = xyz_list2array(x_list_new,y_list_new,dz_list_new)
 
+    # Height lookup used for all the tower and bowl stats below
+    if minterp == 2:
+        # Fit the surface once and evaluate it directly
+        coeffs, scale = fit_surface(table['x'], table['y'], table['dz'])
+        def surface(xq, yq):
+            return surface_height(coeffs, scale, xq, yq)
+    else:
+        # Triangulate once, same result as griddata without redoing it for every lookup
+        # Points outside the probed area (possible on hex/radial grids) take the nearest probe value
+        linear = LinearNDInterpolator(coord_xy, coord_z)
+        nearest = NearestNDInterpolator(coord_xy, coord_z)
+        def surface(xq, yq):
+            zq = float(linear(xq, yq))
+            if np.isnan(zq):
+                zq = float(nearest(xq, yq))
+            return zq
     
     # North Tilt (opposite of LCD)
     x0 = xmin
     y0 = ymin/2
-    ntower = float(griddata(coord_xy, coord_z, (x0, y0)))
+    ntower = surface(x0, y0)
     TN_list = [None]*5
-    TN_list[0] = float(griddata(coord_xy, coord_z, (x0   , y0)))
-    TN_list[1] = float(griddata(coord_xy, coord_z, (x0   , y0+dy)))
-    TN_list[2] = float(griddata(coord_xy, coord_z, (x0+dx, y0)))
-    TN_list[3] = float(griddata(coord_xy, coord_z, (x0+dx, y0+dy)))
-    TN_list[4] = float(griddata(coord_xy, coord_z, (x0+dx, y0-dy)))
+    TN_list[0] = surface(x0   , y0)
+    TN_list[1] = surface(x0   , y0+dy)
+    TN_list[2] = surface(x0+dx, y0)
+    TN_list[3] = surface(x0+dx, y0+dy)
+    TN_list[4] = surface(x0+dx, y0-dy)
     #print("TN Values\n")
     #print(*TN_list, sep='\n\n')
     #print("\n")
@@ -451,13 +586,13 @@ def calculate_contour(x_list, y_list, dz_list, runs, xhigh, yhigh, zhigh, minter
     # West Tilt (left of LCD)
     x0 = xmax
     y0 = ymin/2
-    wtower = float(griddata(coord_xy, coord_z, (x0, y0)))
+    wtower = surface(x0, y0)
     TW_list = [None]*5
-    TW_list[0] = float(griddata(coord_xy, coord_z, (x0   , y0)))
-    TW_list[1] = float(griddata(coord_xy, coord_z, (x0   , y0+dy)))
-    TW_list[2] = float(griddata(coord_xy, coord_z, (x0-dx, y0))) # problem
-    TW_list[3] = float(griddata(coord_xy, coord_z, (x0-dx, y0+dy)))
-    TW_list[4] = float(griddata(coord_xy, coord_z, (x0-dx, y0-dy)))
+    TW_list[0] = surface(x0   , y0)
+    TW_list[1] = surface(x0   , y0+dy)
+    TW_list[2] = surface(x0-dx, y0) # problem
+    TW_list[3] = surface(x0-dx, y0+dy)
+    TW_list[4] = surface(x0-dx, y0-dy)
     #print("TW Values\n")
     #print(*TW_list, sep='\n\n')
     #print("\n")
@@ -466,14 +601,14 @@ def calculate_contour(x_list, y_list, dz_list, runs, xhigh, yhigh, zhigh, minter
     # East Tilt (right of LCD)
     x0 = 0.0
     y0 = ymax
-    etower = float(griddata(coord_xy, coord_z, (x0, y0)))
+    etower = surface(x0, y0)
     TE_list = [None]*6
-    TE_list[0] = float(griddata(coord_xy, coord_z, (x0-dx, y0)))
-    TE_list[1] = float(griddata(coord_xy, coord_z, (x0   , y0)))
-    TE_list[2] = float(griddata(coord_xy, coord_z, (x0+dx, y0)))
-    TE_list[3] = float(griddata(coord_xy, coord_z, (x0-dx, y0-dy)))
-    TE_list[4] = float(griddata(coord_xy, coord_z, (x0   , y0-dy)))
-    TE_list[5] = float(griddata(coord_xy, coord_z, (x0+dx, y0-dy)))
+    TE_list[0] = surface(x0-dx, y0)
+    TE_list[1] = surface(x0   , y0)
+    TE_list[2] = surface(x0+dx, y0)
+    TE_list[3] = surface(x0-dx, y0-dy)
+    TE_list[4] = surface(x0   , y0-dy)
+    TE_list[5] = surface(x0+dx, y0-dy)
     #print("TE Values\n")
     #print(*TE_list, sep='\n\n')
     #print("\n")
@@ -483,15 +618,15 @@ def calculate_contour(x_list, y_list, dz_list, runs, xhigh, yhigh, zhigh, minter
     x0 = 0.0
     y0 = 0.0
     BC_list = [None]*9
-    BC_list[0] = float(griddata(coord_xy, coord_z, (x0-dx, y0+dy)))
-    BC_list[1] = float(griddata(coord_xy, coord_z, (x0   , y0+dy)))
-    BC_list[2] = float(griddata(coord_xy, coord_z, (x0+dx, y0+dy)))
-    BC_list[3] = float(griddata(coord_xy, coord_z, (x0-dx, y0)))
-    BC_list[4] = float(griddata(coord_xy, coord_z, (x0   , y0)))
-    BC_list[5] = float(griddata(coord_xy, coord_z, (x0+dx, y0)))
-    BC_list[6] = float(griddata(coord_xy, coord_z, (x0-dx, y0-dy)))
-    BC_list[7] = float(griddata(coord_xy, coord_z, (x0   , y0-dy)))
-    BC_list[8] = float(griddata(coord_xy, coord_z, (x0+dx, y0-dy)))
+    BC_list[0] = surface(x0-dx, y0+dy)
+    BC_list[1] = surface(x0   , y0+dy)
+    BC_list[2] = surface(x0+dx, y0+dy)
+    BC_list[3] = surface(x0-dx, y0)
+    BC_list[4] = surface(x0   , y0)
+    BC_list[5] = surface(x0+dx, y0)
+    BC_list[6] = surface(x0-dx, y0-dy)
+    BC_list[7] = surface(x0   , y0-dy)
+    BC_list[8] = surface(x0+dx, y0-dy)
     #print("Bowl Center: \n")
     #print(*BC_list, sep='\n\n')
     #print("\n")
@@ -500,21 +635,21 @@ def calculate_contour(x_list, y_list, dz_list, runs, xhigh, yhigh, zhigh, minter
     # Bowl Stats - Outside Ring
     OR_list = [None]*12
     # Left
-    OR_list[0]  = float(griddata(coord_xy, coord_z, (xmin, ymin/2.0)))
-    OR_list[1]  = float(griddata(coord_xy, coord_z, (xmin,   0.0)))
-    OR_list[2]  = float(griddata(coord_xy, coord_z, (xmin,  ymax/2.0)))
+    OR_list[0]  = surface(xmin, ymin/2.0)
+    OR_list[1]  = surface(xmin,   0.0)
+    OR_list[2]  = surface(xmin,  ymax/2.0)
     # Right
-    OR_list[3]  = float(griddata(coord_xy, coord_z, (xmax, ymin/2.0)))
-    OR_list[4]  = float(griddata(coord_xy, coord_z, (xmax,   0.0)))
-    OR_list[5]  = float(griddata(coord_xy, coord_z, (xmax,  ymax/2.0)))
+    OR_list[3]  = surface(xmax, ymin/2.0)
+    OR_list[4]  = surface(xmax,   0.0)
+    OR_list[5]  = surface(xmax,  ymax/2.0)
     # Top
-    OR_list[6]  = float(griddata(coord_xy, coord_z, (xmin/2.0,  ymax)))
-    OR_list[7]  = float(griddata(coord_xy, coord_z, (   0.0,  ymax)))
-    OR_list[8]  = float(griddata(coord_xy, coord_z, (xmax/2.0,  ymax)))
+    OR_list[6]  = surface(xmin/2.0,  ymax)
+    OR_list[7]  = surface(   0.0,  ymax)
+    OR_list[8]  = surface(xmax/2.0,  ymax)
     # Bottom
-    OR_list[9]  = float(griddata(coord_xy, coord_z, (xmin/2.0, ymin)))
-    OR_list[10] = float(griddata(coord_xy, coord_z, (   0.0, ymin)))
-    OR_list[11] = float(griddata(coord_xy, coord_z, (xmax/2.0, ymin)))
+    OR_list[9]  = surface(xmin/2.0, ymin)
+    OR_list[10] = surface(   0.0, ymin)
+    OR_list[11] = surface(xmax/2.0, ymin)
     BowlOR = float(statistics.median(OR_list))
     #print("Outer Ring Values: \n")
     #print(*OR_list, sep='\n\n')
@@ -589,14 +724,170 @@ def determine_error(TX, TY, TZ, THigh, BowlCenter, BowlOR):
     x_error = float("{0:.4f}".format(TX - THigh))
     y_error = float("{0:.4f}".format(TY - THigh))
     c_error = float("{0:.4f}".format(BowlCenter - BowlOR))
-    print('Z-Error: ' + str(z_error) + ' X-Error: ' + str(x_error) + ' Y-Error: ' + str(y_error) + ' C-Error: ' + str(c_error) + '\n')
+    console.info('Z-Error: ' + str(z_error) + ' X-Error: ' + str(x_error) + ' Y-Error: ' + str(y_error) + ' C-Error: ' + str(c_error) + '\n')
 
     return z_error, x_error, y_error, c_error
-    
 
-def calibrate(port, z_error, x_error, y_error, c_error, trial_x, trial_y, trial_z, l_value, r_value, iHighTower, max_runs, runs):
+
+# Delta geometry model used by the geometry calibration mode (-cm 1)
+# Geometry values are kept in a dict using the same keys as the settings file:
+#     x, y, z : M666 endstop adjustments
+#     r, l    : M665 delta radius and diagonal rod length
+#     ax, ay, az : M665 X/Y/Z tower angle corrections (degrees)
+# Tower base angles follow Marlin (X at 210, Y at 330, Z at 90 degrees), one row per tower flag
+tower_base_angles = [[210.0, 330.0, 90.0], [90.0, 210.0, 330.0], [330.0, 90.0, 210.0]]
+
+# Parameters estimated by the geometry fit, the Z tower angle stays fixed since a rotation of all
+# three towers can't be seen on a flat bed
+geometry_parameters = ['x', 'y', 'z', 'r', 'l', 'ax', 'ay']
+
+def delta_towers(geom, tower_flag):
+    angles = np.radians(np.array(tower_base_angles[tower_flag]) + np.array([geom['ax'], geom['ay'], geom['az']]))
+    return geom['r']*np.cos(angles), geom['r']*np.sin(angles)
+
+def delta_inverse(x, y, z, geom, tower_flag):
+    # Carriage heights (one column per tower) needed to put the nozzle at x, y, z
+    tx, ty = delta_towers(geom, tower_flag)
+    dx = x[:, None] - tx[None, :]
+    dy = y[:, None] - ty[None, :]
+    return z[:, None] + np.sqrt(geom['l']**2 - dx**2 - dy**2)
+
+def delta_forward(carriages, geom, tower_flag):
+    # Trilateration of the nozzle position from the carriage heights (same approach as Marlin's forward_kinematics)
+    tx, ty = delta_towers(geom, tower_flag)
+    p1 = np.column_stack((np.full(len(carriages), tx[0]), np.full(len(carriages), ty[0]), carriages[:, 0]))
+    p12 = np.column_stack((np.full(len(carriages), tx[1]-tx[0]), np.full(len(carriages), ty[1]-ty[0]), carriages[:, 1]-carriages[:, 0]))
+    p13 = np.column_stack((np.full(len(carriages), tx[2]-tx[0]), np.full(len(carriages), ty[2]-ty[0]), carriages[:, 2]-carriages[:, 0]))
+    d = np.linalg.norm(p12, axis=1)
+    ex = p12/d[:, None]
+    i = np.sum(ex*p13, axis=1)
+    ey = p13 - ex*i[:, None]
+    j = np.linalg.norm(ey, axis=1)
+    ey = ey/j[:, None]
+    ez = np.cross(ex, ey)
+    # Make sure ez points up so the nozzle solution is the one below the carriages
+    ez = ez*np.sign(ez[:, 2])[:, None]
+    xn = d/2.0
+    yn = ((i**2 + j**2)/2.0 - i*xn)/j
+    zn = np.sqrt(geom['l']**2 - xn**2 - yn**2)
+    return p1 + ex*xn[:, None] + ey*yn[:, None] - ez*zn[:, None]
+
+def delta_probe_heights(x_list, y_list, fw_geom, actual_geom, tower_flag):
+    # Heights reported by the probe on a flat bed when the firmware is set to fw_geom
+    # but the printer really has actual_geom (actual endstop values being the "correct" M666 values)
+    x = np.asarray(x_list, dtype=float)
+    y = np.asarray(y_list, dtype=float)
+    z = np.zeros(len(x))
+    offset = np.array([fw_geom['x']-actual_geom['x'], fw_geom['y']-actual_geom['y'], fw_geom['z']-actual_geom['z']])
+    for ii in range(4):
+        nozzle = delta_forward(delta_inverse(x, y, z, fw_geom, tower_flag) + offset[None, :], actual_geom, tower_flag)
+        z = z - nozzle[:, 2]
+    return z
+
+def delta_jacobian(x_list, y_list, geom, tower_flag, params=geometry_parameters, step=0.01):
+    # Sensitivity of every probe height to every geometry parameter (central differences)
+    columns = []
+    for param in params:
+        geom_plus = dict(geom)
+        geom_minus = dict(geom)
+        geom_plus[param] += step
+        geom_minus[param] -= step
+        h_plus = delta_probe_heights(x_list, y_list, geom_plus, geom, tower_flag)
+        h_minus = delta_probe_heights(x_list, y_list, geom_minus, geom, tower_flag)
+        columns.append((h_plus - h_minus)/(2.0*step))
+    return np.column_stack(columns)
+
+# Values after a correction step: delta added to each of the parameters, the highest endstop kept at
+# zero (a common shift only moves the overall height) and everything rounded to what set_M_values sends
+def corrected_values(values, parameters, delta):
+    new_values = dict(values)
+    for ii, param in enumerate(parameters):
+        new_values[param] = values[param] + float(delta[ii])
+    shift = max(new_values['x'], new_values['y'], new_values['z'])
+    for key in ['x', 'y', 'z']:
+        new_values[key] = new_values[key] - shift
+    for key in new_values:
+        new_values[key] = float("{0:.4f}".format(new_values[key]))
+    return new_values
+
+def estimate_geometry(x_list, y_list, dz_list, geom, tower_flag, damping=1e-3):
+    # One Gauss-Newton step fitting endstops, radius, rod length and tower angles to the probed heights
+    # The three endstops together absorb the overall height so dz_list only needs to be relative
+    # A little Levenberg-Marquardt damping keeps the nearly degenerate radius/rod length pair stable
+    jac = delta_jacobian(x_list, y_list, geom, tower_flag)
+    dz = np.asarray(dz_list, dtype=float)
+    jtj = jac.T @ jac
+    damped_inv = np.linalg.inv(jtj + damping*np.diag(np.diag(jtj)))
+    delta = damped_inv @ (jac.T @ dz)
+
+    # Parameter covariance for unit variance on each probed height, scale by the height variance to use it
+    covariance = damped_inv @ jtj @ damped_inv
+
+    new_geom = corrected_values(geom, geometry_parameters, -delta)
+
+    # Height change the correction is expected to make at each probe point
+    correction = jac @ delta
+    correction = correction - np.mean(correction)
+
+    return new_geom, correction, jac, covariance
+
+# Statistical stopping rule (-sc)
+# The double taps give a direct measure of the probe repeatability, corrections smaller than what that
+# noise (or a single motor step) can explain are treated as zero instead of using a fixed 0.02 threshold
+def estimate_tap_noise(dtap_list):
+    # Each double tap difference carries the noise of two taps, so its variance is twice that of a single tap
+    dtap = np.asarray(dtap_list, dtype=float)
+    return float(np.sqrt(np.mean(dtap**2)/2.0))
+
+def contour_errors(table, runs, xhigh, yhigh, zhigh, minterp, tower_flag):
+    # Same errors as determine_error (z, x, y, c order) without printing or touching the high tower flags
+    TX, TY, TZ, THigh, BowlCenter, BowlOR, xh, yh, zh, iHighTower = calculate_contour(table, runs, list(xhigh), list(yhigh), list(zhigh), minterp, tower_flag)
+    return np.array([TZ - THigh, TX - THigh, TY - THigh, BowlCenter - BowlOR])
+
+def error_standard_errors(table, runs, xhigh, yhigh, zhigh, minterp, tower_flag, sigma_avg, step=1e-3):
+    # The contour is linear in the probed heights (apart from the median and the high tower pick),
+    # so nudge one point at a time (in place, restored afterwards) to get the weight of every point in every error
+    base = contour_errors(table, runs, xhigh, yhigh, zhigh, minterp, tower_flag)
+    weights = np.zeros((len(base), len(table)))
+    for ii in range(len(table)):
+        dz_saved = table['dz'][ii]
+        table['dz'][ii] = dz_saved + step
+        weights[:, ii] = (contour_errors(table, runs, xhigh, yhigh, zhigh, minterp, tower_flag) - base)/step
+        table['dz'][ii] = dz_saved
+    return sigma_avg*np.sqrt(np.sum(weights**2, axis=1))
+
+# Stop test of the fitted modes (-cm 1, -cm 2, -ap 1): every height correction within 0.02 like the
+# spreadsheet or, given their standard errors (-sc), within zscore of them and at least one motor step
+def corrections_settled(correction, correction_se=None, zscore=None, step_floor=0.0):
+    if correction_se is None:
+        thresholds = np.full(len(correction), 0.02)
+    else:
+        thresholds = np.maximum(zscore*correction_se, step_floor)
+    return bool(np.all(np.abs(correction) < thresholds))
+
+# Errors the parameters can't explain (tower angles on the stock firmware, a warped bed) leave
+# corrections that don't make the bed any flatter, once the last one took off less than stall_ratio
+# of the rms height of the pass before (prev_table) the current values are kept
+stall_ratio = 0.1
+
+def flattening_stalled(table, prev_table):
+    if prev_table is None:
+        return False
+    rms = float(np.std(table['dz']))
+    prev_rms = float(np.std(prev_table['dz']))
+    if rms > (1.0 - stall_ratio)*prev_rms:
+        console.info('Corrections stopped flattening the bed (rms {0:.4f} after {1:.4f}), keeping the current values'.format(rms, prev_rms))
+        return True
+    return False
+
+# ci: confidence interval half width per parameter, L and the tower angles are printed when there
+def print_confidence_interval(ci):
+    m665 = ' '.join('{0}+/-{1:.4f}'.format(code, ci[param]) for code, param in [('L', 'l'), ('R', 'r'), ('X', 'ax'), ('Y', 'ay')] if param in ci)
+    console.info("Confidence interval\nM666 Z+/-{0:.4f} X+/-{1:.4f} Y+/-{2:.4f} \nM665 {3}".format(ci['z'], ci['x'], ci['y'], m665))
+
+def calibrate(port, z_error, x_error, y_error, c_error, trial_x, trial_y, trial_z, l_value, r_value, iHighTower, max_runs, runs, thresholds=(0.02, 0.02, 0.02, 0.02), std_errors=None, zscore=None):
     calibrated = True
-    if abs(z_error) >= 0.02:
+    if abs(z_error) >= thresholds[0]:
         if iHighTower == 2:
             new_z = float("{0:.4f}".format(0.0))
         else:
@@ -605,7 +896,7 @@ def calibrate(port, z_error, x_error, y_error, c_error, trial_x, trial_y, trial_
     else:
         new_z = trial_z
 
-    if abs(x_error) >= 0.02:
+    if abs(x_error) >= thresholds[1]:
         if iHighTower == 0:
             new_x = float("{0:.4f}".format(0.0))
         else:
@@ -614,7 +905,7 @@ def calibrate(port, z_error, x_error, y_error, c_error, trial_x, trial_y, trial_
     else:
         new_x = trial_x
 
-    if abs(y_error) >= 0.02:
+    if abs(y_error) >= thresholds[2]:
         if iHighTower == 1:
             new_y = float("{0:.4f}".format(0.0))
         else:
@@ -623,7 +914,7 @@ def calibrate(port, z_error, x_error, y_error, c_error, trial_x, trial_y, trial_
     else:
         new_y = trial_y
 
-    if abs(c_error) >= 0.02:
+    if abs(c_error) >= thresholds[3]:
         new_r = float("{0:.4f}".format(r_value - 4.0*c_error))
         calibrated = False
     else:
@@ -641,22 +932,371 @@ def calibrate(port, z_error, x_error, y_error, c_error, trial_x, trial_y, trial_
     #new_y += diff
 
     if calibrated:
-        print ("Final values\nM666 Z{0} X{1} Y{2} \nM665 L{3} R{4}".format(str(new_z),str(new_x),str(new_y),str(new_l),str(new_r)))
+        console.info("Final values\nM666 Z{0} X{1} Y{2} \nM665 L{3} R{4}".format(str(new_z),str(new_x),str(new_y),str(new_l),str(new_r)))
+        if std_errors is not None:
+            # Endstops follow their tower error 1:1, R moves 4x the bowl error and L 1.5x R
+            console.info("Confidence interval\nM666 Z+/-{0:.4f} X+/-{1:.4f} Y+/-{2:.4f} \nM665 L+/-{3:.4f} R+/-{4:.4f}".format(zscore*std_errors[0], zscore*std_errors[1], zscore*std_errors[2], zscore*6.0*std_errors[3], zscore*4.0*std_errors[3]))
     else:
         set_M_values(port, new_z, new_x, new_y, new_l, new_r)
 
     return calibrated, new_z, new_x, new_y, new_l, new_r
 
-def set_M_values(port, z, x, y, l, r):
+def calibrate_geometry(port, table, trial_x, trial_y, trial_z, l_value, r_value, tower_angles, tower_flag, sigma_avg=None, zscore=None, step_floor=0.0):
+    # Least squares fit of endstops, radius, rod length and tower angles to the whole grid in one pass
+    geom = {'x':trial_x, 'y':trial_y, 'z':trial_z, 'r':r_value, 'l':l_value,
+            'ax':tower_angles[0], 'ay':tower_angles[1], 'az':tower_angles[2]}
+    with tracer.span('geometry fit', 'compute'):
+        new_geom, correction, jac, covariance = estimate_geometry(table['x'], table['y'], table['dz'], geom, tower_flag)
+    console.info('Geometry fit: max height correction {0:.4f}'.format(float(np.max(np.abs(correction)))))
+
+    correction_se = None
+    if sigma_avg is not None:
+        centered = jac - np.mean(jac, axis=0)
+        correction_se = sigma_avg*np.sqrt(np.sum((centered @ covariance)*centered, axis=1))
+    calibrated = corrections_settled(correction, correction_se, zscore, step_floor)
+    if calibrated:
+        new_geom = geom
+
+    new_angles = [new_geom['ax'], new_geom['ay'], new_geom['az']]
+
+    if calibrated:
+        console.info("Final values\nM666 Z{0} X{1} Y{2} \nM665 L{3} R{4} X{5} Y{6} Z{7}".format(str(new_geom['z']),str(new_geom['x']),str(new_geom['y']),str(new_geom['l']),str(new_geom['r']),str(new_angles[0]),str(new_angles[1]),str(new_angles[2])))
+        if sigma_avg is not None:
+            print_confidence_interval(dict((param, zscore*sigma_avg*np.sqrt(covariance[ii, ii])) for ii, param in enumerate(geometry_parameters)))
+    else:
+        set_M_values(port, new_geom['z'], new_geom['x'], new_geom['y'], new_geom['l'], new_geom['r'], new_angles)
+
+    return calibrated, new_geom['z'], new_geom['x'], new_geom['y'], new_geom['l'], new_geom['r'], new_angles
+
+# Measured Jacobian calibration mode (-cm 2)
+# Instead of the spreadsheet's fixed sensitivities (endstops 1:1, R 4x the bowl, L 1.5x R) the
+# printer's own response is measured: each parameter is moved by a small step in turn and the grid
+# probed again, the height change per mm is one column of the Jacobian. All corrections are then
+# solved at once from it, and since the sensitivities hardly change between calibrations it is
+# cached per printer (-p or --jacobian-key) and grid, later calibrations start right away.
+jacobian_steps = {'x': 0.3, 'y': 0.3, 'z': 0.3, 'r': 0.5, 'l': 0.5}
+jacobian_file = 'auto_cal_p5_jacobian.json'
+
+# The rod length can't be told apart from the radius on the handful of P2 points
+def jacobian_parameters(grid):
+    return ['x', 'y', 'z', 'r', 'l'] if len(grid) > 5 else ['x', 'y', 'z', 'r']
+
+def load_jacobian(filename, key, grid, tower_flag):
+    try:
+        with open(filename) as jacobian_file:
+            entry = json.load(jacobian_file).get(key)
+    except (IOError, OSError, ValueError):
+        return None
+    if entry is None or entry['grid'] != grid or entry['tower_flag'] != tower_flag:
+        return None
+    entry['jacobian'] = np.array(entry['jacobian'])
+    return entry
+
+def save_jacobian(filename, key, entry):
+    try:
+        with open(filename) as jacobian_file:
+            cache = json.load(jacobian_file)
+    except (IOError, OSError, ValueError):
+        cache = {}
+    cache[key] = dict(entry, jacobian=entry['jacobian'].tolist())
+    with open(filename, 'w') as jacobian_file:
+        json.dump(cache, jacobian_file, indent=2, sort_keys=True)
+
+# Probes the trial values and once more per parameter with that parameter moved by its step.
+# Returns the Jacobian entry (probe height change per mm, one column per parameter) and the table
+# of the trial values, which doubles as the first calibration pass.
+def measure_jacobian(port, firmFlag, grid, trial_x, trial_y, trial_z, l_value, r_value, tower_flag):
+    trial = {'x':trial_x, 'y':trial_y, 'z':trial_z, 'r':r_value, 'l':l_value}
+    parameters = jacobian_parameters(grid)
+    console.info('\nMeasuring the Jacobian, probing once more for each of {0}'.format(', '.join(parameters)))
+    columns = []
+    # The trial values' probing is the first calibration pass (run_calibration gets it as probed),
+    # the time budget counts it as that pass
+    with tracer.span('pass 0'):
+        base = get_current_values(port, firmFlag, grid)
+    with tracer.span('measure jacobian'):
+        for param in parameters:
+            moved = dict(trial)
+            moved[param] += jacobian_steps[param]
+            set_M_values(port, moved['z'], moved['x'], moved['y'], moved['l'], moved['r'])
+            table = get_current_values(port, firmFlag, grid, travel_height(base))
+            columns.append((table['dz'] - base['dz'])/jacobian_steps[param])
+        set_M_values(port, trial_z, trial_x, trial_y, l_value, r_value)
+
+    jacobian = np.column_stack(columns)
+    for ii, param in enumerate(parameters):
+        console.info('{0}: {1:.3f} mm height range per mm'.format(param, float(np.ptp(jacobian[:, ii]))))
+    return {'grid': grid, 'tower_flag': tower_flag, 'parameters': parameters, 'steps': dict((p, jacobian_steps[p]) for p in parameters),
+            'trial': trial, 'measured': time.strftime('%Y-%m-%d %H:%M:%S'), 'jacobian': jacobian}, base
 
-    print ("Setting values M666 X{0} Y{1} Z{2}, M665 L{3} R{4}".format(str(x),str(y),str(z),str(l),str(r)))
+# A parameter that doesn't move any probe height can't be solved for (and means a bad measurement)
+def jacobian_dead_parameters(entry, floor=1e-3):
+    ranges = np.ptp(entry['jacobian'], axis=0)
+    return [param for param, height_range in zip(entry['parameters'], ranges) if height_range < floor]
 
-    port.write(('M666 X{0} Y{1} Z{2}\n'.format(str(x), str(y), str(z))).encode())
-    out = port.readline().decode()
-    port.write(('M665 L{0} R{1}\n'.format(str(l),str(r))).encode())
-    out = port.readline().decode()
+def solve_jacobian(jac, dz_list, damping=1e-3):
+    # Least squares step that flattens the probed heights, with the same damping as estimate_geometry
+    # for the radius/rod length pair. Heights are relative, so both sides lose their mean.
+    jac = jac - np.mean(jac, axis=0)
+    dz = np.asarray(dz_list, dtype=float)
+    dz = dz - np.mean(dz)
+    jtj = jac.T @ jac
+    # pinv, a dry run measures an all zero Jacobian
+    damped_inv = np.linalg.pinv(jtj + damping*np.diag(np.diag(jtj)))
+    delta = -damped_inv @ (jac.T @ dz)
+    covariance = damped_inv @ jtj @ damped_inv
+    # Height change the correction is expected to make at each probe point
+    return delta, jac @ delta, jac, covariance
+
+# prev_table: the probe table of the pass before, for the stall check (flattening_stalled)
+def calibrate_jacobian(port, table, entry, trial_x, trial_y, trial_z, l_value, r_value, sigma_avg=None, zscore=None, step_floor=0.0, prev_table=None):
+    values = {'x':trial_x, 'y':trial_y, 'z':trial_z, 'r':r_value, 'l':l_value}
+    with tracer.span('jacobian solve', 'compute'):
+        delta, correction, jac, covariance = solve_jacobian(entry['jacobian'], table['dz'])
+    console.info('Jacobian solve: max height correction {0:.4f}'.format(float(np.max(np.abs(correction)))))
+
+    correction_se = None
+    if sigma_avg is not None:
+        correction_se = sigma_avg*np.sqrt(np.sum((jac @ covariance)*jac, axis=1))
+    calibrated = corrections_settled(correction, correction_se, zscore, step_floor) or flattening_stalled(table, prev_table)
+
+    new_values = values if calibrated else corrected_values(values, entry['parameters'], delta)
+
+    if calibrated:
+        console.info("Final values\nM666 Z{0} X{1} Y{2} \nM665 L{3} R{4}".format(str(new_values['z']),str(new_values['x']),str(new_values['y']),str(new_values['l']),str(new_values['r'])))
+        if sigma_avg is not None:
+            print_confidence_interval(dict((param, zscore*sigma_avg*np.sqrt(covariance[ii, ii])) for ii, param in enumerate(entry['parameters'])))
+    else:
+        set_M_values(port, new_values['z'], new_values['x'], new_values['y'], new_values['l'], new_values['r'])
+
+    return calibrated, new_values['z'], new_values['x'], new_values['y'], new_values['l'], new_values['r']
+
+# Active probing (-ap 1, Marlin only)
+# Instead of probing the whole grid every pass, the grid points are candidates and probed one at a
+# time. A Bayesian linear model of the probed heights (the geometry Jacobian at the current values
+# plus the overall bed height, with Gaussian priors) is updated after every point, the next point is
+# the candidate that takes the most out of the variance of the height corrections over the grid,
+# and probing stops once every correction is known to within the 0.02 threshold. The pass then
+# applies the posterior mean and stops like the geometry fit (-cm 1) does.
+active_prior_sd = {'x': 0.5, 'y': 0.5, 'z': 0.5, 'r': 1.0, 'l': 1.0, 'ax': 0.5, 'ay': 0.5}
+active_height_sd = 5.0  # prior on the overall bed height (mm)
+active_noise = 0.005    # tap noise (mm) until the double taps give an estimate
+active_min_points = 4
+
+# Design matrix of the candidates, one row per point: geometry Jacobian then the overall height
+def active_design(grid, geom, tower_flag):
+    x = np.array([point[0] for point in grid], dtype=float)
+    y = np.array([point[1] for point in grid], dtype=float)
+    jac = delta_jacobian(x, y, geom, tower_flag)
+    return np.column_stack((jac, np.ones(len(grid))))
+
+# The correction a parameter change makes, the overall height left out (rows padded with a zero for it)
+def active_correction_rows(design):
+    jac = design[:, :-1]
+    return np.column_stack((jac - np.mean(jac, axis=0), np.zeros(len(design))))
+
+def active_update(mean, cov, row, z, noise_var):
+    s = row @ cov @ row + noise_var
+    gain = cov @ row / s
+    return mean + gain*(z - row @ mean), cov - np.outer(gain, row @ cov)
+
+# Variance the correction at every candidate loses when candidate k gets probed, summed over the candidates
+def active_gain(design, correction_rows, cov, noise_var):
+    cross = correction_rows @ cov @ design.T
+    return np.sum(cross**2, axis=0)/(np.sum((design @ cov)*design, axis=1) + noise_var)
+
+# Largest correction uncertainty over the candidates (zscore standard deviations)
+def active_uncertainty(correction_rows, cov, zscore):
+    return zscore*float(np.sqrt(np.max(np.sum((correction_rows @ cov)*correction_rows, axis=1))))
+
+# home: False when the G28 has already been queued (overlap mode)
+# Returns the table, the posterior mean of the parameter errors and their covariance, the height
+# corrections and their standard errors
+def probe_active(port, grid, geom, tower_flag, zscore, z_travel=None, threshold=0.02, home=True):
+    design = active_design(grid, geom, tower_flag)
+    correction_rows = active_correction_rows(design)
+    mean = np.zeros(design.shape[1])
+    cov = np.diag([active_prior_sd[param]**2 for param in geometry_parameters] + [active_height_sd**2])
+    uncertainty = active_uncertainty(correction_rows, cov, zscore)
+    probed = []
+    rows = []
+
+    if home:
+        with tracer.span('home'):
+            port.write('G28')
+            port.wait_for_ok(deadline_in(home_timeout))
+
+    tracer.begin('probe', candidates=len(grid))
+    while len(probed) < len(grid) and (len(probed) < active_min_points or uncertainty >= threshold):
+        # Tap noise of the averaged two taps, from the taps so far once there are enough of them
+        tap_noise = estimate_tap_noise([row[3] - row[2] for row in rows]) if len(rows) >= 3 else active_noise
+        noise_var = max(tap_noise, 1e-4)**2/2.0
+        gain = active_gain(design, correction_rows, cov, noise_var)
+        gain[probed] = -1.0
+        ii = int(np.argmax(gain))
+
+        # The first point also waits for the queued homing
+        deadline = deadline_in(point_timeout + (0 if home or probed else home_timeout))
+        port.write(probe_moves([grid[ii]], z_travel)[0])
+        port.write('G30')
+        port.write('G30')
+        z1 = float(get_points(port, deadline)[6])
+        z2 = float(get_points(port, deadline)[6])
+        z_avg = float("{0:.4f}".format((z1 + z2) / 2.0))
+        mean, cov = active_update(mean, cov, design[ii], z_avg, noise_var)
+        uncertainty = active_uncertainty(correction_rows, cov, zscore)
+        probed.append(ii)
+        rows.append((grid[ii][0], grid[ii][1], z1, z2, z_avg))
+        console.debug('Probed X{0} Y{1}: {2:.4f}, correction uncertainty now {3:.4f}'.format(grid[ii][0], grid[ii][1], z_avg, uncertainty))
+    port.wait_for_ok(deadline_in(point_timeout))
+    tracer.end('probe')
+
+    table = new_probe_table([grid[ii] for ii in probed])
+    for row, (x, y, z1, z2, z_avg) in zip(table, rows):
+        row['z1'] = z1
+        row['z2'] = z2
+        row['z_avg'] = z_avg
+        row['dtap'] = z2 - z1
+    table['dz'] = table['z_avg'] - np.median(table['z_avg'])
+    console.info('Active probing: {0} of {1} points, correction uncertainty {2:.4f}'.format(len(probed), len(grid), uncertainty))
+    rows = correction_rows[:, :-1]
+    covariance = cov[:-1, :-1]
+    return table, mean[:-1], covariance, rows @ mean[:-1], np.sqrt(np.sum((rows @ covariance)*rows, axis=1))
+
+# The options work as in run_calibration: max_error limits the contour errors after the first pass,
+# minterp is the interpolation of the contour (of the points probed) that gives those errors and
+# the highest tower for the records, pass_files and overlap as there. With stat_confidence (-sc) the
+# corrections are compared with their posterior standard errors and step_mm's motor step.
+def run_active_calibration(port, grid, trial_x, trial_y, trial_z, l_value, r_value, tower_angles, tower_flag, max_runs, max_error, bed_temp, minterp, stat_confidence, step_mm, pass_files=False, overlap=None, exit_on_failure=True):
+    geom = {'x':trial_x, 'y':trial_y, 'z':trial_z, 'r':r_value, 'l':l_value,
+            'ax':tower_angles[0], 'ay':tower_angles[1], 'az':tower_angles[2]}
+    zscore = confidence_zscore(stat_confidence if stat_confidence > 0 else 0.95)
+    prev_table = None
+    queued = False
+    xhigh = [0]*2
+    yhigh = [0]*2
+    zhigh = [0]*2
+    for runs in range(1, max_runs + 1):
+        console.info('\nCalibration pass {1}, run {2} out of {0}'.format(str(max_runs), str(runs-1), str(runs)))
+        tracer.begin('pass {0}'.format(runs-1))
+        if bed_temp >= 0 and not queued:
+            with tracer.span('heat'):
+                port.write('M140 S{0}'.format(str(bed_temp)))
+
+        table, delta, covariance, correction, correction_se = probe_active(port, grid, geom, tower_flag, zscore, travel_height(prev_table), home=not queued)
+        uncertainty = zscore*float(np.max(correction_se))
+        with tracer.span('contour', 'compute'):
+            TX, TY, TZ, THigh, BowlCenter, BowlOR, xhigh, yhigh, zhigh, iHighTower = calculate_contour(table, runs, xhigh, yhigh, zhigh, minterp, tower_flag)
+        with tracer.span('error', 'compute'):
+            z_error, x_error, y_error, c_error = determine_error(TX, TY, TZ, THigh, BowlCenter, BowlOR)
+        if abs(max([z_error, x_error, y_error, c_error], key=abs)) > max_error and runs > 1:
+            tracer.end('pass {0}'.format(runs-1))
+            calibrated = calibration_failed("Calibration error on non-first run exceeds set limit", exit_on_failure)
+            return calibrated, geom['z'], geom['x'], geom['y'], geom['l'], geom['r'], [geom['ax'], geom['ay'], geom['az']]
+        console.info('Geometry fit: max height correction {0:.4f}'.format(float(np.max(np.abs(correction)))))
+        calibrated = corrections_settled(correction, correction_se if stat_confidence > 0 else None, zscore, 1.0/step_mm) or flattening_stalled(table, prev_table)
+
+        new_geom = geom if calibrated else corrected_values(geom, geometry_parameters, -delta)
+        new_angles = [new_geom['ax'], new_geom['ay'], new_geom['az']]
+
+        if calibrated:
+            console.info("Final values\nM666 Z{0} X{1} Y{2} \nM665 L{3} R{4} X{5} Y{6} Z{7}".format(str(new_geom['z']),str(new_geom['x']),str(new_geom['y']),str(new_geom['l']),str(new_geom['r']),str(new_angles[0]),str(new_angles[1]),str(new_angles[2])))
+            # The posterior already carries the tap noise. A common endstop shift only moves the overall
+            # height (that prior is wide), the endstops are known relative to each other
+            centering = np.eye(len(geometry_parameters))
+            centering[:3, :3] -= 1.0/3.0
+            covariance = centering @ covariance @ centering.T
+            print_confidence_interval(dict((param, zscore*np.sqrt(covariance[ii, ii])) for ii, param in enumerate(geometry_parameters)))
+        else:
+            set_M_values(port, new_geom['z'], new_geom['x'], new_geom['y'], new_geom['l'], new_geom['r'], new_angles)
+        tracer.end('pass {0}'.format(runs-1))
+
+        # Overlap mode: the next pass homes while this one is written down (see run_calibration)
+        queued = overlap is not None and not calibrated and runs < max_runs
+        if queued:
+            if bed_temp >= 0:
+                port.write('M140 S{0}'.format(str(bed_temp)))
+            port.write('G28')
+
+        record = (runs, geom['x'], geom['y'], geom['z'], geom['l'], geom['r'], iHighTower, table, pass_files)
+        fields = dict(points=len(table), uncertainty=uncertainty,
+                      contour=[float(v) for v in (TX, TY, TZ, THigh, BowlCenter, BowlOR)],
+                      errors=[float(v) for v in (z_error, x_error, y_error, c_error)],
+                      trial={'x':geom['x'], 'y':geom['y'], 'z':geom['z'], 'l':geom['l'], 'r':geom['r'], 'angles':[geom['ax'], geom['ay'], geom['az']]},
+                      new={'x':new_geom['x'], 'y':new_geom['y'], 'z':new_geom['z'], 'l':new_geom['l'], 'r':new_geom['r']}, calibrated=calibrated, bed_temp=bed_temp)
+        if overlap is not None:
+            overlap.submit(record_pass, *record, **fields).add_done_callback(report_failure)
+        else:
+            record_pass(*record, **fields)
+        if calibrated:
+            console.info("Calibration complete")
+            return calibrated, new_geom['z'], new_geom['x'], new_geom['y'], new_geom['l'], new_geom['r'], new_angles
+        geom = new_geom
+        prev_table = table
+    calibrated = calibration_failed("Too many calibration attempts", exit_on_failure)
+    return calibrated, geom['z'], geom['x'], geom['y'], geom['l'], geom['r'], [geom['ax'], geom['ay'], geom['az']]
+
+# Tower flag auto-detection (-tf -1)
+# The grid is probed, the X endstop is moved by a known amount and the grid is probed again.
+# Each tower mapping puts the X tower somewhere else, so the forward model predicts a different
+# tilt for each, the mapping whose prediction matches the observed change wins.
+tower_flag_trial = 0.5  # mm added to the X endstop for the trial pass
+
+def tower_flag_response(x_list, y_list, geom, trial_geom, tower_flag):
+    # Probe height change predicted for the trial adjustment under one tower mapping
+    before = delta_probe_heights(x_list, y_list, geom, geom, tower_flag)
+    after = delta_probe_heights(x_list, y_list, trial_geom, geom, tower_flag)
+    return after - before
+
+def detect_tower_flag(port, firmFlag, grid, trial_x, trial_y, trial_z, l_value, r_value, tower_angles, trial=tower_flag_trial):
+    geom = {'x':trial_x, 'y':trial_y, 'z':trial_z, 'r':r_value, 'l':l_value,
+            'ax':tower_angles[0], 'ay':tower_angles[1], 'az':tower_angles[2]}
+    trial_geom = dict(geom)
+    trial_geom['x'] += trial
+
+    console.info('\nDetecting tower setup, probing before and after moving the X endstop by {0}'.format(trial))
+    with tracer.span('detect tower flag'):
+        before = get_current_values(port, firmFlag, grid)
+        set_M_values(port, trial_geom['z'], trial_geom['x'], trial_geom['y'], l_value, r_value)
+        after = get_current_values(port, firmFlag, grid, travel_height(before))
+        set_M_values(port, trial_z, trial_x, trial_y, l_value, r_value)
+
+        # Both tables are referenced to their own median, only the shape of the change counts
+        observed = after['z_avg'] - before['z_avg']
+        observed = observed - np.mean(observed)
+
+        # Three small forward model evaluations, no reason to leave the process (or fork the
+        # connection's reader thread along with it)
+        with tracer.span('tower flag models', 'compute'):
+            predicted = [tower_flag_response(before['x'], before['y'], geom, trial_geom, flag) for flag in range(len(tower_base_angles))]
+
+    residuals = [np.sqrt(np.mean((observed - (p - np.mean(p)))**2)) for p in predicted]
+    for flag, residual in enumerate(residuals):
+        console.info('Tower flag {0}: rms misfit {1:.4f}'.format(flag, residual))
+    tower_flag = int(np.argmin(residuals))
+    ranked = sorted(residuals)
+    if ranked[1] < 2*ranked[0]:
+        console.warning('Warning: tower setup detection is ambiguous, consider setting -tf explicitly')
+    console.info('Using tower flag {0}\n'.format(tower_flag))
+    return tower_flag
+
+def set_M_values(port, z, x, y, l, r, tower_angles=None):
+
+    if tower_angles is None:
+        console.info("Setting values M666 X{0} Y{1} Z{2}, M665 L{3} R{4}".format(str(x),str(y),str(z),str(l),str(r)))
+    else:
+        console.info("Setting values M666 X{0} Y{1} Z{2}, M665 L{3} R{4} X{5} Y{6} Z{7}".format(str(x),str(y),str(z),str(l),str(r),str(tower_angles[0]),str(tower_angles[1]),str(tower_angles[2])))
+
+    # Only the values that differ from the printer's are sent
+    with tracer.span('push config'):
+        port.set_parameters('M666', X=x, Y=y, Z=z)
+        if tower_angles is None:
+            port.set_parameters('M665', L=l, R=r)
+        else:
+            port.set_parameters('M665', L=l, R=r, X=tower_angles[0], Y=tower_angles[1], Z=tower_angles[2])
+        port.wait_for_ok()
     
-def output_pass_text(runs, trial_x, trial_y, trial_z, l_value, r_value, iHighTower, x_list, y_list, z1_list, z2_list): 
+def output_pass_text(runs, trial_x, trial_y, trial_z, l_value, r_value, iHighTower, table): 
 
     # Get the pass number corresponding to Dennis's spreadsheet
     pass_num = int(runs-1)
@@ -681,63 +1321,190 @@ def output_pass_text(runs, trial_x, trial_y, trial_z, l_value, r_value, iHighTow
     file_object.write("\r\n") 
     file_object.write("\r\n") 
     file_object.write("< 01:02:03 PM: G29 Auto Bed Leveling\r\n") 
-    for ii in range(len(x_list)):
-        file_object.write("< 01:02:03 PM: Bed X: {0:.3f} Y: {1:.3f} Z: {2:.3f}\r\n".format(float(x_list[ii]), float(y_list[ii]), float(z1_list[ii]))) 
-        file_object.write("< 01:02:03 PM: Bed X: {0:.3f} Y: {1:.3f} Z: {2:.3f}\r\n".format(float(x_list[ii]), float(y_list[ii]), float(z2_list[ii]))) 
+    for row in table:
+        file_object.write("< 01:02:03 PM: Bed X: {0:.3f} Y: {1:.3f} Z: {2:.3f}\r\n".format(float(row['x']), float(row['y']), float(row['z1']))) 
+        file_object.write("< 01:02:03 PM: Bed X: {0:.3f} Y: {1:.3f} Z: {2:.3f}\r\n".format(float(row['x']), float(row['y']), float(row['z2']))) 
     
     # Close file stream
     file_object.close() 
     
     return
 
+# Session log records of a probe table, one list per column
+def probe_table_record(table):
+    return dict((name, table[name].tolist()) for name in table.dtype.names)
+
+def probe_table_from_record(columns):
+    table = np.zeros(len(columns['x']), dtype=probe_table_dtype)
+    for name in table.dtype.names:
+        table[name] = columns[name]
+    return table
+
+# Legacy auto_cal_p5_pass{N}.txt files (Dennis's spreadsheet input) from the last session of a session log
+def export_pass_files(log_file):
+    passes = [record for record in read_session(log_file) if record['kind'] == 'pass']
+    for record in passes:
+        trial = record['trial']
+        output_pass_text(record['runs'], trial['x'], trial['y'], trial['z'], trial['l'], trial['r'], record['iHighTower'], probe_table_from_record(record['table']))
+    return len(passes)
 
-def run_calibration(port, firmFlag, trial_x, trial_y, trial_z, l_value, r_value, xhigh, yhigh, zhigh, max_runs, max_error, bed_temp, minterp, tower_flag, runs=0):
+
+# Pass files and the session log record of a pass, on the overlap worker in overlap mode
+def record_pass(runs, trial_x, trial_y, trial_z, l_value, r_value, iHighTower, table, pass_files, **fields):
+    if pass_files:
+        output_pass_text(runs, trial_x, trial_y, trial_z, l_value, r_value, iHighTower, table)
+    session.record('pass', runs=runs, table=probe_table_record(table), iHighTower=int(iHighTower), **fields)
+    session.checkpoint()
+
+def report_failure(future):
+    if future.exception() is not None:
+        console.warning('Recording a pass failed: {0}'.format(future.exception()))
+
+# overlap: a single thread executor for overlap mode (None = everything in line). The next pass's
+# heating and homing are queued on the printer as soon as the new M666/M665 are, and the pass files
+# and session log record of this pass are written while the printer homes and probes. Only that
+# bookkeeping overlaps the printer, the new values are computed before the G28 that needs them.
+# queued: the previous pass already queued this pass's heating and homing
+# jacobian: the measured Jacobian of the -cm 2 mode (see measure_jacobian)
+# probed: a probe table of the trial values already taken, used instead of probing the first pass
+# A calibration that can't finish: exit, or (exit_on_failure False, a sweep carries on with the
+# next temperature) say so and hand back calibrated=False
+def calibration_failed(message, exit_on_failure):
+    if exit_on_failure:
+        # The console prints in the background, everything before the failure goes out first
+        console.flush()
+        sys.exit(message)
+    console.warning(message)
+    return False
+
+# exit_on_failure: False returns calibrated=False with the values on the printer instead of exiting
+# taps: double tap differences of the passes so far, the probe noise is estimated from all of them
+def run_calibration(port, firmFlag, grid, trial_x, trial_y, trial_z, l_value, r_value, xhigh, yhigh, zhigh, max_runs, max_error, bed_temp, minterp, tower_flag, cal_mode, tower_angles, stat_confidence, step_mm, runs=0, prev_table=None, pass_files=False, overlap=None, queued=False, jacobian=None, probed=None, exit_on_failure=True, taps=None):
     runs += 1
 
     if runs > max_runs:
-        sys.exit("Too many calibration attempts")
-    print('\nCalibration pass {1}, run {2} out of {0}'.format(str(max_runs), str(runs-1), str(runs)))
+        calibrated = calibration_failed("Too many calibration attempts", exit_on_failure)
+        return calibrated, trial_z, trial_x, trial_y, l_value, r_value, xhigh, yhigh, zhigh, tower_angles
+    console.info('\nCalibration pass {1}, run {2} out of {0}'.format(str(max_runs), str(runs-1), str(runs)))
+    # A pass probed beforehand (measure_jacobian) already has its pass span, this is only its analysis
+    pass_span = 'pass {0}'.format(runs-1) if probed is None else 'analysis {0}'.format(runs-1)
+    tracer.begin(pass_span)
     
     # Make sure the bed doesn't go cold
-    if bed_temp >= 0: 
-        port.write('M140 S{0}\n'.format(str(bed_temp)).encode())
+    if bed_temp >= 0 and not queued: 
+        with tracer.span('heat'):
+            port.write('M140 S{0}'.format(str(bed_temp)))
     
     # Read G30 values and calculate values in columns B through H
-    x_list, y_list, z1_list, z2_list, z_avg_list, dtap_list, dz_list = get_current_values(port, firmFlag)
+    if probed is not None:
+        table = probed
+    else:
+        table = get_current_values(port, firmFlag, grid, travel_height(prev_table), home=not queued)
     
     # Generate the P5 contour map
-    TX, TY, TZ, THigh, BowlCenter, BowlOR, xhigh, yhigh, zhigh, iHighTower = calculate_contour(x_list, y_list, dz_list, runs, xhigh, yhigh, zhigh, minterp, tower_flag)
-    
-    # Output current pass results
-    output_pass_text(runs, trial_x, trial_y, trial_z, l_value, r_value, iHighTower, x_list, y_list, z1_list, z2_list)
+    with tracer.span('contour', 'compute'):
+        TX, TY, TZ, THigh, BowlCenter, BowlOR, xhigh, yhigh, zhigh, iHighTower = calculate_contour(table, runs, xhigh, yhigh, zhigh, minterp, tower_flag)
     
     # Output Debugging Info
     #file_object  = open("debug_pass{0:d}.csv".format(int(runs-1)), "w")
     #file_object.write("X,Y,Z1,Z2,Z avg,Tap diff,Z diff,TX,TY,TZ,THigh,BowlCenter,BowlOR\r\n") 
-    #z_med = statistics.median(z_avg_list)
-    #for ii in range(len(x_list)):
-    #    dz_list[ii] = z_avg_list[ii] - z_med
-    #    file_object.write("{0:.4f},{1:.4f},{2:.4f},{3:.4f},".format(float(x_list[ii]),float(y_list[ii]),float(z1_list[ii]),float(z2_list[ii])))
-    #    file_object.write("{0:.4f},{1:.4f},{2:.4f},".format(float(z_avg_list[ii]),float(dtap_list[ii]),float(dz_list[ii])))
+    #for row in table:
+    #    file_object.write("{0:.4f},{1:.4f},{2:.4f},{3:.4f},".format(float(row['x']),float(row['y']),float(row['z1']),float(row['z2'])))
+    #    file_object.write("{0:.4f},{1:.4f},{2:.4f},".format(float(row['z_avg']),float(row['dtap']),float(row['dz'])))
     #    file_object.write("{0:.4f},{1:.4f},{2:.4f},{3:.4f},{4:.4f},{5:.4f}\r\n".format(float(TX),float(TY),float(TZ),float(THigh),float(BowlCenter),float(BowlOR)))
     #file_object.close() 
     
     # Calculate Error
-    z_error, x_error, y_error, c_error = determine_error(TX, TY, TZ, THigh, BowlCenter, BowlOR)
+    with tracer.span('error', 'compute'):
+        z_error, x_error, y_error, c_error = determine_error(TX, TY, TZ, THigh, BowlCenter, BowlOR)
     
     if abs(max([z_error, x_error, y_error, c_error], key=abs)) > max_error and runs > 1:
-        sys.exit("Calibration error on non-first run exceeds set limit")
+        tracer.end(pass_span)
+        calibrated = calibration_failed("Calibration error on non-first run exceeds set limit", exit_on_failure)
+        return calibrated, trial_z, trial_x, trial_y, l_value, r_value, xhigh, yhigh, zhigh, tower_angles
+
+    # Statistical stopping rule, thresholds come from the double tap noise instead of a fixed 0.02
+    sigma_avg = None
+    zscore = None
+    std_errors = None
+    thresholds = (0.02, 0.02, 0.02, 0.02)
+    if stat_confidence > 0:
+        # Averaging the two taps halves the variance of a single tap. The noise doesn't change between
+        # passes, so it comes from the taps of every pass so far, Student's t for that many differences.
+        taps = list(taps or []) + table['dtap'].tolist()
+        sigma_avg = estimate_tap_noise(taps)/np.sqrt(2.0)
+        zscore = confidence_zscore(stat_confidence, len(taps))
+        console.info('Probe noise: {0:.4f} per averaged point, z-score {1:.3f}'.format(sigma_avg, zscore))
+        if cal_mode == 0:
+            with tracer.span('standard errors', 'compute'):
+                std_errors = error_standard_errors(table, runs, xhigh, yhigh, zhigh, minterp, tower_flag, sigma_avg)
+            # Nothing smaller than a single motor step can be corrected anyway
+            thresholds = [max(zscore*se, 1.0/step_mm) for se in std_errors]
+            console.info('Error thresholds: Z {0:.4f} X {1:.4f} Y {2:.4f} C {3:.4f}\n'.format(thresholds[0], thresholds[1], thresholds[2], thresholds[3]))
+
+    if cal_mode == 1:
+        calibrated, new_z, new_x, new_y, new_l, new_r, tower_angles = calibrate_geometry(port, table, trial_x, trial_y, trial_z, l_value, r_value, tower_angles, tower_flag, sigma_avg, zscore, 1.0/step_mm)
+    elif cal_mode == 2:
+        calibrated, new_z, new_x, new_y, new_l, new_r = calibrate_jacobian(port, table, jacobian, trial_x, trial_y, trial_z, l_value, r_value, sigma_avg, zscore, 1.0/step_mm, prev_table)
+    else:
+        calibrated, new_z, new_x, new_y, new_l, new_r = calibrate(port, z_error, x_error, y_error, c_error, trial_x, trial_y, trial_z, l_value, r_value, iHighTower, max_runs, runs, thresholds, std_errors, zscore)
+    tracer.end(pass_span)
+
+    # Overlap mode: the printer starts on the next pass right away. The endstop adjustments only
+    # take effect on homing, so the G28 has to come after the new M666, it can't be sent any earlier.
+    next_queued = overlap is not None and not calibrated and runs < max_runs
+    if next_queued:
+        if bed_temp >= 0:
+            port.write('M140 S{0}'.format(str(bed_temp)))
+        port.write('G28')
 
-    calibrated, new_z, new_x, new_y, new_l, new_r = calibrate(port, z_error, x_error, y_error, c_error, trial_x, trial_y, trial_z, l_value, r_value, iHighTower, max_runs, runs)
+    record = (runs, trial_x, trial_y, trial_z, l_value, r_value, iHighTower, table, pass_files)
+    fields = dict(contour=[float(v) for v in (TX, TY, TZ, THigh, BowlCenter, BowlOR)],
+                  errors=[float(v) for v in (z_error, x_error, y_error, c_error)], thresholds=[float(v) for v in thresholds],
+                  trial={'x':trial_x, 'y':trial_y, 'z':trial_z, 'l':l_value, 'r':r_value, 'angles':list(tower_angles)},
+                  new={'x':new_x, 'y':new_y, 'z':new_z, 'l':new_l, 'r':new_r}, calibrated=calibrated, bed_temp=bed_temp)
+    if overlap is not None:
+        overlap.submit(record_pass, *record, **fields).add_done_callback(report_failure)
+    else:
+        record_pass(*record, **fields)
     
     if calibrated:
-        print ("Calibration complete")
+        console.info("Calibration complete")
     else:
-        calibrated, new_z, new_x, new_y, new_l, new_r, xhigh, yhigh, zhigh = run_calibration(port, firmFlag, new_x, new_y, new_z, new_l, new_r, xhigh, yhigh, zhigh, max_runs, max_error, bed_temp, minterp, tower_flag, runs)
+        calibrated, new_z, new_x, new_y, new_l, new_r, xhigh, yhigh, zhigh, tower_angles = run_calibration(port, firmFlag, grid, new_x, new_y, new_z, new_l, new_r, xhigh, yhigh, zhigh, max_runs, max_error, bed_temp, minterp, tower_flag, cal_mode, tower_angles, stat_confidence, step_mm, runs, table, pass_files, overlap, next_queued, jacobian, exit_on_failure=exit_on_failure, taps=taps)
+
+    return calibrated, new_z, new_x, new_y, new_l, new_r, xhigh, yhigh, zhigh, tower_angles
+
+# Bring the bed to temperature and wait there (R also waits for cooling down, Marlin only)
+def heat_bed(port, firmFlag, bed_temp, soak=0):
+    console.info('Waiting for the bed to reach {0} C'.format(bed_temp))
+    with tracer.span('heat', temperature=bed_temp):
+        port.write('M190 {0}{1}'.format('R' if firmFlag == 1 else 'S', bed_temp))
+        port.wait_for_ok(deadline_in(heat_timeout))
+        if soak > 0:
+            # Let the bed plate settle at the new temperature
+            console.info('Soaking for {0} s'.format(soak))
+            port.write('G4 S{0}'.format(soak))
+            port.wait_for_ok(deadline_in(soak + home_timeout))
+
+def sweep_entry(bed_temp, calibrated, x, y, z, l, r, tower_angles):
+    return {'bed_temp': bed_temp, 'calibrated': calibrated, 'x': x, 'y': y, 'z': z, 'l': l, 'r': r, 'angles': list(tower_angles),
+            'M666': 'M666 X{0} Y{1} Z{2}'.format(x, y, z),
+            'M665': 'M665 L{0} R{1} X{2} Y{3} Z{4}'.format(l, r, tower_angles[0], tower_angles[1], tower_angles[2])}
 
-    return calibrated, new_z, new_x, new_y, new_l, new_r, xhigh, yhigh, zhigh
+# Temperature -> M666/M665 table of a sweep, rewritten after every temperature so a failed sweep keeps what it found
+def write_sweep_table(filename, sweep):
+    with open(filename, 'w') as sweep_file:
+        json.dump({'sweep': sweep}, sweep_file, indent=2)
 
-def main():
+def print_sweep_table(sweep):
+    console.info('\nBed temperature sweep')
+    for entry in sweep:
+        console.info('{0:>5} C  {1:<36} {2}{3}'.format(entry['bed_temp'], entry['M666'], entry['M665'], '' if entry['calibrated'] else '  (not calibrated)'))
+
+# argv: the command line arguments (default sys.argv)
+# connection: an open PrinterConnection to use instead of opening the port, it's left open
+def main(argv=None, connection=None):
     # Default values
     max_runs = 14
     max_error = 1
@@ -758,9 +1525,13 @@ def main():
     minterp = 0
     firmFlag = 0
     tower_flag = 0
+    cal_mode = 0
+    tower_angles = [0.0]*3
+    stat_confidence = 0.0
+    grid_name = 'P5'
 
     parser = argparse.ArgumentParser(description='Auto-Bed Cal. for Monoprice Mini Delta')
-    parser.add_argument('-p','--port',help='Serial port',required=True)
+    parser.add_argument('-p','--port',help='Serial port, or socket://host:port / rfc2217://host:port for a network serial bridge (not needed for a dry run)')
     parser.add_argument('-x','--x0',type=float,default=x0,help='Starting x-value')
     parser.add_argument('-y','--y0',type=float,default=y0,help='Starting y-value')
     parser.add_argument('-z','--z0',type=float,default=z0,help='Starting z-value')
@@ -770,20 +1541,79 @@ def main():
     parser.add_argument('-me','--max-error',type=float,default=max_error,help='Maximum acceptable calibration error on non-first run')
     parser.add_argument('-mr','--max-runs',type=int,default=max_runs,help='Maximum attempts to calibrate printer')
     parser.add_argument('-bt','--bed-temp',type=int,default=bed_temp,help='Bed Temperature')
-    parser.add_argument('-im','--minterp',type=int,default=minterp,help='Intepolation Method')
+    parser.add_argument('-sw','--sweep',type=int,nargs='+',default=None,help='Calibrate at each of these bed temperatures in one session (e.g. 60 70 80), each one starting from the values of the one before')
+    parser.add_argument('-sk','--soak',type=int,default=0,help='Seconds to wait after the bed reached a sweep temperature')
+    parser.add_argument('--sweep-file',type=str,default='auto_cal_p5_sweep.json',help='Temperature to M666/M665 table written by a sweep')
+    parser.add_argument('-im','--minterp',type=int,default=minterp,help='Intepolation Method (0 = scipy griddata; 1 = Dennis\'s Spreadsheet; 2 = Zernike surface fit)')
     parser.add_argument('-ff','--firmFlag',type=int,default=firmFlag,help='Firmware Flag (0 = Stock; 1 = Marlin)')
-    parser.add_argument('-tf','--tower_flag',type=int,default=tower_flag,help='Tower Flag (0 = Stock and old Marlin; 1 = Marlin 1.3.3, 2 = experimental)')
+    parser.add_argument('-tf','--tower_flag',type=int,default=tower_flag,help='Tower Flag (0 = Stock and old Marlin; 1 = Marlin 1.3.3, 2 = experimental, -1 = detect from a trial pass)')
+    parser.add_argument('-cm','--cal-mode',type=int,default=cal_mode,help='Calibration Mode (0 = Dennis\'s Spreadsheet; 1 = Geometry fit of endstops, radius, rod length and tower angles; 2 = Measured Jacobian, one extra pass per parameter the first time)')
+    parser.add_argument('-ap','--active-probing',type=int,default=0,help='Probe the grid points one at a time, most informative first, until the geometry fit is certain enough (Marlin only; 0 = off; 1 = on)')
+    parser.add_argument('--jacobian-file',type=str,default=jacobian_file,help='Cache of the Jacobians measured by -cm 2')
+    parser.add_argument('--jacobian-key',type=str,default=None,help='Name of this printer in the Jacobian cache (default: the port, use a /dev/serial/by-id name to keep it stable)')
+    parser.add_argument('--jacobian-refresh',type=int,default=0,help='Measure the Jacobian again even if it is cached (0 = off; 1 = on)')
+    parser.add_argument('-ta','--tower-angles',type=float,nargs=3,default=tower_angles,help='Starting M665 X/Y/Z tower angle corrections')
+    parser.add_argument('-g','--grid',type=str,default=grid_name,help='Probe grid (P2 = towers and center, P3-P6 or any Pn, hex<spacing>, radial<rings>, or a json file of [X, Y] points; stock firmware only supports P5 and P2)')
+    parser.add_argument('-sc','--stat-confidence',type=float,default=stat_confidence,help='Stop when corrections are within this confidence level (e.g. 0.95) of the probe noise instead of the fixed 0.02 (0 = off)')
+    parser.add_argument('-br','--baud-rates',type=int,nargs='+',default=[115200],help='Baudrate, or several to use the fastest one the printer answers at (e.g. 250000 115200)')
+    parser.add_argument('-pl','--pipeline',type=int,default=4,help='Commands sent ahead of the printer\'s acknowledgements, hides the round trip of network serial bridges (1 = lockstep; 4 = Marlin\'s default command buffer)')
+    parser.add_argument('-rt','--reliable-transport',type=int,default=0,help='Send line numbers and checksums and resend lines the printer rejects (0 = off; 1 = on)')
+    parser.add_argument('-dr','--dry-run',type=int,default=0,help='Run against a simulated printer and print the predicted time per phase, without opening the serial port (0 = off; 1 = on)')
+    parser.add_argument('-lg','--log',type=str,default='auto_cal_p5_session.jsonl',help='Session log, every command, response and pass is appended to it as JSON lines (empty = off; dry runs only read it, for the command round trip)')
+    parser.add_argument('--log-fsync',type=str,default='pass',choices=fsync_policies,help='When to force the session log to disk (never; pass = after every pass; always = after every record)')
+    parser.add_argument('--archive',type=str,default=None,help='Also add every pass to this probe archive directory (see mpmd_archive.py)')
+    parser.add_argument('--printer-name',type=str,default=None,help='Name of this printer in the probe archive and the Jacobian cache (default: the port)')
+    parser.add_argument('-ov','--overlap',type=int,default=0,help='Start homing for the next pass as soon as the new values are sent and write the pass files and log in the background, the new values are still computed first (0 = off; 1 = on)')
+    parser.add_argument('-pf','--pass-files',type=int,default=0,help='Also write the legacy auto_cal_p5_pass<N>.txt files while calibrating (0 = off; 1 = on)')
+    parser.add_argument('--export-passes',type=str,default=None,help='Write the legacy auto_cal_p5_pass<N>.txt files for the last session in this session log and exit')
+    parser.add_argument('--console-level',type=str,default='info',choices=['debug', 'info', 'warning'],help='Console verbosity')
+    parser.add_argument('--console-rate',type=float,default=50,help='Maximum console lines per second below warning level, the rest are counted as suppressed (0 = unlimited)')
+    parser.add_argument('--trace',type=str,default=None,help='Write a timeline of every phase and pass to this file (Chrome trace format, open in chrome://tracing or ui.perfetto.dev)')
+    parser.add_argument('--profile',type=str,default=None,help='Profile the host computation (not the time waiting on the printer) and write <prefix>.prof and <prefix>.folded (flame graph stacks)')
     parser.add_argument('-f','--file',type=str,dest='file',default=None,
         help='File with settings, will be updated with latest settings at the end of the run')
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+    console.configure(args.console_level, args.console_rate)
+
+    if args.export_passes:
+        console.info('Wrote {0} pass files from {1}'.format(export_pass_files(args.export_passes), args.export_passes))
+        return
+
+    if args.port is None and args.dry_run != 1 and connection is None:
+        parser.error('the following arguments are required: -p/--port')
 
-    port = establish_serial_connection(args.port)        
+    # A dry run has nothing of the printer to log, it only reads the log for the round trip
+    if args.log and args.dry_run != 1:
+        session.open(args.log, args.log_fsync)
+        session.record('session', script='auto_cal_p5.py', args=vars(args))
+
+    # A dry run keeps the timeline on the simulated printer clock, the time budget is read from it
+    simulated_port = None
+    if args.dry_run == 1:
+        simulated_port = SimulatedPort(dry_run_model(args.log), g29_grids={2: probe_grids['P2'], 5: probe_grids['P5']})
+        tracer.enable(clock=simulated_port.clock)
+    elif args.trace:
+        tracer.enable()
+    if args.profile:
+        tracer.profiler = HostProfiler()
+    tracer.begin('session')
+    with tracer.span('connect'):
+        if simulated_port is not None:
+            port = PrinterConnection(simulated_port, reliable=args.reliable_transport == 1, on_line=session.received, on_write=session.sent, window=args.pipeline)
+        elif connection is not None:
+            port = connection
+        else:
+            port = establish_serial_connection(args.port, speeds=args.baud_rates, reliable=args.reliable_transport == 1, window=args.pipeline)
 
     if args.file:
         try:
             with open(args.file) as data_file:
                 settings = json.load(data_file)
             tower_flag = int(settings.get('tower_flag', tower_flag))
+            cal_mode = int(settings.get('cal_mode', cal_mode))
+            stat_confidence = float(settings.get('stat_confidence', stat_confidence))
+            grid_name = str(settings.get('grid', grid_name))
+            tower_angles = [float(settings.get('ax', tower_angles[0])), float(settings.get('ay', tower_angles[1])), float(settings.get('az', tower_angles[2]))]
             firmFlag = int(settings.get('firmFlag', firmFlag))
             minterp = int(settings.get('minterp', minterp))
             bed_temp = int(settings.get('bed_temp', bed_temp))
@@ -798,6 +1628,10 @@ def main():
 
         except:
             tower_flag = args.tower_flag
+            cal_mode = args.cal_mode
+            stat_confidence = args.stat_confidence
+            grid_name = args.grid
+            tower_angles = args.tower_angles
             firmFlag = args.firmFlag
             minterp = args.minterp
             bed_temp = args.bed_temp
@@ -813,6 +1647,10 @@ def main():
             pass
     else: 
         tower_flag = args.tower_flag
+        cal_mode = args.cal_mode
+        stat_confidence = args.stat_confidence
+        grid_name = args.grid
+        tower_angles = args.tower_angles
         firmFlag = args.firmFlag
         minterp = args.minterp
         bed_temp = args.bed_temp
@@ -825,69 +1663,196 @@ def main():
         step_mm = args.step_mm
         max_runs = args.max_runs
         l_value = args.l_value
+
+    # Sweep from the lowest temperature up, heating is much quicker than cooling down
+    sweep_temps = sorted(args.sweep) if args.sweep else None
+    if sweep_temps:
+        bed_temp = sweep_temps[0]
         
     if port:
     
         # Firmware
         if firmFlag == 0:
-            print("Using Monoprice Firmware\n")
+            console.info("Using Monoprice Firmware\n")
         elif firmFlag == 1:
-            print("Using Marlin Firmware\n")
+            console.info("Using Marlin Firmware\n")
             
         # Tower Setup
         if tower_flag == 0:
-            print("Stock Tower Setup (X opposite of LCD)\n")
+            console.info("Stock Tower Setup (X opposite of LCD)\n")
         elif tower_flag == 1:
-            print("Altered Tower Setup (Y opposite of LCD)\n")
+            console.info("Altered Tower Setup (Y opposite of LCD)\n")
         elif tower_flag == 2:
-            print("Experimental Tower Setup (Z opposite of LCD)\n")
+            console.info("Experimental Tower Setup (Z opposite of LCD)\n")
+        else:
+            console.info("Tower Setup detected on the first pass\n")
     
         #Set Bed Temperature
         if bed_temp >= 0:
-            print ('Setting bed temperature to {0} C\n'.format(str(bed_temp)))
-            port.write('M140 S{0}\n'.format(str(bed_temp)).encode())
-            out = port.readline().decode()
+            console.info('Setting bed temperature to {0} C\n'.format(str(bed_temp)))
+            with tracer.span('heat'):
+                port.write('M140 S{0}'.format(str(bed_temp)))
+                port.wait_for_ok()
             
+        # Probe grid, the stock firmware can only report the G29 P5 and P2 grids
+        grid = get_grid(grid_name)
+        if firmFlag == 0 and grid != probe_grids['P5'] and grid != probe_grids['P2']:
+            sys.exit("Stock firmware only supports the P5 and P2 grids")
+        console.info("Probe Grid: {0} ({1} points)\n".format(grid_name, len(grid)))
+
+        # Dennis's spreadsheet samples the whole grid, active probing only takes part of it
+        if minterp == 1 and args.active_probing == 1:
+            console.info("Dennis's Spreadsheet interpolation needs the whole grid, using griddata instead\n")
+            minterp = 0
+
         # Display interpolation methods
         if minterp == 1: 
-            print("Interpolation Method: Dennis's Spreadsheet\n")
+            console.info("Interpolation Method: Dennis's Spreadsheet\n")
+        elif minterp == 2:
+            console.info("Interpolation Method: Zernike surface fit\n")
+        else:
+            console.info("Interpolation Method: python3 scipy.interpolate.griddata\n")
+
+        if args.active_probing == 1 and firmFlag != 1:
+            sys.exit("Active probing needs Marlin, the stock firmware only probes whole G29 grids")
+
+        # Display calibration mode
+        if args.active_probing == 1:
+            console.info("Calibration Mode: Geometry fit with active probing\n")
+        elif cal_mode == 1:
+            console.info("Calibration Mode: Geometry fit (endstops, radius, rod length, tower angles)\n")
+        elif cal_mode == 2:
+            console.info("Calibration Mode: Measured Jacobian\n")
         else:
-            print("Interpolation Method: python3 scipy.interpolate.griddata\n")
+            console.info("Calibration Mode: Dennis's Spreadsheet\n")
     
+        # Current printer settings, from here on only changed values get sent
+        tracer.begin('setup')
+        port.read_state()
+
         # Set the proper step/mm
-        print ('Setting up M92 X{0} Y{0} Z{0}\n'.format(str(step_mm)))
-        port.write(('M92 X{0} Y{0} Z{0}\n'.format(str(step_mm))).encode())
-        out = port.readline().decode()
+        console.info('Setting up M92 X{0} Y{0} Z{0}\n'.format(str(step_mm)))
+        port.set_parameters('M92', X=step_mm, Y=step_mm, Z=step_mm)
+        port.wait_for_ok()
         
-        print ('Setting up M665 L{0} R{1}\n'.format(str(l_value),str(r_value)))
-        port.write(('M665 L{0}\n'.format(str(l_value))).encode())
-        out = port.readline().decode()
+        console.info('Setting up M665 L{0} R{1}\n'.format(str(l_value),str(r_value)))
+        port.set_parameters('M665', L=l_value)
+        port.wait_for_ok()
 
         if firmFlag == 1:
-            print ('Setting up M206 X0 Y0 Z0\n')
-            port.write('M206 X0 Y0 Z0\n'.encode())
-            out = port.readline().decode()
+            console.info('Setting up M206 X0 Y0 Z0\n')
+            port.set_parameters('M206', X=0, Y=0, Z=0)
+            port.wait_for_ok()
         
-            print ('Clearing mesh with M421 C\n')
-            port.write('M421 C\n'.encode())
-            out = port.readline().decode()
+            console.info('Clearing mesh with M421 C\n')
+            port.write('M421 C')
+            port.wait_for_ok()
 
-        set_M_values(port, trial_z, trial_x, trial_y, l_value, r_value)
+        if cal_mode == 1 or args.active_probing == 1:
+            set_M_values(port, trial_z, trial_x, trial_y, l_value, r_value, tower_angles)
+        else:
+            set_M_values(port, trial_z, trial_x, trial_y, l_value, r_value)
+        tracer.end('setup')
 
-        print ('\nStarting calibration')
+        if tower_flag < 0:
+            tower_flag = detect_tower_flag(port, firmFlag, grid, trial_x, trial_y, trial_z, l_value, r_value, tower_angles)
 
-        calibrated, new_z, new_x, new_y, new_l, new_r, xhigh, yhigh, zhigh = run_calibration(port, firmFlag, trial_x, trial_y, trial_z, l_value, r_value, xhigh, yhigh, zhigh, max_runs, args.max_error, bed_temp, minterp, tower_flag)
+        jacobian = None
+        probed = None
+        if cal_mode == 2:
+            jacobian_key = args.jacobian_key or args.printer_name or args.port or 'dry run'
+            jacobian = load_jacobian(args.jacobian_file, jacobian_key, grid, tower_flag) if args.jacobian_refresh != 1 else None
+            if jacobian is not None:
+                console.info('Using the Jacobian of {0} measured {1}'.format(jacobian_key, jacobian['measured']))
+            else:
+                jacobian, probed = measure_jacobian(port, firmFlag, grid, trial_x, trial_y, trial_z, l_value, r_value, tower_flag)
+                if sweep_temps:
+                    # Probed before the bed got to the first sweep temperature
+                    probed = None
+                dead = jacobian_dead_parameters(jacobian)
+                if dead:
+                    console.warning('Warning: moving {0} did not change the probed heights, the Jacobian is not cached'.format(', '.join(dead)))
+                else:
+                    save_jacobian(args.jacobian_file, jacobian_key, jacobian)
+                session.record('jacobian', key=jacobian_key, parameters=jacobian['parameters'], jacobian=jacobian['jacobian'].tolist())
+
+        console.info('\nStarting calibration')
 
-        port.close()
+        overlap = concurrent.futures.ThreadPoolExecutor(max_workers=1) if args.overlap == 1 else None
+        sweep = []
+        archive_pass = None
+        if args.archive and simulated_port is None:
+            archive_pass = ProbeArchive(args.archive).listener(args.printer_name or args.port)
+            session.listeners.append(archive_pass)
+        try:
+            for ii, bed_temp in enumerate(sweep_temps or [bed_temp]):
+                if sweep_temps:
+                    heat_bed(port, firmFlag, bed_temp, args.soak)
+                    console.info('\nCalibrating at {0} C'.format(bed_temp))
+                    # The tower history of the previous temperature doesn't carry over
+                    xhigh = [0]*2
+                    yhigh = [0]*2
+                    zhigh = [0]*2
+                if args.active_probing == 1:
+                    calibrated, new_z, new_x, new_y, new_l, new_r, tower_angles = run_active_calibration(port, grid, trial_x, trial_y, trial_z, l_value, r_value, tower_angles, tower_flag, max_runs, args.max_error, bed_temp, minterp, stat_confidence, step_mm, pass_files=args.pass_files == 1, overlap=overlap, exit_on_failure=not sweep_temps)
+                else:
+                    calibrated, new_z, new_x, new_y, new_l, new_r, xhigh, yhigh, zhigh, tower_angles = run_calibration(port, firmFlag, grid, trial_x, trial_y, trial_z, l_value, r_value, xhigh, yhigh, zhigh, max_runs, args.max_error, bed_temp, minterp, tower_flag, cal_mode, tower_angles, stat_confidence, step_mm, pass_files=args.pass_files == 1, overlap=overlap, jacobian=jacobian, probed=probed, exit_on_failure=not sweep_temps)
+                probed = None
+                if sweep_temps and ii + 1 < len(sweep_temps):
+                    # The bed heats up for the next temperature while this one is written down
+                    port.write('M140 S{0}'.format(sweep_temps[ii + 1]))
+                if overlap is not None:
+                    # The pass records go before the result
+                    overlap.submit(lambda: None).result()
+                session.record('result', calibrated=calibrated, x=new_x, y=new_y, z=new_z, l=new_l, r=new_r, angles=list(tower_angles), tower_flag=tower_flag, bed_temp=bed_temp)
+                if sweep_temps:
+                    sweep.append(sweep_entry(bed_temp, calibrated, new_x, new_y, new_z, new_l, new_r, tower_angles))
+                    write_sweep_table(args.sweep_file, sweep)
+                    # Warm start for the next temperature, after a failed one from what it left on the printer
+                    trial_x, trial_y, trial_z, l_value, r_value = new_x, new_y, new_z, new_l, new_r
+            if sweep_temps:
+                print_sweep_table(sweep)
+                console.info('Wrote the sweep table to {0}'.format(args.sweep_file))
+                failed = [str(entry['bed_temp']) for entry in sweep if not entry['calibrated']]
+                if failed:
+                    console.warning('Not calibrated at {0} C'.format(', '.join(failed)))
+        except Timeout as e:
+            sys.exit("Printer stopped answering: {0}".format(e))
+        finally:
+            if overlap is not None:
+                overlap.shutdown(wait=True)
+            if archive_pass is not None:
+                session.listeners.remove(archive_pass)
+            session.close()
+            # Keep the timeline of failed runs too, those are the interesting ones
+            tracer.end('session')
+            if simulated_port is not None:
+                print_time_budget(tracer, simulated_port, max_runs)
+            if args.trace:
+                tracer.save(args.trace)
+                console.info('Wrote trace to {0}'.format(args.trace))
+            if args.profile:
+                console.flush()
+                tracer.profiler.print_stats()
+                tracer.profiler.save(args.profile)
+                console.info('Wrote profile to {0}.prof and {0}.folded'.format(args.profile))
+
+        if port is not connection:
+            port.close()
 
         if calibrated:
             if firmFlag == 1:
-                print ('Run mesh bed leveling before printing: G29\n')
-            if args.file:
-                data = {'z':new_z, 'x':new_x, 'y':new_y, 'r':new_r, 'l': new_l, 'step':step_mm, 'max_runs':max_runs, 'max_error':max_error, 'bed_temp':bed_temp}
+                console.info('Run mesh bed leveling before printing: G29\n')
+            if args.file and simulated_port is None:
+                data = {'z':new_z, 'x':new_x, 'y':new_y, 'r':new_r, 'l': new_l, 'step':step_mm, 'max_runs':max_runs, 'max_error':max_error, 'bed_temp':bed_temp,
+                        'tower_flag':tower_flag, 'cal_mode':cal_mode, 'stat_confidence':stat_confidence, 'grid':grid_name, 'ax':tower_angles[0], 'ay':tower_angles[1], 'az':tower_angles[2]}
                 with open(args.file, "w") as text_file:
                     text_file.write(json.dumps(data))
 
 
 if __name__ == '__main__':
-    main()
+    try:
+        main()
+    finally:
+        # Before the exit message (sys.exit) or traceback
+        console.flush()
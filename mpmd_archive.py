@@ -0,0 +1,274 @@
+#!/usr/bin/python
+
+# Probe archive for a fleet of printers
+#
+# Every calibration pass of every printer, in a directory of append-only fixed-width binary files
+# that NumPy can memory-map, so fleet analytics (drift over time, bowl trends per printer) scan
+# millions of probe points without parsing a line of text:
+#
+#   x.f32 y.f32 z1.f32 z2.f32 z_avg.f32 dz.f32
+#                one float32 file per probe point column (point_columns), the same row in each
+#                is the same point, passes follow each other. A scan of one column only reads
+#                that column's file.
+#   passes.idx   one record per pass (pass_dtype): where its points are (first row, count, the
+#                same in every column), when, which printer, the trial and new M666/M665 values,
+#                NaN where a script doesn't have a value
+#   printers.json  printer names, the 'printer' column is an index into it
+#   archive.json   format version and the layouts
+#
+# The points of a pass go in before its index record, a pass interrupted half way leaves points
+# no index record points at, which cost nothing (columns cut off at different rows are brought
+# back to the same length before the next pass goes in). One process writes to an archive at a time.
+#
+# auto_cal_p5.py and auto_cal.py add their passes with --archive, older session logs and
+# auto_cal_p5_pass<N>.txt files can be imported:
+#
+# python3 mpmd_archive.py fleet --import-log auto_cal_p5_session.jsonl --printer mpmd-1
+# python3 mpmd_archive.py fleet --import-pass-files auto_cal_p5_pass*.txt --printer mpmd-1
+# python3 mpmd_archive.py fleet
+#
+# archive = ProbeArchive('fleet')
+# passes = archive.passes()                      # memmap, pass_dtype
+# points = archive.points(['dz'])                # {'dz': memmap}, only the columns asked for
+# bowl = [points['dz'][p['first']:p['first'] + p['count']] for p in passes[passes['printer'] == 0]]
+
+import argparse
+import json
+import time
+import os
+import re
+import numpy as np
+from mpmd_log import console, read_session
+from mpmd_dryrun import g29_p2_points
+
+version = 2
+
+point_columns = ['x', 'y', 'z1', 'z2', 'z_avg', 'dz']
+point_type = np.dtype('<f4')
+
+geometry_columns = ['x', 'y', 'z', 'l', 'r', 'ax', 'ay', 'az']
+pass_dtype = np.dtype([('time', '<f8'), ('first', '<i8'), ('count', '<i4'), ('printer', '<i4'), ('run', '<i4'),
+                       ('calibrated', '<i4'), ('bed_temp', '<f4')] +
+                      [('trial_' + key, '<f4') for key in geometry_columns] + [('new_' + key, '<f4') for key in geometry_columns])
+
+
+def _geometry(values):
+    # {'x': .., 'angles': [..]} as the scripts record it, missing values become NaN
+    values = values or {}
+    angles = values.get('angles') or [None]*3
+    geometry = dict((key, values.get(key)) for key in geometry_columns[:5])
+    geometry.update(ax=angles[0], ay=angles[1], az=angles[2])
+    return dict((key, np.nan if value is None else float(value)) for key, value in geometry.items())
+
+
+class ProbeArchive(object):
+
+    def __init__(self, path):
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        manifest = os.path.join(path, 'archive.json')
+        if os.path.exists(manifest):
+            with open(manifest) as manifest_file:
+                layout = json.load(manifest_file)
+            if layout['version'] != version:
+                raise ValueError('{0} is a version {1} archive, this is version {2}'.format(path, layout['version'], version))
+        else:
+            with open(manifest, 'w') as manifest_file:
+                json.dump({'version': version, 'points': dict((name, point_type.str) for name in point_columns),
+                           'passes': pass_dtype.descr}, manifest_file, indent=2)
+        self.printer_names = self._load_printers()
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    def _load_printers(self):
+        try:
+            with open(self._file('printers.json')) as printers_file:
+                return json.load(printers_file)
+        except (IOError, OSError, ValueError):
+            return []
+
+    def printer_id(self, name):
+        if name not in self.printer_names:
+            self.printer_names.append(name)
+            with open(self._file('printers.json'), 'w') as printers_file:
+                json.dump(self.printer_names, printers_file, indent=2)
+        return self.printer_names.index(name)
+
+    def _column_file(self, name):
+        return self._file(name + '.f32')
+
+    # Whole records in a file, a record cut off by a crash is dropped before appending (trim)
+    def _records(self, filename, dtype, trim=False, keep=None):
+        size = os.path.getsize(filename) if os.path.exists(filename) else 0
+        count = size // dtype.itemsize if keep is None else min(keep, size // dtype.itemsize)
+        if trim and size != count*dtype.itemsize:
+            with open(filename, 'r+b') as records_file:
+                records_file.truncate(count*dtype.itemsize)
+        return count
+
+    # Rows every point column has, a pass cut off half way can leave some columns longer
+    def _point_rows(self, trim=False):
+        rows = min(self._records(self._column_file(name), point_type) for name in point_columns)
+        if trim:
+            for name in point_columns:
+                self._records(self._column_file(name), point_type, trim=True, keep=rows)
+        return rows
+
+    def _map(self, filename, dtype, count):
+        if count == 0:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(filename, dtype=dtype, mode='r', shape=(count,))
+
+    # {column: memmap} of the given point columns (default all of them)
+    def points(self, columns=None):
+        rows = self._point_rows()
+        return dict((name, self._map(self._column_file(name), point_type, rows)) for name in (columns or point_columns))
+
+    def passes(self):
+        filename = self._file('passes.idx')
+        return self._map(filename, pass_dtype, self._records(filename, pass_dtype))
+
+    def pass_points(self, index, passes=None, points=None):
+        entry = (self.passes() if passes is None else passes)[index]
+        points = self.points() if points is None else points
+        return dict((name, column[entry['first']:entry['first'] + entry['count']]) for name, column in points.items())
+
+    # table: structured array or dict of columns with x, y, z1, z2 (z_avg and dz are filled in when missing)
+    # trial, new: geometry values as the scripts record them ({'x': .., 'l': .., 'angles': [..]})
+    def append(self, printer, table, trial=None, new=None, run=0, calibrated=False, bed_temp=None, timestamp=None):
+        columns = dict((name, np.asarray(table[name], dtype=point_type)) for name in ['x', 'y', 'z1', 'z2'])
+        names = table.dtype.names if hasattr(table, 'dtype') else table.keys()
+        columns['z_avg'] = np.asarray(table['z_avg'], dtype=point_type) if 'z_avg' in names else (columns['z1'] + columns['z2'])/point_type.type(2.0)
+        columns['dz'] = np.asarray(table['dz'], dtype=point_type) if 'dz' in names else columns['z_avg'] - np.median(columns['z_avg'])
+
+        entry = np.zeros(1, dtype=pass_dtype)
+        entry['time'] = time.time() if timestamp is None else timestamp
+        entry['first'] = self._point_rows(trim=True)
+        entry['count'] = len(columns['x'])
+        entry['printer'] = self.printer_id(printer)
+        entry['run'] = run
+        entry['calibrated'] = 1 if calibrated else 0
+        entry['bed_temp'] = np.nan if bed_temp is None or bed_temp < 0 else bed_temp
+        for prefix, values in (('trial_', trial), ('new_', new)):
+            for key, value in _geometry(values).items():
+                entry[prefix + key] = value
+
+        for name in point_columns:
+            with open(self._column_file(name), 'ab') as column_file:
+                column_file.write(columns[name].astype(point_type).tobytes())
+        self._records(self._file('passes.idx'), pass_dtype, trim=True)
+        with open(self._file('passes.idx'), 'ab') as passes_file:
+            passes_file.write(entry.tobytes())
+
+    # A 'pass' record of either script's session log, returns False for any other record
+    def append_record(self, printer, record, bed_temp=None):
+        if record.get('kind') != 'pass':
+            return False
+        if 'table' in record:
+            # auto_cal_p5.py
+            table = dict((name, np.asarray(column, dtype=float)) for name, column in record['table'].items())
+            trial = record.get('trial')
+            new = record.get('new')
+            run = record.get('runs', 0)
+        else:
+            # auto_cal.py: the averages of the G29 P2 points, the taps from their differences
+            averages = np.asarray(record['averages'], dtype=float)
+            taps = np.asarray(record.get('taps') or [0.0]*len(averages), dtype=float)
+            table = {'x': np.array([p[0] for p in g29_p2_points]), 'y': np.array([p[1] for p in g29_p2_points]),
+                     'z1': averages - taps/2.0, 'z2': averages + taps/2.0}
+            trial = dict(zip(['x', 'y', 'z', 'r'], record['trial']))
+            new = dict(zip(['x', 'y', 'z', 'r'], record['new']))
+            run = record.get('run', 0)
+        self.append(printer, table, trial, new, run, record.get('calibrated', False), record.get('bed_temp', bed_temp), record.get('t'))
+        return True
+
+    # Session log listener that archives the passes as they're made
+    def listener(self, printer, bed_temp=None):
+        def archive_pass(fields):
+            self.append_record(printer, fields, bed_temp)
+        return archive_pass
+
+
+# Every session in a session log, the printer is the -p of the session unless one is given
+def import_session_log(archive, filename, printer=None):
+    count = 0
+    name = printer
+    bed_temp = None
+    for record in read_session(filename, all_sessions=True):
+        if record.get('kind') == 'session':
+            args = record.get('args') or {}
+            name = printer or args.get('printer_name') or args.get('port') or 'unknown'
+            bed_temp = args.get('bed_temp')
+        elif archive.append_record(name or 'unknown', record, bed_temp):
+            count += 1
+    return count
+
+
+_pass_file_re = re.compile(r'pass(\d+)\.txt$')
+_bed_re = re.compile(r'Bed X: (\S+) Y: (\S+) Z: (\S+)')
+_value_re = re.compile(r'([A-Z])(-?[\d.]+)')
+
+
+# Legacy auto_cal_p5_pass<N>.txt files, the file time stands in for the pass time
+def import_pass_file(archive, filename, printer):
+    trial = {}
+    taps = []
+    with open(filename) as pass_file:
+        for line in pass_file:
+            line = line.strip()
+            match = _bed_re.search(line)
+            if match:
+                taps.append([float(value) for value in match.groups()])
+            elif line.startswith('M666') or line.startswith('M665'):
+                for letter, value in _value_re.findall(line[4:]):
+                    trial[letter.lower()] = float(value)
+    if not taps:
+        return False
+    taps = np.array(taps)
+    table = {'x': taps[0::2, 0], 'y': taps[0::2, 1], 'z1': taps[0::2, 2], 'z2': taps[1::2, 2]}
+    match = _pass_file_re.search(filename)
+    archive.append(printer, table, trial, None, int(match.group(1)) + 1 if match else 0, timestamp=os.path.getmtime(filename))
+    return True
+
+
+def print_summary(archive):
+    passes = archive.passes()
+    points = archive.points(['dz'])
+    console.info('{0} passes, {1} probe points, {2} printers'.format(len(passes), len(points['dz']), len(archive.printer_names)))
+    for printer, name in enumerate(archive.printer_names):
+        mine = passes[passes['printer'] == printer]
+        if len(mine) == 0:
+            continue
+        # Flatness left after every pass, peak to valley of its probe heights
+        spread = np.array([np.ptp(points['dz'][p['first']:p['first'] + p['count']]) for p in mine])
+        last = mine[np.argmax(mine['time'])]
+        console.info('{0}: {1} passes, {2} calibrated, {3} to {4}, peak to valley median {5:.3f}, last {6:.3f}'.format(
+            name, len(mine), int(np.sum(mine['calibrated'])), time.strftime('%Y-%m-%d', time.localtime(np.min(mine['time']))),
+            time.strftime('%Y-%m-%d', time.localtime(np.max(mine['time']))), float(np.median(spread)), float(spread[np.argmax(mine['time'])])))
+        console.info('    last trial M666 X{0:.4f} Y{1:.4f} Z{2:.4f} M665 L{3:.4f} R{4:.4f}'.format(
+            last['trial_x'], last['trial_y'], last['trial_z'], last['trial_l'], last['trial_r']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Columnar archive of the probe data of a fleet of printers')
+    parser.add_argument('archive', help='Archive directory (created if needed)')
+    parser.add_argument('--import-log', type=str, nargs='+', default=None, help='Session logs (.jsonl) of auto_cal_p5.py or auto_cal.py to add')
+    parser.add_argument('--import-pass-files', type=str, nargs='+', default=None, help='auto_cal_p5_pass<N>.txt files to add')
+    parser.add_argument('--printer', type=str, default=None, help='Printer the imported passes belong to (default for logs: the -p of each session)')
+    args = parser.parse_args()
+
+    archive = ProbeArchive(args.archive)
+    for filename in args.import_log or []:
+        console.info('{0}: {1} passes'.format(filename, import_session_log(archive, filename, args.printer)))
+    if args.import_pass_files:
+        if args.printer is None:
+            parser.error('--import-pass-files needs --printer')
+        count = sum(1 for filename in sorted(args.import_pass_files) if import_pass_file(archive, filename, args.printer))
+        console.info('{0} pass files'.format(count))
+    print_summary(archive)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,206 @@
+#!/usr/bin/python
+
+# Port discovery for racks of printers
+#
+# Works out which serial port is which printer: every candidate port is opened at the same time
+# on its own thread, sent M115 and given 'timeout' seconds to answer, so a scan takes about as
+# long as the slowest port instead of the sum of all of them (the USB double open included).
+#
+# Ports are identified by an ID that survives reboots and re-plugging: the udev /dev/serial/by-id
+# link when there is one, otherwise the USB vendor/product/serial number. The answers are cached
+# under that ID, later scans only open ports they haven't seen before (or all of them with
+# --refresh), which brings a scan of a known rack down to listing the ports.
+#
+# python3 mpmd_discover.py
+# python3 mpmd_discover.py --refresh --timeout 3
+
+import threading
+import argparse
+import json
+import time
+import glob
+import os
+import re
+from auto_cal import MpmdConnection
+from mpmd_log import console
+
+try:
+    from serial.tools import list_ports
+except ImportError:
+    list_ports = None
+
+default_cache = os.path.join(os.path.expanduser('~'), '.mpmd_ports.json')
+
+# Device names worth probing when there's no USB information
+_candidate_re = re.compile(r'(ttyACM|ttyUSB|cu\.usbmodem|COM)\d*')
+# 'FIRMWARE_NAME:Marlin 1.1.9 SOURCE_CODE_URL:github.com/... MACHINE_TYPE:MP Mini Delta UUID:...'
+_m115_re = re.compile(r'([A-Z_]+):(.*?)(?=\s+[A-Z_]+:|$)')
+
+
+# Fields of an M115 report ('Cap:' lines become a capabilities dict)
+def parse_m115(lines):
+    info = {}
+    capabilities = {}
+    for line in lines:
+        line = line.strip()
+        if line.startswith('Cap:'):
+            name, _, value = line[4:].partition(':')
+            capabilities[name] = value
+        elif 'FIRMWARE_NAME' in line:
+            for key, value in _m115_re.findall(line[line.index('FIRMWARE_NAME'):]):
+                info[key.lower()] = value.strip()
+    if capabilities:
+        info['capabilities'] = capabilities
+    return info
+
+
+# {device: udev by-id link} (Linux only, empty elsewhere)
+def by_id_links():
+    links = {}
+    for link in glob.glob('/dev/serial/by-id/*'):
+        links[os.path.realpath(link)] = link
+    return links
+
+
+# Candidate ports as {'device', 'stable_id', 'usb_serial', 'vid', 'pid', 'description'}
+def candidate_ports(include_all=False):
+    links = by_id_links()
+    ports = []
+    for port in (list_ports.comports() if list_ports is not None else []):
+        if port.vid is None and not include_all and not _candidate_re.search(port.device):
+            continue
+        if port.device in links:
+            stable_id = links[port.device]
+        elif port.vid is not None and port.serial_number:
+            stable_id = 'usb:{0:04x}:{1:04x}:{2}'.format(port.vid, port.pid, port.serial_number)
+        elif port.vid is not None and port.location:
+            stable_id = 'usb:{0:04x}:{1:04x}@{2}'.format(port.vid, port.pid, port.location)
+        else:
+            stable_id = port.device
+        ports.append({'device': port.device, 'stable_id': stable_id, 'usb_serial': port.serial_number,
+                      'vid': port.vid, 'pid': port.pid, 'description': port.description})
+    return ports
+
+
+# Open a port, send M115 and collect the reply until ok or the timeout
+def identify(device, speed=115200, timeout=2.0):
+    deadline = time.time() + timeout
+    info = {}
+    conn = None
+    try:
+        conn = MpmdConnection.establishSerialConnection(device, speed, timeout=0.1, writeTimeout=timeout)
+        # Skip whatever the printer printed before (start-up banner, temperatures)
+        conn.reset_input_buffer()
+        conn.write(b'M115\n')
+        lines = []
+        buffer = b''
+        while time.time() < deadline:
+            buffer += conn.read(conn.in_waiting or 1)
+            if b'\n' not in buffer:
+                continue
+            complete = buffer.split(b'\n')
+            buffer = complete.pop()
+            lines.extend(line.decode('utf-8', 'replace').strip() for line in complete)
+            if any(line.startswith('ok') for line in lines):
+                break
+        info = parse_m115(lines)
+        replies = [line for line in lines if line and not line.startswith('ok')]
+        if not info and replies:
+            # Firmware without the Marlin style report, keep what it said
+            info['reply'] = replies[:5]
+        elif not info:
+            info['error'] = 'No M115 reply within {0} s'.format(timeout)
+    except Exception as e:
+        info['error'] = '{0}: {1}'.format(type(e).__name__, e)
+    finally:
+        if conn is not None:
+            conn.close()
+    return info
+
+
+def load_cache(filename):
+    try:
+        with open(filename) as cache_file:
+            return json.load(cache_file)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def save_cache(filename, cache):
+    with open(filename, 'w') as cache_file:
+        json.dump(cache, cache_file, indent=2, sort_keys=True)
+
+
+# Returns {device: port info + M115 fields}, ports: devices or URLs to probe instead of the
+# detected ones. cache: file name, None to always probe.
+def discover(ports=None, speed=115200, timeout=2.0, cache=default_cache, refresh=False, include_all=False):
+    if ports is None:
+        candidates = candidate_ports(include_all)
+    else:
+        links = by_id_links()
+        candidates = [{'device': device, 'stable_id': links.get(device, device)} for device in ports]
+    cached = load_cache(cache) if cache else {}
+    results = {}
+    threads = []
+
+    def probe(candidate):
+        info = dict(candidate)
+        info.update(identify(candidate['device'], speed, timeout))
+        info['seen'] = round(time.time(), 1)
+        results[candidate['device']] = info
+
+    for candidate in candidates:
+        known = cached.get(candidate['stable_id'])
+        if known is not None and 'error' not in known and not refresh:
+            # The port may have been renumbered, the ID hasn't
+            results[candidate['device']] = dict(known, **candidate)
+            continue
+        thread = threading.Thread(target=probe, args=(candidate,))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    deadline = time.time() + timeout + 1.0
+    for thread in threads:
+        thread.join(max(0.0, deadline - time.time()))
+    # Threads still stuck opening a port can't change the result any more
+    results = dict(results)
+    for candidate in candidates:
+        if candidate['device'] not in results:
+            results[candidate['device']] = dict(candidate, error='Opening the port did not return')
+
+    if cache:
+        for info in results.values():
+            if 'error' not in info:
+                cached[info['stable_id']] = info
+        save_cache(cache, cached)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Find the printers on the serial ports and identify them (M115, USB serial number)')
+    parser.add_argument('ports', nargs='*', help='Ports or socket:// / rfc2217:// URLs to probe (default: every USB serial port)')
+    parser.add_argument('-b', '--baud-rate', type=int, default=115200, help='Baudrate to probe at')
+    parser.add_argument('-t', '--timeout', type=float, default=2.0, help='Seconds every port gets to answer M115')
+    parser.add_argument('--cache', type=str, default=default_cache, help='Cache of identified printers by stable port ID (empty = off)')
+    parser.add_argument('--refresh', action='store_true', help='Probe every port, also the ones in the cache')
+    parser.add_argument('--all', action='store_true', help='Also probe ports that are not USB serial ports')
+    parser.add_argument('--json', action='store_true', help='Print the port to printer map as JSON')
+    args = parser.parse_args()
+
+    started = time.time()
+    printers = discover(args.ports or None, args.baud_rate, args.timeout, args.cache or None, args.refresh, args.all)
+    if args.json:
+        print(json.dumps(printers, indent=2, sort_keys=True))
+        return
+    for device in sorted(printers):
+        info = printers[device]
+        if 'error' in info:
+            console.info('{0:<16} {1}  ({2})'.format(device, info['stable_id'], info['error']))
+        else:
+            console.info('{0:<16} {1}  {2} {3} {4}'.format(device, info['stable_id'], info.get('firmware_name', ''),
+                                                          info.get('machine_type', ''), info.get('uuid', '')))
+    console.info('{0} ports in {1:.2f} s'.format(len(printers), time.time() - started))
+
+
+if __name__ == '__main__':
+    main()
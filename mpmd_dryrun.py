@@ -0,0 +1,436 @@
+#!/usr/bin/python
+
+# Dry run support shared by the calibration scripts
+#
+# SimulatedPort stands in for the pyserial port: the scripts send exactly the G-code they would
+# send to a printer, and it answers like a perfectly flat, perfectly calibrated printer would.
+# Every command advances a simulated clock by the time a delta printer would need for it
+# (trapezoidal moves limited by the carriage speeds, homing, probe taps, heating and dwells)
+# plus a per-command latency, so a dry run predicts how long a session takes without a printer
+# attached.
+#
+# The defaults are rough Monoprice Mini Delta numbers, time a real run with --trace and
+# adjust them if the prediction is off. The latency is taken from the session log of earlier
+# real runs when there is one (latency_from_log), it depends on the host and the connection
+# more than on the printer.
+#
+# TcpPrinterStandIn serves a SimulatedPort over TCP like a ser2net bridge in raw mode, with an
+# adjustable network latency, so socket:// connections and pipelining can be tried without a
+# printer:
+#
+# python3 mpmd_dryrun.py --listen 5000 --latency 0.02
+# python3 auto_cal_p5.py -p socket://127.0.0.1:5000 -ff 1
+
+import threading
+import argparse
+import socket
+import time
+import math
+import os
+import re
+from mpmd_log import console, read_session
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+_word_re = re.compile(r'([A-Z])(-?[\d.]+)?')
+
+# G29 P2 probe points of the stock firmware (X, Y, Z towers and the center)
+g29_p2_points = [(-43.3, -25.0), (43.3, -25.0), (0.0, 50.0), (0.0, 0.0)]
+# G29 P5 probe points of the stock firmware, in the order G29 P5 V4 reports them (auto_cal_p5.py's
+# square_grid(5) comes out the same)
+g29_p5_points = [(-25.0, -50.0), (0.0, -50.0), (25.0, -50.0), (50.0, -25.0), (25.0, -25.0), (0.0, -25.0), (-25.0, -25.0),
+                 (-50.0, -25.0), (-50.0, 0.0), (-25.0, 0.0), (0.0, 0.0), (25.0, 0.0), (50.0, 0.0), (50.0, 25.0),
+                 (25.0, 25.0), (0.0, 25.0), (-25.0, 25.0), (-50.0, 25.0), (-25.0, 50.0), (0.0, 50.0), (25.0, 50.0)]
+
+
+# A heater warming up or cooling down at a constant rate towards its target
+class Heater(object):
+
+    # heat_rate, cool_rate: degrees C per second, residency: seconds M190/M109 wait at the target
+    def __init__(self, heat_rate, cool_rate, residency=10.0, temperature=25.0):
+        self.heat_rate = heat_rate
+        self.cool_rate = cool_rate
+        self.residency = residency
+        self.temperature = temperature
+        self.target = temperature
+
+    def elapse(self, seconds):
+        if self.temperature < self.target:
+            self.temperature = min(self.target, self.temperature + self.heat_rate*seconds)
+        else:
+            self.temperature = max(self.target, self.temperature - self.cool_rate*seconds)
+
+    # Seconds until the target is reached (and held for the residency time), cooling only with wait_cooling
+    def wait_time(self, wait_cooling):
+        if self.temperature < self.target:
+            return (self.target - self.temperature)/self.heat_rate + self.residency
+        if wait_cooling and self.temperature > self.target:
+            return (self.temperature - self.target)/self.cool_rate + self.residency
+        return 0.0
+
+
+class DeltaMotionModel(object):
+
+    # radius, rod, height: M665 R, L and the nozzle height after homing (mm)
+    # accel: mm/s^2, max_carriage_speed: mm/s
+    # homing_feed, probe_feed: mm/s, probe_raise: height the nozzle is lifted to after a tap (mm)
+    # probe_dwell: settle/bump time per tap (s), latency: round trip per command (s)
+    # bed, hotend: Heater (default the MPMD's, about 0.4 C/s bed and 2 C/s hotend warm up from 25 C)
+    def __init__(self, radius=63.5, rod=123.0, height=120.0, accel=1000.0, max_carriage_speed=200.0,
+                 homing_feed=50.0, probe_feed=10.0, probe_raise=5.0, probe_dwell=0.3, latency=0.01, bed=None, hotend=None):
+        self.radius = radius
+        self.rod = rod
+        self.height = height
+        self.accel = accel
+        self.max_carriage_speed = max_carriage_speed
+        self.homing_feed = homing_feed
+        self.probe_feed = probe_feed
+        self.probe_raise = probe_raise
+        self.probe_dwell = probe_dwell
+        self.latency = latency
+        self.bed = bed or Heater(0.4, 0.05)
+        self.hotend = hotend or Heater(2.0, 0.5)
+        # Modal state, the printer starts homed
+        self.position = [0.0, 0.0, height]
+        self.feed = 50.0
+
+    def carriages(self, position):
+        heights = []
+        for angle in (210.0, 330.0, 90.0):
+            tower_x = self.radius*math.cos(math.radians(angle))
+            tower_y = self.radius*math.sin(math.radians(angle))
+            dist2 = (position[0] - tower_x)**2 + (position[1] - tower_y)**2
+            heights.append(position[2] + math.sqrt(max(self.rod**2 - dist2, 0.0)))
+        return heights
+
+    # Trapezoidal (or triangular) velocity profile
+    def _profile_time(self, distance, speed):
+        if distance <= 0:
+            return 0.0
+        if distance >= speed*speed/self.accel:
+            return distance/speed + speed/self.accel
+        return 2.0*math.sqrt(distance/self.accel)
+
+    def move(self, target, feed):
+        start = self.carriages(self.position)
+        end = self.carriages(target)
+        distance = math.sqrt(sum((t - p)**2 for t, p in zip(target, self.position)))
+        carriage_distance = max(abs(e - s) for e, s in zip(end, start))
+        speed = feed
+        # Marlin keeps every carriage under its own feed rate limit
+        if distance > 0 and carriage_distance/distance*speed > self.max_carriage_speed:
+            speed = self.max_carriage_speed*distance/carriage_distance
+        self.position = list(target)
+        return self._profile_time(max(distance, carriage_distance), speed)
+
+    def home(self):
+        return self.move([0.0, 0.0, self.height], self.homing_feed) + 1.0
+
+    # A single tap: down to the bed, then back up to the probe raise height
+    def probe(self):
+        down = self.move([self.position[0], self.position[1], 0.0], self.probe_feed)
+        up = self.move([self.position[0], self.position[1], self.probe_raise], self.feed)
+        return down + up + self.probe_dwell
+
+    # The heaters keep going whatever the printer is doing
+    def elapse(self, seconds):
+        self.bed.elapse(seconds)
+        self.hotend.elapse(seconds)
+
+    # Seconds the printer needs for a command, including the round trip
+    def command_time(self, command):
+        words = dict((w[0], w[1]) for w in _word_re.findall(command))
+        code = command.split(' ')[0]
+        if 'F' in words and code in ('G0', 'G1'):
+            self.feed = float(words['F'])/60.0
+        seconds = self.latency
+        if code in ('G0', 'G1'):
+            target = list(self.position)
+            for ii, axis in enumerate('XYZ'):
+                if words.get(axis):
+                    target[ii] = float(words[axis])
+            seconds += self.move(target, self.feed)
+        elif code == 'G28':
+            seconds += self.home()
+        elif code == 'G30':
+            seconds += self.probe()
+        elif code == 'G4':
+            # P milliseconds or S seconds
+            seconds += float(words.get('P') or 0)/1000.0 + float(words.get('S') or 0)
+        elif code in ('M140', 'M190', 'M104', 'M109'):
+            heater = self.bed if code in ('M140', 'M190') else self.hotend
+            value = words.get('S') or words.get('R')
+            if value:
+                heater.target = float(value)
+            if code in ('M190', 'M109'):
+                # S only waits for heating up, R for cooling down as well
+                seconds += heater.wait_time('R' in words)
+        self.elapse(seconds)
+        return seconds
+
+
+class SimulatedPort(object):
+
+    # model: DeltaMotionModel
+    # g29_grids: {program number: [(x, y), ...]} for the G29 Pn grids the firmware probes itself
+    def __init__(self, model=None, g29_grids=None, step_mm=57.14):
+        self.model = model or DeltaMotionModel()
+        self.g29_grids = g29_grids or {}
+        self.timeout = 1.0
+        self.buffer = b''
+        self.condition = threading.Condition()
+        self.commands = []
+        self.elapsed = 0.0
+        self.settings = {'step': step_mm, 'x': 0.0, 'y': 0.0, 'z': 0.0}
+
+    # Simulated seconds since the port was opened
+    def clock(self):
+        return self.elapsed
+
+    def _respond(self, command):
+        model = self.model
+        words = dict((w[0], w[1]) for w in _word_re.findall(command))
+        code = command.split(' ')[0]
+        lines = []
+        if code == 'G30':
+            lines.append('Bed X: {0:.3f} Y: {1:.3f} Z: 0.000'.format(model.position[0], model.position[1]))
+        elif code == 'G29':
+            lines.append('G29 Auto Bed Leveling')
+            started = self.elapsed
+            for x, y in self.g29_grids.get(int(float(words.get('P') or 1)), []):
+                self.elapsed += model.move([x, y, model.probe_raise], model.feed)
+                for tap in range(2):
+                    self.elapsed += model.probe()
+                    lines.append('Bed X: {0:.3f} Y: {1:.3f} Z: 0.000'.format(x, y))
+            model.elapse(self.elapsed - started)
+        elif code == 'M665':
+            if words.get('R'):
+                model.radius = float(words['R'])
+            if words.get('L'):
+                model.rod = float(words['L'])
+        elif code == 'M666':
+            for axis in 'XYZ':
+                if words.get(axis):
+                    self.settings[axis.lower()] = float(words[axis])
+        elif code == 'M92' and words.get('X'):
+            self.settings['step'] = float(words['X'])
+        elif code == 'M503':
+            settings = self.settings
+            lines.append('M92 X{0:.2f} Y{0:.2f} Z{0:.2f} E97.00'.format(settings['step']))
+            lines.append('M666 X{0:.2f} Y{1:.2f} Z{2:.2f}'.format(settings['x'], settings['y'], settings['z']))
+            lines.append('M665 L{0:.2f} R{1:.2f} H{2:.2f} S200.00 B50.00 X0.00 Y0.00 Z0.00'.format(model.rod, model.radius, model.height))
+        elif code == 'M500':
+            lines.append('echo:Settings Stored')
+        elif code == 'M115':
+            lines.append('FIRMWARE_NAME:Dry run')
+        lines.append('ok')
+        return lines
+
+    def write(self, data):
+        for command in data.decode().splitlines():
+            command = command.strip()
+            # Drop the line number and checksum of the reliable transport
+            if command.startswith('N') and '*' in command:
+                command = command.split('*')[0].split(' ', 1)[1]
+            if command == '':
+                continue
+            self.commands.append(command)
+            self.elapsed += self.model.command_time(command)
+            lines = self._respond(command)
+            with self.condition:
+                self.buffer += ''.join(line + '\n' for line in lines).encode()
+                self.condition.notify_all()
+        return len(data)
+
+    @property
+    def in_waiting(self):
+        return len(self.buffer)
+
+    def read(self, size=1):
+        with self.condition:
+            if not self.buffer:
+                self.condition.wait(self.timeout)
+            data = self.buffer[:size]
+            self.buffer = self.buffer[size:]
+            return data
+
+    def close(self):
+        pass
+
+
+class TcpPrinterStandIn(object):
+
+    # latency: one way network delay (s)
+    # time_scale: share of the simulated printer time that is really waited (0 = answer at once, 1 = real time)
+    # g29_grids: see SimulatedPort
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, time_scale=0.0, g29_grids=None):
+        self.latency = latency
+        self.time_scale = time_scale
+        self.g29_grids = g29_grids
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind((host, port))
+        self.server.listen(1)
+        # (host, port), port 0 picks a free one
+        self.address = self.server.getsockname()
+        self.thread = None
+
+    # Serve on a background thread
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def serve_forever(self):
+        while True:
+            try:
+                client, address = self.server.accept()
+            except (IOError, OSError):
+                # Closed
+                break
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self._serve(client)
+
+    def close(self):
+        self.server.close()
+
+    # Both directions are delayed by the latency without limiting the throughput, like a network
+    def _serve(self, client):
+        printer = SimulatedPort(g29_grids=self.g29_grids)
+        inbound = queue.Queue()
+        outbound = queue.Queue()
+
+        def delayed(items, handle):
+            while True:
+                item = items.get()
+                if item is None:
+                    break
+                due, data = item
+                time.sleep(max(0.0, due - time.time()))
+                handle(data)
+
+        def execute(data):
+            execute.buffer += data
+            while b'\n' in execute.buffer:
+                line, execute.buffer = execute.buffer.split(b'\n', 1)
+                started = printer.clock()
+                printer.write(line + b'\n')
+                time.sleep((printer.clock() - started)*self.time_scale)
+                with printer.condition:
+                    reply, printer.buffer = printer.buffer, b''
+                if reply:
+                    outbound.put((time.time() + self.latency, reply))
+        execute.buffer = b''
+
+        def send(data):
+            try:
+                client.sendall(data)
+            except (IOError, OSError):
+                pass
+
+        workers = [threading.Thread(target=delayed, args=(inbound, execute)),
+                   threading.Thread(target=delayed, args=(outbound, send))]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        while True:
+            try:
+                data = client.recv(4096)
+            except (IOError, OSError):
+                data = b''
+            if not data:
+                break
+            inbound.put((time.time() + self.latency, data))
+        inbound.put(None)
+        workers[0].join()
+        outbound.put(None)
+        workers[1].join()
+        client.close()
+
+
+# Commands the firmware answers without waiting on a move or a heater, their send to ok time
+# is the round trip the model's latency stands for
+_immediate_codes = ('M92', 'M105', 'M114', 'M115', 'M117', 'M140', 'M104', 'M665', 'M666', 'M503', 'M500')
+
+
+# Median round trip (s) of the commands in the session log records (mpmd_log.read_session with
+# all_sessions) that were sent with nothing else in flight and got an ok back, None without any.
+# Dry run sessions are skipped, they only hold the latency the simulation was given.
+def latency_from_log(records):
+    round_trips = []
+    outstanding = []
+    dry_run = False
+    for record in records:
+        kind = record.get('kind')
+        if kind == 'session':
+            dry_run = (record.get('args') or {}).get('dry_run') == 1
+            outstanding = []
+        elif dry_run:
+            continue
+        elif kind == 'send':
+            outstanding.append((record['t'], record['command'].split(' ')[0], len(outstanding) == 0))
+        elif kind == 'recv' and record['line'].startswith('ok') and outstanding:
+            sent, code, alone = outstanding.pop(0)
+            if alone and code in _immediate_codes:
+                round_trips.append(record['t'] - sent)
+    if not round_trips:
+        return None
+    round_trips.sort()
+    return round_trips[len(round_trips)//2]
+
+
+# Motion model for a dry run, with the latency measured from the real runs in log_file (a session log)
+def dry_run_model(log_file=None):
+    model = DeltaMotionModel()
+    latency = None
+    if log_file and os.path.exists(log_file):
+        latency = latency_from_log(read_session(log_file, all_sessions=True))
+    if latency is None:
+        console.info('Dry run: no real run in the session log to measure the round trip from, assuming {0:.3f} s per command'.format(model.latency))
+    else:
+        model.latency = latency
+        console.info('Dry run: {0:.3f} s round trip per command, measured from {1}'.format(latency, log_file))
+    return model
+
+
+# Per phase time budget from the tracer spans, with the worst case for max_runs passes
+def print_time_budget(tracer, port, max_runs, pass_name='pass'):
+    # Host compute doesn't move the simulated clock, only the printer phases are of interest
+    totals = tracer.phase_totals('printer')
+    console.info('\nDry run: {0} commands, predicted printer time per phase'.format(len(port.commands)))
+    for name, (count, seconds) in totals.items():
+        if name in ('session', pass_name):
+            continue
+        console.info('    {0:<16}{1:>4}x {2:>9.1f} s'.format(name, count, seconds))
+    session = totals.get('session', (1, port.clock()))[1]
+    passes, pass_seconds = totals.get(pass_name, (0, 0.0))
+    console.info('Predicted session: {0:.1f} s ({1} x {2})'.format(session, passes, pass_name))
+    if passes > 0:
+        per_pass = pass_seconds/passes
+        worst = session - pass_seconds + per_pass*max_runs
+        console.info('Per {0}: {1:.1f} s, worst case with max runs {2}: {3:.1f} s ({4:.1f} min)'.format(pass_name, per_pass, max_runs, worst, worst/60.0))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulated Monoprice Mini Delta on a TCP port (connect with -p socket://host:port)')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='Address to listen on')
+    parser.add_argument('--listen', type=int, default=5000, help='TCP port to listen on')
+    parser.add_argument('--latency', type=float, default=0.0, help='One way network latency to add (s)')
+    parser.add_argument('--time-scale', type=float, default=0.0, help='Share of the simulated printer time to really wait (0 = answer at once; 1 = real time)')
+    args = parser.parse_args()
+    stand_in = TcpPrinterStandIn(args.host, args.listen, args.latency, args.time_scale, g29_grids={2: g29_p2_points, 5: g29_p5_points})
+    console.info('Simulated printer listening on socket://{0}:{1}'.format(*stand_in.address))
+    try:
+        stand_in.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stand_in.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,215 @@
+#!/usr/bin/python
+
+# Session log and console output shared by the calibration scripts
+#
+# session: one append-only JSON lines file per calibration log. Every record is a JSON object
+# with a 'kind' (session, send, recv, pass, result), the time 't' and the session id, written
+# through a large buffer. How often it is forced to disk is the fsync policy: 'never' (leave it
+# to the OS), 'pass' (after every calibration pass) or 'always' (after every record).
+#
+# console: a logging.Logger whose records are printed by a background thread, so a slow serial
+# console or SSH session doesn't hold up the calibration. Records below the console level are
+# dropped, and below WARNING at most 'rate' lines per second get printed, the rest are counted
+# and reported as suppressed.
+#
+# Listeners added to the session get every record as it's made, log file or not, that's how
+# mpmd_service streams the progress of a calibration.
+
+import threading
+import logging
+import atexit
+import json
+import time
+import os
+import sys
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+fsync_policies = ['never', 'pass', 'always']
+
+
+# NumPy values are written as their plain python equivalents
+def json_default(value):
+    return value.tolist() if hasattr(value, 'tolist') else str(value)
+
+
+class SessionLog(object):
+
+    def __init__(self):
+        self.file = None
+        self.fsync = 'pass'
+        self.session_id = None
+        self.lock = threading.Lock()
+        # Functions called with every record (a dict), on the thread making the record
+        self.listeners = []
+
+    def open(self, filename, fsync='pass', buffering=1 << 16):
+        if fsync not in fsync_policies:
+            raise ValueError('Unknown fsync policy {0}, use one of {1}'.format(fsync, fsync_policies))
+        self.file = open(filename, 'a', buffering)
+        self.fsync = fsync
+        self.session_id = time.strftime('%Y%m%d-%H%M%S')
+
+    def record(self, kind, **fields):
+        if self.file is None and not self.listeners:
+            return
+        fields['kind'] = kind
+        fields['t'] = round(time.time(), 4)
+        fields['session'] = self.session_id
+        for listener in list(self.listeners):
+            listener(fields)
+        if self.file is None:
+            return
+        line = json.dumps(fields, default=json_default) + '\n'
+        with self.lock:
+            self.file.write(line)
+            if self.fsync == 'always':
+                self._sync()
+
+    # End of a pass, the point the 'pass' policy syncs at
+    def checkpoint(self):
+        if self.file is None:
+            return
+        with self.lock:
+            if self.fsync in ('pass', 'always'):
+                self._sync()
+
+    def _sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        if self.file is None:
+            return
+        with self.lock:
+            if self.fsync != 'never':
+                self._sync()
+            self.file.close()
+            self.file = None
+
+    # on_line / on_write hooks for PrinterConnection
+    def received(self, line):
+        self.record('recv', line=line)
+
+    def sent(self, command):
+        self.record('send', command=command)
+
+
+# Records of the last session in a session log file, or of all of them with all_sessions
+def read_session(filename, all_sessions=False):
+    records = []
+    with open(filename) as log_file:
+        for line in log_file:
+            line = line.strip()
+            if line == '':
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # A record cut off by a crash
+                continue
+            if record.get('kind') == 'session' and not all_sessions:
+                records = []
+            records.append(record)
+    return records
+
+
+class RateLimitFilter(logging.Filter):
+
+    def __init__(self, rate):
+        logging.Filter.__init__(self)
+        self.rate = rate
+        self.tokens = rate
+        self.last = time.time()
+        self.suppressed = 0
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or self.rate <= 0:
+            return True
+        now = time.time()
+        self.tokens = min(self.rate, self.tokens + (now - self.last)*self.rate)
+        self.last = now
+        if self.tokens < 1:
+            self.suppressed += 1
+            return False
+        self.tokens -= 1
+        if self.suppressed:
+            record.msg = '({0} console lines suppressed)\n{1}'.format(self.suppressed, record.msg)
+            self.suppressed = 0
+        return True
+
+
+class _ConsoleHandler(logging.Handler):
+    # Hands records to the background printer thread
+
+    def __init__(self, records):
+        logging.Handler.__init__(self)
+        self.records = records
+
+    def emit(self, record):
+        self.records.put(record)
+
+
+class Console(object):
+
+    def __init__(self):
+        self.logger = logging.getLogger('mpmd')
+        self.logger.propagate = False
+        self.records = queue.Queue()
+        self.printer = logging.StreamHandler(sys.stdout)
+        self.printer.setFormatter(logging.Formatter('%(message)s'))
+        self.rate_filter = RateLimitFilter(0)
+        self.printer.addFilter(self.rate_filter)
+        self.logger.addHandler(_ConsoleHandler(self.records))
+        self.logger.setLevel(logging.INFO)
+        self.thread = None
+        atexit.register(self.flush)
+
+    # level: 'debug', 'info' or 'warning', rate: console lines per second (0 = unlimited)
+    def configure(self, level='info', rate=0):
+        self.logger.setLevel(getattr(logging, level.upper()))
+        self.rate_filter.rate = rate
+        self.rate_filter.tokens = rate
+
+    def _print_loop(self):
+        while True:
+            record = self.records.get()
+            if record is None:
+                break
+            self.printer.handle(record)
+
+    def _start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._print_loop)
+            self.thread.daemon = True
+            self.thread.start()
+
+    # Wait until everything logged so far is printed
+    def flush(self):
+        if self.thread is not None:
+            self.records.put(None)
+            self.thread.join()
+            self.thread = None
+        if self.rate_filter.suppressed:
+            sys.stdout.write('({0} console lines suppressed)\n'.format(self.rate_filter.suppressed))
+            self.rate_filter.suppressed = 0
+        sys.stdout.flush()
+
+    def debug(self, message):
+        self._start()
+        self.logger.debug(message)
+
+    def info(self, message):
+        self._start()
+        self.logger.info(message)
+
+    def warning(self, message):
+        self._start()
+        self.logger.warning(message)
+
+
+session = SessionLog()
+console = Console()
@@ -0,0 +1,423 @@
+#!/usr/bin/python
+
+# Serial connection layer shared by the calibration scripts
+#
+# A background thread drains the serial port continuously and sorts every line the printer
+# sends into a typed event. Temperature reports, busy keep-alives and stray oks can no longer
+# shift the positional readline() parsing the scripts used to do, the scripts wait for the
+# event type they need instead.
+#
+# Writes go straight to the port from the calling thread, they never wait behind a read. With
+# a window, a write waits until fewer than that many commands are unacknowledged, so a batch of
+# commands can be queued up front without overrunning the firmware's command buffer. The
+# printer then always has its next command on hand, which hides the round trip of slow links
+# (network serial bridges).
+#
+# A mirror of the printer's settings (state) is read from M503 and kept up to date by
+# set_parameters, which only sends the parameters that differ from what it sent before. M503
+# rounds (two decimals), a parameter known only from the report is always sent.
+#
+# The thread running a calibration can be stopped from another one with cancel(): its next
+# write or wait raises Cancelled. resume() lets the printer finish what it still has queued and
+# makes the connection usable again afterwards.
+#
+# Every wait has a deadline (the connection's timeout unless the caller passes one). When it
+# passes, a watchdog gets the stream back in step by sending M400 and waiting for its ok: if the
+# printer answers, only oks got lost and waiting for oks carries on, a missing line (probe
+# result, settings) raises Timeout. Nothing waits forever on a line that never comes.
+#
+# Optionally (reliable=True) every command is sent with a line number and checksum
+# (N<line> <command>*<checksum>) and Resend: requests from the firmware are answered from a
+# short history of sent lines, so a corrupted byte gets the line rejected instead of silently
+# changing a value.
+
+import threading
+import collections
+import time
+import re
+from mpmd_settings import PrinterSettings
+from mpmd_log import console
+
+# Largest rounding error of an M503 value (reported with two decimals)
+report_rounding = 0.005
+
+# Event types
+OK = 'ok'
+PROBE = 'probe'             # Bed X: ... Y: ... Z: ...
+LEVELING = 'leveling'       # G29 Auto Bed Leveling banner
+SETTINGS = 'settings'       # M503 output lines and Settings Stored
+TEMPERATURE = 'temperature' # T: ... B: ... reports
+BUSY = 'busy'               # echo:busy: processing keep-alives
+ERROR = 'error'
+RESEND = 'resend'           # Resend: <line> (handled by the connection itself)
+OTHER = 'other'
+
+# Only a complete probe result counts, M503 section headings ('echo:Auto Bed Leveling:',
+# 'echo:; Mesh Bed Leveling:') mention the bed too
+_probe_re = re.compile(r'^Bed X: \S+ Y: \S+ Z: \S+')
+_settings_re = re.compile(r'^(echo:\s*)?M\d+ ')
+_temperature_re = re.compile(r'(^|\s)T:\s*-?\d')
+_resend_re = re.compile(r'^(Resend:|rs)\s*N?(\d+)')
+
+
+class Cancelled(Exception):
+    pass
+
+
+class Timeout(Exception):
+    pass
+
+
+# Deadline for the waits, 'seconds' from now (None = no limit)
+def deadline_in(seconds):
+    return None if seconds is None else time.time() + seconds
+
+
+def classify_line(line):
+    if line.startswith('ok'):
+        return OK
+    if 'busy:' in line:
+        return BUSY
+    if _resend_re.match(line):
+        return RESEND
+    if line.startswith('Error') or line.startswith('!!'):
+        return ERROR
+    if 'G29 Auto Bed Leveling' in line:
+        return LEVELING
+    if _probe_re.match(line):
+        return PROBE
+    if 'Settings Stored' in line or _settings_re.match(line):
+        return SETTINGS
+    if _temperature_re.search(line):
+        return TEMPERATURE
+    return OTHER
+
+def checksum(line):
+    cs = 0
+    for c in bytearray(line.encode()):
+        cs ^= c
+    return cs
+
+def frame_command(number, command):
+    line = 'N{0} {1}'.format(number, command)
+    return '{0}*{1}'.format(line, checksum(line))
+
+# Try the baudrates from fastest to slowest and keep the first one the printer answers.
+# open_port(speed) returns an open pyserial port (or raises), the winning port is returned open.
+def negotiate_speed(open_port, speeds, probe_timeout=1.0):
+    for speed in sorted(speeds, reverse=True):
+        try:
+            port = open_port(speed)
+        except Exception:
+            continue
+        if port is None:
+            continue
+        timeout = port.timeout
+        port.timeout = probe_timeout
+        port.write((frame_command(0, 'M110 N0') + '\n').encode())
+        for ii in range(5):
+            if port.readline().startswith(b'ok'):
+                port.timeout = timeout
+                return port, speed
+        port.close()
+    return None, None
+
+
+class PrinterConnection(object):
+
+    # port: an open pyserial port
+    # max_events: bound on the queued events, untyped (OTHER) lines are dropped when it's reached,
+    #             typed ones (probe results, settings, errors) never are, the queue grows past it instead
+    # on_line: optional callback run (on the reader thread) with every received line
+    # on_write: optional callback run with every command before it is sent
+    # reliable: send line numbers and checksums and answer resend requests
+    # history: number of sent lines kept around for resends
+    # window: maximum number of unacknowledged commands (None = no limit), Marlin queues 4 (BUFSIZE)
+    # timeout: seconds a wait that isn't given a deadline waits before the watchdog steps in (None = no limit)
+    def __init__(self, port, max_events=1000, on_line=None, reliable=False, history=64, on_write=None, window=None, timeout=120.0):
+        self.port = port
+        self.max_events = max_events
+        self.on_line = on_line
+        self.on_write = on_write
+        self.window = window
+        self.timeout = timeout
+        self.resyncs = 0
+        self.events = collections.deque()
+        self.condition = threading.Condition()
+        self.write_lock = threading.Lock()
+        # Every command gets one ok back, counting them keeps replies lined up with commands
+        self.sent = 0
+        self.acknowledged = 0
+        self.temperature = None
+        self.discarded = 0
+        self.overfull = False
+        self.reliable = reliable
+        self.line_number = 0
+        self.history = collections.OrderedDict()
+        self.history_size = history
+        self.resends = 0
+        # Line being replayed and the ok count at which its replay is acknowledged (see _resend)
+        self.resending = None
+        self.replay_acknowledged = 0
+        # Mirror of the printer settings (mpmd_settings.PrinterSettings)
+        self.state = PrinterSettings()
+        # Parameters at the exact value set_parameters sent, {'M665': {'L': 123.0}, ...}
+        self.exact = {}
+        self.cancelled = threading.Event()
+        self.running = True
+        self.reader = threading.Thread(target=self._read_loop)
+        self.reader.daemon = True
+        self.reader.start()
+        if reliable:
+            self.reset_line_number()
+
+    def _read_loop(self):
+        buffer = b''
+        while self.running:
+            try:
+                # Block for at most the port timeout, then take whatever else is already waiting
+                data = self.port.read(1)
+                if data:
+                    data = data + self.port.read(self.port.in_waiting)
+            except Exception as e:
+                if self.running:
+                    self._add_line('Error:Serial read failed: {0}'.format(e))
+                break
+            buffer = buffer + data
+            while b'\n' in buffer:
+                raw, buffer = buffer.split(b'\n', 1)
+                self._add_line(raw.decode('utf-8', 'replace').strip())
+
+    def _add_line(self, line):
+        if line == '':
+            return
+        if self.on_line is not None:
+            self.on_line(line)
+        line_type = classify_line(line)
+        with self.condition:
+            if line_type == OK:
+                # An ok nothing is waiting on is a stray one, ignore it
+                if self.acknowledged < self.sent:
+                    self.acknowledged += 1
+                if _temperature_re.search(line):
+                    self.temperature = line
+            elif line_type == TEMPERATURE:
+                self.temperature = line
+            elif line_type == RESEND:
+                self._resend(int(_resend_re.match(line).group(2)))
+            elif line_type == ERROR and self.reliable and ('checksum' in line.lower() or 'Line Number' in line):
+                # Transport errors are followed by a Resend:, nothing for the scripts to see
+                pass
+            elif line_type != BUSY:
+                self.events.append((line_type, line))
+                if len(self.events) > self.max_events:
+                    self._trim_events()
+                else:
+                    self.overfull = False
+            self.condition.notify_all()
+
+    # Drops the oldest untyped line. Typed lines are what the scripts wait for, when the queue is
+    # full of those nobody is reading them, that gets a warning (once until it drains) but no line is lost
+    def _trim_events(self):
+        for event in self.events:
+            if event[0] == OTHER:
+                self.events.remove(event)
+                self.discarded += 1
+                return
+        if not self.overfull:
+            self.overfull = True
+            console.warning('{0} lines queued and not read, keeping them all'.format(len(self.events)))
+
+    def _resend(self, number):
+        # The firmware drops the bad line and everything after it, then acks the error with its own ok
+        self.sent += 1
+        # Every line that was already on its way behind the bad one gets rejected as well, with
+        # another request for the same line. Those all come in before the replay is acknowledged
+        # and the replay already covers them, only requests after that are new errors.
+        if self.resending is not None and number >= self.resending and self.acknowledged < self.replay_acknowledged:
+            return
+        with self.write_lock:
+            replay = [line_number for line_number in self.history.keys() if line_number >= number]
+            for line_number in replay:
+                self.resends += 1
+                self.port.write((self.history[line_number] + '\n').encode())
+        # The oks still to come before the replayed line's: the error's and one per rejected line
+        self.resending = number
+        self.replay_acknowledged = self.acknowledged + len(replay) + 1
+
+    def reset_line_number(self):
+        with self.condition:
+            self.sent += 1
+        with self.write_lock:
+            self.line_number = 0
+            self.history.clear()
+            self.resending = None
+            self.port.write((frame_command(0, 'M110 N0') + '\n').encode())
+
+    def write(self, command):
+        if self.cancelled.is_set():
+            raise Cancelled('Cancelled before sending ' + command)
+        command = command.split(';')[0].strip()
+        if self.on_write is not None:
+            self.on_write(command)
+        if self.window is not None:
+            self._wait_window(command)
+        with self.condition:
+            self.sent += 1
+        with self.write_lock:
+            if self.reliable:
+                self.line_number += 1
+                command = frame_command(self.line_number, command)
+                self.history[self.line_number] = command
+                if len(self.history) > self.history_size:
+                    self.history.popitem(last=False)
+            self.port.write((command + '\n').encode())
+
+    def _wait_window(self, command):
+        if not self._wait_until(lambda: self.sent - self.acknowledged < self.window, deadline_in(self.timeout), 'before sending ' + command):
+            self._watchdog()
+
+    # Send M503 and update the settings mirror from its output. The report is complete once
+    # the M503 is acknowledged, so its lines are parsed in one go instead of waiting for a
+    # particular last line. Everything else the report holds (section headings, comments) is
+    # dropped with it, nothing of it is left queued for the next wait.
+    def read_state(self, deadline=None):
+        # Replies to earlier commands are all in once they're acknowledged, later events are the report's
+        self.wait_for_ok(deadline)
+        with self.condition:
+            earlier = len(self.events)
+        self.write('M503')
+        self.wait_for_ok(deadline)
+        with self.condition:
+            events = list(self.events)
+            self.events = collections.deque(events[:earlier])
+        self.state.parse([event[1] for event in events[earlier:] if event[0] == SETTINGS])
+        # A sent value the report doesn't round to has been changed by someone else since
+        for code, sent in self.exact.items():
+            for key in list(sent.keys()):
+                reported = self.state.get(code, key)
+                if reported is None or abs(reported - sent[key]) > report_rounding + 1e-9:
+                    del sent[key]
+        return self.state
+
+    # Send only the parameters that differ from the values sent before, all in one line. The
+    # mirror only holds the rounded M503 value of a parameter that wasn't sent yet, the printer
+    # may well hold something else (L123.0012 reads back as L123.00), so it is always sent.
+    # Returns the command that was sent, or None when nothing changed.
+    def set_parameters(self, code, **values):
+        sent = self.exact.setdefault(code, {})
+        changed = [(key, value) for key, value in sorted(values.items())
+                   if sent.get(key) is None or abs(float(value) - sent[key]) > 1e-6]
+        if not changed:
+            return None
+        command = code + ''.join(' {0}{1}'.format(key, value) for key, value in changed)
+        self.write(command)
+        current = self.state.parameters(code)
+        for key, value in changed:
+            sent[key] = float(value)
+            current[key] = float(value)
+        return command
+
+    # Take every queued event of the given types
+    def drain(self, types):
+        if not isinstance(types, (tuple, list)):
+            types = (types,)
+        with self.condition:
+            lines = [event[1] for event in self.events if event[0] in types]
+            self.events = collections.deque(event for event in self.events if event[0] not in types)
+        return lines
+
+    # Wait until ready() (checked holding the condition) is true, False when the deadline passes first
+    def _wait_until(self, ready, deadline, what):
+        with self.condition:
+            while not ready():
+                if self.cancelled.is_set():
+                    raise Cancelled('Cancelled ' + what)
+                remaining = 1.0 if deadline is None else min(1.0, deadline - time.time())
+                if remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+            return True
+
+    # Watchdog: forget the oks still owed, send M400 and wait for its ok. The printer works
+    # through its commands in order, so once the M400 is answered everything sent before it
+    # has been executed. Returns whether the printer answered.
+    def resync(self, timeout=None):
+        self.resyncs += 1
+        with self.condition:
+            self.acknowledged = self.sent
+        self.write('M400')
+        return self._wait_until(lambda: self.acknowledged >= self.sent, deadline_in(timeout or self.timeout), 'resyncing')
+
+    def _watchdog(self):
+        missing = self.sent - self.acknowledged
+        if not self.resync():
+            raise Timeout('No ok for {0} command(s) and no answer to M400'.format(missing))
+        console.warning('No ok for {0} command(s) in time, back in step after M400'.format(missing))
+
+    # Wait until every command sent so far has been acknowledged
+    # deadline: time.time() to give up at (default: the connection's timeout from now)
+    def wait_for_ok(self, deadline=None):
+        if deadline is None:
+            deadline = deadline_in(self.timeout)
+        if not self._wait_until(lambda: self.acknowledged >= self.sent, deadline, 'waiting for ok'):
+            self._watchdog()
+
+    # Wait for the next event of one of the given types, optionally containing a string.
+    # Events of those types that don't contain it are skipped, other types are left queued.
+    # Raises Timeout (after the watchdog resynced the stream) when the deadline passes.
+    def wait_for(self, types, contains=None, deadline=None):
+        if not isinstance(types, (tuple, list)):
+            types = (types,)
+        if deadline is None:
+            deadline = deadline_in(self.timeout)
+        found = []
+
+        def ready():
+            while True:
+                event = None
+                for queued in self.events:
+                    if queued[0] in types:
+                        event = queued
+                        break
+                if event is None:
+                    return False
+                self.events.remove(event)
+                if contains is None or contains in event[1]:
+                    found.append(event[1])
+                    return True
+
+        if self._wait_until(ready, deadline, 'waiting for {0}'.format('/'.join(types))):
+            return found[0]
+        what = '{0} line{1}'.format('/'.join(types), '' if contains is None else " with '" + contains + "'")
+        if not self.resync():
+            raise Timeout('No {0} in time and no answer to M400'.format(what))
+        raise Timeout('No {0} in time'.format(what))
+
+    # Stop whatever is using the connection at its next write or wait (from any thread)
+    def cancel(self):
+        with self.condition:
+            self.cancelled.set()
+            self.condition.notify_all()
+
+    # After a cancel the printer still works through what it had queued (up to a window of
+    # commands, probes in flight), their oks and probe lines would reach whoever uses the
+    # connection next. Wait for those oks, get back in step with M400 and drop every event that
+    # came in meanwhile. Returns False when the printer didn't answer.
+    def resume(self, timeout=None):
+        self.cancelled.clear()
+        try:
+            # The owed oks go first, an M400 sent right away would be answered by the first late one
+            self.wait_for_ok(deadline_in(timeout or self.timeout))
+            answered = self.resync(timeout)
+        except (Timeout, Cancelled):
+            answered = False
+            self.cancelled.clear()
+        with self.condition:
+            self.events.clear()
+        return answered
+
+    def close(self):
+        self.running = False
+        self.port.close()
+        self.reader.join(1.0)
@@ -0,0 +1,344 @@
+#!/usr/bin/python
+
+# Local calibration service
+#
+# Keeps the printer connection open and runs calibrations in this process on request, so an
+# OctoPrint plugin or a dashboard can start and watch them without a terminal, a new Python
+# process or reconnecting the serial port every time. One calibration runs at a time, the
+# scripts share the console, session log and tracer.
+#
+# JSON-RPC 2.0 over HTTP, POST /rpc:
+#   start(script, args)          script 'p5' (auto_cal_p5.py) or 'p2' (auto_cal.py), args: the
+#                                command line arguments of the script, -p is not needed
+#   status(job)                  state of a job (default: the last one)
+#   cancel(job)                  stop a running job at its next command or wait
+#   results(job)                 pass records and the final result
+#   events(job, since, timeout)  progress events after sequence number 'since', waits up to
+#                                'timeout' seconds for new ones (long polling)
+#
+# GET /events?job=<id>&since=<n> streams the same events as Server-Sent Events until the job ends.
+#
+# Progress events are the session, pass and result records the scripts write to their session
+# log, plus 'job' events for the state changes.
+#
+# python3 mpmd_service.py -p /dev/ttyACM0
+# curl -d '{"jsonrpc": "2.0", "id": 1, "method": "start", "params": {"script": "p5", "args": ["-ff", "1"]}}' http://127.0.0.1:8765/rpc
+
+import threading
+import argparse
+import json
+import time
+from mpmd_serial import PrinterConnection, Cancelled
+from mpmd_log import session, console, json_default
+from mpmd_trace import tracer
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+
+scripts = ['p5', 'p2']
+progress_kinds = ('session', 'pass', 'result')
+
+# JSON-RPC error codes
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
+SERVICE_ERROR = -32000
+
+
+class ServiceError(Exception):
+
+    def __init__(self, message, code=SERVICE_ERROR):
+        Exception.__init__(self, message)
+        self.code = code
+
+
+# Whether the script arguments ask for a dry run (-dr 1), read the way the scripts read them
+def is_dry_run(args):
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('-dr', '--dry-run', type=int, default=0)
+    try:
+        return parser.parse_known_args(args)[0].dry_run == 1
+    except SystemExit:
+        raise ServiceError('Invalid dry run argument in {0}'.format(' '.join(args)), INVALID_PARAMS)
+
+
+def run_script(script, argv, connection):
+    if script == 'p5':
+        import auto_cal_p5
+        auto_cal_p5.main(argv, connection)
+    else:
+        import auto_cal
+        auto_cal.MpmdAutomaticCalibration().calibrate(argv, connection)
+
+
+class CalibrationJob(object):
+
+    def __init__(self, number, script, args):
+        self.number = number
+        self.script = script
+        self.args = list(args)
+        self.state = 'running'
+        self.error = None
+        self.started = time.time()
+        self.finished = None
+        self.events = []
+        self.passes = []
+        self.result = None
+        self.cancel_requested = False
+        # Set once the script is done, the connection's own commands while resuming go through
+        self.script_done = False
+        self.thread = None
+
+    def status(self):
+        return {'job': self.number, 'script': self.script, 'args': self.args, 'state': self.state,
+                'error': self.error, 'started': self.started, 'finished': self.finished,
+                'passes': len(self.passes), 'events': len(self.events)}
+
+
+class CalibrationService(object):
+
+    # connection: the open PrinterConnection the jobs use, None allows dry runs only
+    def __init__(self, connection=None):
+        self.connection = connection
+        self.jobs = {}
+        self.job = None
+        self.condition = threading.Condition()
+        session.listeners.append(self._record)
+
+    def _event(self, job, kind, fields):
+        with self.condition:
+            fields = dict(fields, kind=kind, seq=len(job.events) + 1, job=job.number)
+            job.events.append(fields)
+            if kind == 'pass':
+                job.passes.append(fields)
+            elif kind == 'result':
+                job.result = fields
+            self.condition.notify_all()
+
+    # Session log listener, runs on the thread that made the record. Everything recorded while the
+    # script runs belongs to the job, whichever thread made it (the pass records come from the
+    # overlap worker in -ov mode, the received lines from the connection's reader).
+    def _record(self, fields):
+        job = self.job
+        if job is None or job.script_done:
+            return
+        if job.cancel_requested and fields['kind'] == 'send' and threading.current_thread() is job.thread:
+            # Stops dry runs too, they don't use the service's connection
+            raise Cancelled('Cancelled before sending ' + fields['command'])
+        if fields['kind'] in progress_kinds:
+            self._event(job, fields['kind'], fields)
+
+    def _run(self, job):
+        tracer.reset()
+        try:
+            run_script(job.script, job.args, self.connection)
+            state = 'finished'
+        except Cancelled:
+            state = 'cancelled'
+        except SystemExit as e:
+            # The scripts exit on calibration errors and bad arguments
+            state = 'failed' if e.code else 'finished'
+            job.error = None if not e.code else str(e.code)
+        except Exception as e:
+            state = 'failed'
+            job.error = '{0}: {1}'.format(type(e).__name__, e)
+        job.script_done = True
+        # Nothing from this job's commands may reach the next one
+        if self.connection is not None and not self.connection.resume():
+            console.warning('Job {0}: the printer did not answer after the job ended'.format(job.number))
+        job.finished = time.time()
+        job.state = 'cancelled' if job.cancel_requested else state
+        console.info('Job {0} {1}'.format(job.number, job.state))
+        self._event(job, 'job', {'state': job.state, 'error': job.error})
+
+    def _get_job(self, job=None):
+        if job is None:
+            if self.job is None:
+                raise ServiceError('No calibration has been started')
+            return self.job
+        if job not in self.jobs:
+            raise ServiceError('Unknown job {0}'.format(job), INVALID_PARAMS)
+        return self.jobs[job]
+
+    # RPC methods
+
+    def start(self, script='p5', args=None):
+        if script not in scripts:
+            raise ServiceError('Unknown script {0}, use one of {1}'.format(script, scripts), INVALID_PARAMS)
+        args = list(args or [])
+        if self.connection is None and not is_dry_run(args):
+            raise ServiceError('The service has no printer connection, only dry runs can be started')
+        with self.condition:
+            if self.job is not None and self.job.state == 'running':
+                raise ServiceError('Calibration job {0} is still running'.format(self.job.number))
+            job = CalibrationJob(len(self.jobs) + 1, script, args)
+            self.jobs[job.number] = job
+            self.job = job
+        job.thread = threading.Thread(target=self._run, args=(job,))
+        job.thread.daemon = True
+        self._event(job, 'job', {'state': 'running', 'script': script, 'args': args})
+        console.info('Job {0}: {1} {2}'.format(job.number, script, ' '.join(args)))
+        job.thread.start()
+        return job.status()
+
+    def status(self, job=None):
+        return self._get_job(job).status()
+
+    def cancel(self, job=None):
+        job = self._get_job(job)
+        if job.state == 'running':
+            job.cancel_requested = True
+            if self.connection is not None and not job.script_done:
+                self.connection.cancel()
+        return job.status()
+
+    def results(self, job=None):
+        job = self._get_job(job)
+        return {'job': job.number, 'state': job.state, 'error': job.error, 'passes': job.passes, 'result': job.result}
+
+    def events(self, job=None, since=0, timeout=10.0):
+        job = self._get_job(job)
+        deadline = time.time() + min(float(timeout), 60.0)
+        with self.condition:
+            while len(job.events) <= since and job.state == 'running' and time.time() < deadline:
+                self.condition.wait(deadline - time.time())
+            return {'job': job.number, 'state': job.state, 'events': job.events[since:]}
+
+    methods = ['start', 'status', 'cancel', 'results', 'events']
+
+    # One JSON-RPC request object, returns the response object (None for notifications)
+    def call(self, request):
+        if not isinstance(request, dict) or not isinstance(request.get('method'), str):
+            return {'jsonrpc': '2.0', 'id': None, 'error': {'code': INVALID_REQUEST, 'message': 'Invalid request'}}
+        request_id = request.get('id')
+        params = request.get('params') or {}
+        try:
+            if request['method'] not in self.methods:
+                raise ServiceError('Unknown method {0}'.format(request['method']), METHOD_NOT_FOUND)
+            method = getattr(self, request['method'])
+            try:
+                result = method(*params) if isinstance(params, list) else method(**params)
+            except TypeError as e:
+                raise ServiceError(str(e), INVALID_PARAMS)
+            response = {'jsonrpc': '2.0', 'id': request_id, 'result': result}
+        except ServiceError as e:
+            response = {'jsonrpc': '2.0', 'id': request_id, 'error': {'code': e.code, 'message': str(e)}}
+        return response if 'id' in request else None
+
+
+class ServiceRequestHandler(BaseHTTPRequestHandler):
+
+    def _send(self, status, body, content_type='application/json'):
+        data = body.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        if urlparse(self.path).path != '/rpc':
+            self._send(404, json.dumps({'error': 'Not found'}))
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode())
+        except ValueError:
+            self._send(200, json.dumps({'jsonrpc': '2.0', 'id': None, 'error': {'code': PARSE_ERROR, 'message': 'Parse error'}}))
+            return
+        service = self.server.service
+        if isinstance(request, list):
+            response = [r for r in (service.call(item) for item in request) if r is not None]
+        else:
+            response = service.call(request)
+        if response is None or response == []:
+            self._send(204, '')
+        else:
+            self._send(200, json.dumps(response, default=json_default))
+
+    # Server-Sent Events stream of a job's progress
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path != '/events':
+            self._send(404, json.dumps({'error': 'Not found'}))
+            return
+        query = parse_qs(url.query)
+        try:
+            job = int(query['job'][0]) if 'job' in query else None
+            since = int(query.get('since', ['0'])[0])
+            self.server.service.status(job)
+        except (ValueError, ServiceError) as e:
+            self._send(400, json.dumps({'error': str(e)}))
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        try:
+            while True:
+                update = self.server.service.events(job, since, 15.0)
+                for event in update['events']:
+                    self.wfile.write('id: {0}\nevent: {1}\ndata: {2}\n\n'.format(
+                        event['seq'], event['kind'], json.dumps(event, default=json_default)).encode())
+                since += len(update['events'])
+                if update['state'] != 'running' and not update['events']:
+                    break
+                if not update['events']:
+                    # Keep idle connections from timing out
+                    self.wfile.write(b': keep-alive\n\n')
+                self.wfile.flush()
+        except (IOError, OSError):
+            # The client went away
+            pass
+
+    def log_message(self, format, *args):
+        console.debug('HTTP ' + format % args)
+
+
+class ServiceServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, service):
+        HTTPServer.__init__(self, address, ServiceRequestHandler)
+        self.service = service
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local calibration service for Monoprice Mini Delta')
+    parser.add_argument('-p', '--port', help='Serial port or socket:// / rfc2217:// URL (without it only dry runs can be started)')
+    parser.add_argument('-br', '--baud-rates', type=int, nargs='+', default=[115200], help='Baudrate, or several to use the fastest one the printer answers at (e.g. 250000 115200)')
+    parser.add_argument('-pl', '--pipeline', type=int, default=4, help='Commands sent ahead of the printer\'s acknowledgements (1 = lockstep; 4 = Marlin\'s default command buffer)')
+    parser.add_argument('-rt', '--reliable-transport', type=int, default=0, help='Send line numbers and checksums and resend lines the printer rejects (0 = off; 1 = on)')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='Address to listen on, keep it local unless the network is trusted')
+    parser.add_argument('--http-port', type=int, default=8765, help='HTTP port to listen on')
+    parser.add_argument('--console-level', type=str, default='info', choices=['debug', 'info', 'warning'], help='Console verbosity')
+    args = parser.parse_args()
+    console.configure(args.console_level, 50)
+
+    connection = None
+    if args.port:
+        from auto_cal import MpmdConnection
+        serial_port = MpmdConnection.establishSerialConnection(args.port, speeds=args.baud_rates)
+        connection = PrinterConnection(serial_port, reliable=args.reliable_transport == 1, on_line=session.received, on_write=session.sent,
+                                       window=args.pipeline)
+
+    server = ServiceServer((args.host, args.http_port), CalibrationService(connection))
+    console.info('Calibration service listening on http://{0}:{1}/rpc'.format(args.host, args.http_port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if connection is not None:
+            connection.close()
+
+
+if __name__ == '__main__':
+    main()
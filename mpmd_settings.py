@@ -0,0 +1,127 @@
+#!/usr/bin/python
+
+# M503 settings parser and printer settings model shared by the calibration scripts
+#
+# Handles the stock firmware and Marlin report styles alike: with or without 'echo:' prefixes
+# (M503 / M503 S0), comment and header lines, trailing ';' comments, parameter-less flags and
+# indexed codes such as the M145 material presets. Lines that don't parse are skipped, the
+# report ends at the 'ok' that acknowledges the M503.
+
+import re
+
+_code_re = re.compile(r'^([GM]\d+)$')
+_number_re = re.compile(r'^[-+]?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?$')
+
+# Codes reported once per index (the index parameter is part of the key)
+indexed_codes = {'M145': 'S', 'M301': 'E'}
+
+
+# 'echo:  M665 L123.00 R63.50' -> ('M665', {'L': 123.0, 'R': 63.5}), None for anything else
+def parse_settings_line(line):
+    line = line.strip()
+    while line.startswith('echo:'):
+        line = line[5:].strip()
+    line = line.split(';')[0]
+    words = line.split()
+    if not words:
+        return None
+    code = words[0].upper()
+    if not _code_re.match(code):
+        return None
+    values = {}
+    for word in words[1:]:
+        letter = word[0].upper()
+        if not letter.isalpha():
+            continue
+        if len(word) == 1:
+            # Flag without a value
+            values[letter] = None
+        elif _number_re.match(word[1:]):
+            values[letter] = float(word[1:])
+    return code, values
+
+
+class PrinterSettings(object):
+
+    def __init__(self):
+        # {'M665': {'L': 123.0, 'R': 63.5, ...}, 'M145 S0': {...}, ...}
+        self.codes = {}
+
+    def key(self, code, values):
+        index = indexed_codes.get(code)
+        if index is not None and values.get(index) is not None:
+            return '{0} {1}{2:g}'.format(code, index, values[index])
+        return code
+
+    def update(self, code, values):
+        self.codes.setdefault(self.key(code, values), {}).update(values)
+
+    def get(self, code, letter, default=None):
+        value = self.codes.get(code, {}).get(letter)
+        return default if value is None else value
+
+    # Parameters of a code, for comparing and updating in place
+    def parameters(self, code):
+        return self.codes.setdefault(code, {})
+
+    # Feed the lines of an M503 report, stops at the ok. Returns the number of settings lines used.
+    def parse(self, lines):
+        used = 0
+        for line in lines:
+            if line.strip().startswith('ok'):
+                break
+            parsed = parse_settings_line(line)
+            if parsed is None:
+                continue
+            code, values = parsed
+            if code.startswith('M'):
+                self.update(code, values)
+                used += 1
+        return used
+
+    # Commonly used values
+    @property
+    def steps_per_unit(self):
+        return tuple(self.get('M92', axis) for axis in 'XYZE')
+
+    @property
+    def endstop_adjustments(self):
+        return tuple(self.get('M666', axis) for axis in 'XYZ')
+
+    @property
+    def diagonal_rod(self):
+        return self.get('M665', 'L')
+
+    @property
+    def delta_radius(self):
+        return self.get('M665', 'R')
+
+    @property
+    def delta_height(self):
+        return self.get('M665', 'H')
+
+    @property
+    def segments_per_second(self):
+        return self.get('M665', 'S')
+
+    @property
+    def calibration_radius(self):
+        return self.get('M665', 'B')
+
+    @property
+    def tower_angles(self):
+        return tuple(self.get('M665', axis) for axis in 'XYZ')
+
+    @property
+    def home_offsets(self):
+        return tuple(self.get('M206', axis) for axis in 'XYZ')
+
+    @property
+    def probe_offsets(self):
+        return tuple(self.get('M851', axis) for axis in 'XYZ')
+
+
+def parse_settings(lines):
+    settings = PrinterSettings()
+    settings.parse(lines)
+    return settings
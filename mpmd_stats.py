@@ -0,0 +1,55 @@
+#!/usr/bin/python
+
+# Quantiles for the statistical stopping rule (-sc) shared by the calibration scripts
+#
+# Plain math, so auto_cal.py keeps running on Python 2.7 (statistics.NormalDist needs 3.8).
+# The tap noise is estimated from a handful of double tap differences, with that few samples
+# the normal z-score makes the intervals too narrow, Student's t for that many degrees of
+# freedom is used instead.
+
+import math
+
+# Acklam's rational approximation of the inverse normal CDF (relative error below 1.2e-9)
+_a = [-3.969683028665376e+01, 2.209460984245205e+02, -2.759285104469687e+02, 1.383577518672690e+02, -3.066479806614716e+01, 2.506628277459239e+00]
+_b = [-5.447609879822406e+01, 1.615858368580409e+02, -1.556989798598866e+02, 6.680131188771972e+01, -1.328068155288572e+01]
+_c = [-7.784894002430293e-03, -3.223964580411365e-01, -2.400758277161838e+00, -2.549732539343734e+00, 4.374664141464968e+00, 2.938163982698783e+00]
+_d = [7.784695709041462e-03, 3.224671290700398e-01, 2.445134137142996e+00, 3.754408661907416e+00]
+_tail = 0.02425
+
+
+def normal_quantile(p):
+    if p <= 0.0 or p >= 1.0:
+        raise ValueError('Quantile of {0}, it has to be between 0 and 1'.format(p))
+    if p > 1.0 - _tail:
+        return -normal_quantile(1.0 - p)
+    if p < _tail:
+        q = math.sqrt(-2.0*math.log(p))
+        return (((((_c[0]*q + _c[1])*q + _c[2])*q + _c[3])*q + _c[4])*q + _c[5]) / ((((_d[0]*q + _d[1])*q + _d[2])*q + _d[3])*q + 1.0)
+    q = p - 0.5
+    r = q*q
+    return (((((_a[0]*r + _a[1])*r + _a[2])*r + _a[3])*r + _a[4])*r + _a[5])*q / (((((_b[0]*r + _b[1])*r + _b[2])*r + _b[3])*r + _b[4])*r + 1.0)
+
+
+# Student's t: exact for 1 and 2 degrees of freedom, the Cornish-Fisher expansion around the
+# normal quantile above that (within 0.5% up to p = 0.995 at 3 degrees of freedom)
+def t_quantile(p, dof):
+    if dof == 1:
+        return math.tan(math.pi*(p - 0.5))
+    if dof == 2:
+        return (2.0*p - 1.0)/math.sqrt(2.0*p*(1.0 - p))
+    z = normal_quantile(p)
+    n = float(dof)
+    g1 = (z**3 + z)/4.0
+    g2 = (5.0*z**5 + 16.0*z**3 + 3.0*z)/96.0
+    g3 = (3.0*z**7 + 19.0*z**5 + 17.0*z**3 - 15.0*z)/384.0
+    g4 = (79.0*z**9 + 776.0*z**7 + 1482.0*z**5 - 1920.0*z**3 - 945.0*z)/92160.0
+    return z + g1/n + g2/n**2 + g3/n**3 + g4/n**4
+
+
+# Half width of a two sided confidence interval in standard errors. dof: the samples the
+# standard deviation was estimated from (None when it is known, the normal z-score)
+def confidence_zscore(confidence, dof=None):
+    p = 0.5 + confidence/2.0
+    if dof is None:
+        return normal_quantile(p)
+    return t_quantile(p, max(1, int(dof)))
@@ -0,0 +1,301 @@
+#!/usr/bin/python
+
+# Monte Carlo study of the calibration rules
+#
+# Samples virtual printers (endstop, delta radius, diagonal rod and tower angle errors plus tap
+# noise) and runs the update rule of each calibration script against the delta forward model of
+# auto_cal_p5.py, pass by pass the way the script would on that printer: probe (two taps per point,
+# reported to 0.001 like the firmware does), work out the errors, update M666/M665, repeat until
+# calibrated, aborted or out of runs. Reports how many passes each rule needs and how flat the bed
+# ends up, so the max_runs/max_error defaults can be chosen from data.
+#
+#   p2  auto_cal.py     G29 P2 (X, Y, Z towers and center), the error is added to the endstop,
+#                       halved from max_runs/2 on, R moves 2x the center error
+#   v2  auto_cal_v2.py  the same points and update, then the endstops are shifted so the
+#                       smallest adjustment is 0
+#
+# auto_cal_v2.py takes the first G29 P2 point for the Z tower where auto_cal.py (and the simulated
+# printer) have the X tower, v2 is run with the auto_cal.py order to compare the update rules
+# themselves. -ru v2-zxy runs it with the order as written.
+#   p5  auto_cal_p5.py  G29 P5 and Dennis Brown's spreadsheet contour, the high tower goes to 0,
+#                       R moves 4x the bowl error and L 1.5x R
+#
+# max_error is what -me means to each script: the convergence threshold of auto_cal.py, the limit
+# a non-first pass error may not exceed (abort) in auto_cal_v2.py and auto_cal_p5.py.
+#
+# Every rule starts from the same firmware values and sees the same printers. The printers are
+# spread over a process pool, one task per printer and setting.
+#
+# python3 mpmd_study.py -n 2000
+# python3 mpmd_study.py -n 500 -ru p5 -mr 6 10 14 --json study.json
+
+import multiprocessing
+import argparse
+import json
+import time
+import numpy as np
+from auto_cal_p5 import delta_probe_heights, calculate_contour, square_grid, new_probe_table
+from mpmd_dryrun import g29_p2_points
+from mpmd_log import console
+
+rules = ['p2', 'v2', 'p5', 'v2-zxy']
+# -mr / -me defaults of the scripts
+default_max_runs = {'p2': 15, 'v2': 14, 'p5': 14, 'v2-zxy': 14}
+default_max_error = {'p2': 0.02, 'v2': 1.0, 'p5': 1.0, 'v2-zxy': 1.0}
+# Fixed convergence threshold of auto_cal_v2.py and auto_cal_p5.py
+threshold = 0.02
+
+p2_points = np.array(g29_p2_points)
+p5_points = np.array(square_grid(5))
+
+
+# Virtual printers: the true geometry (same keys as the firmware values) and the tap noise
+def sample_printers(count, start, seed=0, endstop_sd=0.3, radius_sd=0.5, rod_sd=0.5, angle_sd=0.3, noise=0.005):
+    rng = np.random.default_rng(seed)
+    printers = []
+    for ii in range(count):
+        actual = dict(start)
+        for key in ['x', 'y', 'z']:
+            actual[key] = start[key] + float(rng.normal(0.0, endstop_sd))
+        actual['r'] = start['r'] + float(rng.normal(0.0, radius_sd))
+        actual['l'] = start['l'] + float(rng.normal(0.0, rod_sd))
+        for key in ['ax', 'ay']:
+            actual[key] = start[key] + float(rng.normal(0.0, angle_sd))
+        # Some probes repeat better than others
+        printers.append({'number': ii, 'actual': actual, 'noise': noise*float(rng.uniform(0.5, 1.5)),
+                         'seed': int(rng.integers(2**31))})
+    return printers
+
+
+class VirtualPrinter(object):
+
+    def __init__(self, actual, noise, start, seed):
+        self.actual = actual
+        self.noise = noise
+        self.firmware = dict(start)
+        self.rng = np.random.default_rng(seed)
+        self.taps = 0
+
+    # Two taps per point as reported by the printer (3 decimals)
+    def probe(self, points):
+        heights = delta_probe_heights(points[:, 0], points[:, 1], self.firmware, self.actual, 0)
+        self.taps += 2*len(points)
+        taps = heights[:, None] + self.rng.normal(0.0, self.noise, (len(points), 2))
+        return np.round(taps, 3)
+
+    def set_values(self, **values):
+        self.firmware.update(values)
+
+    # Peak to valley and rms of the noise free bed heights over the P5 grid, the flatness a print sees
+    def flatness(self):
+        heights = delta_probe_heights(p5_points[:, 0], p5_points[:, 1], self.firmware, self.actual, 0)
+        heights = heights - np.mean(heights)
+        return float(np.max(heights) - np.min(heights)), float(np.sqrt(np.mean(heights**2)))
+
+
+def tap_averages(taps):
+    return [float("{0:.3f}".format((z1 + z2) / 2)) for z1, z2 in taps]
+
+
+# Errors of auto_cal.py / auto_cal_v2.py determine_error, axis averages in X, Y, Z order
+def p2_errors(x_avg, y_avg, z_avg, c_avg):
+    max_average = max([x_avg, y_avg, z_avg])
+    x_error = float("{0:.4f}".format(x_avg - max_average))
+    y_error = float("{0:.4f}".format(y_avg - max_average))
+    z_error = float("{0:.4f}".format(z_avg - max_average))
+    c_error = float("{0:.4f}".format(c_avg - ((x_avg + y_avg + z_avg) / 3)))
+    return x_error, y_error, z_error, c_error
+
+
+def halved(error, trial, runs, max_runs):
+    return error + trial if runs < (max_runs / 2) else (error / 2) + trial
+
+
+# auto_cal.py runCalibrationLoop, returns (outcome, passes)
+def run_p2(printer, max_runs, max_error):
+    for runs in range(1, max_runs + 1):
+        x_avg, y_avg, z_avg, c_avg = tap_averages(printer.probe(p2_points))
+        errors = p2_errors(x_avg, y_avg, z_avg, c_avg)
+        if all(abs(error) < max_error for error in errors):
+            return 'calibrated', runs
+        fw = printer.firmware
+        x_error, y_error, z_error, c_error = errors
+        new = {}
+        for key, error in (('x', x_error), ('y', y_error), ('z', z_error)):
+            new[key] = halved(error, fw[key], runs, max_runs) if abs(error) >= max_error else fw[key]
+        new['r'] = float("{0:.4f}".format(fw['r'] + c_error / -0.5)) if abs(c_error) >= max_error else fw['r']
+        printer.set_values(**new)
+    return 'max_runs', max_runs
+
+
+# auto_cal_v2.py run_calibration, zxy: read the points in the script's Z, X, Y, center order
+def run_v2(printer, max_runs, max_error, zxy=False):
+    for runs in range(1, max_runs + 1):
+        averages = tap_averages(printer.probe(p2_points))
+        if zxy:
+            z_avg, x_avg, y_avg, c_avg = averages
+        else:
+            x_avg, y_avg, z_avg, c_avg = averages
+        x_error, y_error, z_error, c_error = p2_errors(x_avg, y_avg, z_avg, c_avg)
+        if abs(max([z_error, x_error, y_error, c_error], key=abs)) > max_error and runs > 1:
+            return 'aborted', runs
+        if all(abs(error) < threshold for error in (x_error, y_error, z_error, c_error)):
+            return 'calibrated', runs
+        fw = printer.firmware
+        new = {}
+        for key, error in (('z', z_error), ('x', x_error), ('y', y_error)):
+            new[key] = float("{0:.4f}".format(halved(error, fw[key], runs, max_runs))) if abs(error) >= threshold else fw[key]
+        new['r'] = float("{0:.4f}".format(fw['r'] + c_error / -0.5)) if abs(c_error) >= threshold else fw['r']
+        # Same loop as the script, including how it picks the value to shift by
+        diff = 100
+        for value in [new['z'], new['x'], new['y']]:
+            if abs(0 - value) < diff:
+                diff = 0 - value
+        for key in ['z', 'x', 'y']:
+            new[key] += diff
+        printer.set_values(**new)
+    return 'max_runs', max_runs
+
+
+# auto_cal_p5.py run_calibration with the stock firmware defaults (-im 0 -tf 0 -cm 0)
+def run_p5(printer, max_runs, max_error, minterp=0):
+    xhigh = [0]*2
+    yhigh = [0]*2
+    zhigh = [0]*2
+    table = new_probe_table(p5_points.tolist())
+    for runs in range(1, max_runs + 1):
+        taps = printer.probe(p5_points)
+        table['z1'] = taps[:, 0]
+        table['z2'] = taps[:, 1]
+        table['z_avg'] = np.round((table['z1'] + table['z2']) / 2.0, 4)
+        table['dtap'] = table['z2'] - table['z1']
+        table['dz'] = table['z_avg'] - np.median(table['z_avg'])
+        TX, TY, TZ, THigh, BowlCenter, BowlOR, xhigh, yhigh, zhigh, iHighTower = calculate_contour(table, runs, xhigh, yhigh, zhigh, minterp, 0)
+        z_error = float("{0:.4f}".format(TZ - THigh))
+        x_error = float("{0:.4f}".format(TX - THigh))
+        y_error = float("{0:.4f}".format(TY - THigh))
+        c_error = float("{0:.4f}".format(BowlCenter - BowlOR))
+        if abs(max([z_error, x_error, y_error, c_error], key=abs)) > max_error and runs > 1:
+            return 'aborted', runs
+        if all(abs(error) < threshold for error in (x_error, y_error, z_error, c_error)):
+            return 'calibrated', runs
+        fw = printer.firmware
+        new = {}
+        for key, error, tower in (('z', z_error, 2), ('x', x_error, 0), ('y', y_error, 1)):
+            if abs(error) < threshold:
+                new[key] = fw[key]
+            else:
+                new[key] = float("{0:.4f}".format(0.0 if iHighTower == tower else error + fw[key]))
+        new['r'] = float("{0:.4f}".format(fw['r'] - 4.0*c_error)) if abs(c_error) >= threshold else fw['r']
+        new['l'] = float("{0:.4f}".format(1.5*(new['r'] - fw['r']) + fw['l']))
+        printer.set_values(**new)
+    return 'max_runs', max_runs
+
+
+rule_runners = {'p2': run_p2, 'v2': run_v2, 'p5': run_p5,
+                'v2-zxy': lambda printer, max_runs, max_error: run_v2(printer, max_runs, max_error, zxy=True)}
+
+
+# Worker: one printer under one rule and setting
+def run_trial(job):
+    rule, max_runs, max_error, printer, start = job
+    virtual = VirtualPrinter(printer['actual'], printer['noise'], start, printer['seed'])
+    initial = virtual.flatness()
+    try:
+        outcome, passes = rule_runners[rule](virtual, max_runs, max_error)
+    except (ValueError, FloatingPointError):
+        # Geometry the forward model can't reach (or the contour can't interpolate)
+        outcome, passes = 'error', 0
+    peak, rms = virtual.flatness()
+    return {'rule': rule, 'max_runs': max_runs, 'max_error': max_error, 'printer': printer['number'], 'noise': printer['noise'],
+            'outcome': outcome, 'passes': passes, 'taps': virtual.taps, 'initial': initial[0], 'peak': peak, 'rms': rms,
+            'firmware': virtual.firmware}
+
+
+def percentiles(values, levels=(50, 90, 99)):
+    if len(values) == 0:
+        return [float('nan')]*(len(levels) + 1)
+    return [float(np.percentile(values, level)) for level in levels] + [float(np.max(values))]
+
+
+# Summary per rule and setting: outcomes, pass count and final flatness distributions
+def summarize(results):
+    summary = []
+    keys = sorted(set((r['rule'], r['max_runs'], r['max_error']) for r in results), key=lambda k: (rules.index(k[0]), k[1], k[2]))
+    for rule, max_runs, max_error in keys:
+        group = [r for r in results if (r['rule'], r['max_runs'], r['max_error']) == (rule, max_runs, max_error)]
+        outcomes = dict((outcome, sum(1 for r in group if r['outcome'] == outcome)) for outcome in ['calibrated', 'max_runs', 'aborted', 'error'])
+        passes = np.array([r['passes'] for r in group if r['outcome'] != 'error'])
+        peak = np.array([r['peak'] for r in group if r['outcome'] != 'error'])
+        summary.append({'rule': rule, 'max_runs': max_runs, 'max_error': max_error, 'printers': len(group), 'outcomes': outcomes,
+                        'passes_mean': float(np.mean(passes)) if len(passes) else float('nan'),
+                        'passes': percentiles(passes), 'pass_histogram': np.bincount(passes, minlength=max_runs + 1)[1:].tolist() if len(passes) else [],
+                        'peak': percentiles(peak), 'within_0.05': float(np.mean(peak < 0.05)) if len(peak) else float('nan')})
+    return summary
+
+
+def print_summary(summary):
+    console.info('{0:<6} {1:>3} {2:>6} {3:>6} {4:>6} {5:>6} {6:>6}   {7:>5} {8:>5} {9:>5}   {10:>6} {11:>6} {12:>6} {13:>6} {14:>6}'.format(
+        'rule', 'mr', 'me', 'cal %', 'out %', 'abrt %', 'err %', 'mean', 'p50', 'p90', 'p50', 'p90', 'p99', 'max', '<0.05'))
+    console.info('{0:<25}{1:>25}   {2:>34}'.format('', 'passes', 'final peak to valley (mm)'))
+    for entry in summary:
+        count = float(entry['printers'])
+        outcomes = entry['outcomes']
+        console.info('{0:<6} {1:>3} {2:>6g} {3:>6.1f} {4:>6.1f} {5:>6.1f} {6:>6.1f}   {7:>5.1f} {8:>5.0f} {9:>5.0f}   {10:>6.3f} {11:>6.3f} {12:>6.3f} {13:>6.3f} {14:>5.0f}%'.format(
+            entry['rule'], entry['max_runs'], entry['max_error'], 100*outcomes['calibrated']/count, 100*outcomes['max_runs']/count,
+            100*outcomes['aborted']/count, 100*outcomes['error']/count, entry['passes_mean'], entry['passes'][0], entry['passes'][1],
+            entry['peak'][0], entry['peak'][1], entry['peak'][2], entry['peak'][3], 100*entry['within_0.05']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Monte Carlo study of the calibration rules on virtual printers')
+    parser.add_argument('-n', '--printers', type=int, default=1000, help='Number of virtual printers')
+    parser.add_argument('-ru', '--rules', type=str, nargs='+', default=rules[:3], choices=rules, help='Rules to compare')
+    parser.add_argument('-mr', '--max-runs', type=int, nargs='+', default=None, help='max_runs settings to try (default: each script\'s own)')
+    parser.add_argument('-me', '--max-error', type=float, nargs='+', default=None, help='max_error settings to try (default: each script\'s own)')
+    parser.add_argument('-r', '--r-value', type=float, default=63.5, help='Starting r-value, also the nominal radius of the printers')
+    parser.add_argument('-l', '--l-value', type=float, default=123.0, help='Starting l-value, also the nominal rod length of the printers')
+    parser.add_argument('--endstop-sd', type=float, default=0.3, help='Standard deviation of the endstop errors (mm)')
+    parser.add_argument('--radius-sd', type=float, default=0.5, help='Standard deviation of the delta radius error (mm)')
+    parser.add_argument('--rod-sd', type=float, default=0.5, help='Standard deviation of the diagonal rod error (mm)')
+    parser.add_argument('--angle-sd', type=float, default=0.3, help='Standard deviation of the X and Y tower angle errors (degrees)')
+    parser.add_argument('--noise', type=float, default=0.005, help='Typical tap noise (mm), every printer gets 0.5x to 1.5x this')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed, the same seed samples the same printers')
+    parser.add_argument('-w', '--workers', type=int, default=None, help='Worker processes (default: one per core)')
+    parser.add_argument('--json', type=str, default=None, help='Write the summary and every trial to this file')
+    args = parser.parse_args()
+
+    start = {'x': 0.0, 'y': 0.0, 'z': 0.0, 'r': args.r_value, 'l': args.l_value, 'ax': 0.0, 'ay': 0.0, 'az': 0.0}
+    printers = sample_printers(args.printers, start, args.seed, args.endstop_sd, args.radius_sd, args.rod_sd, args.angle_sd, args.noise)
+    jobs = []
+    for rule in args.rules:
+        for max_runs in (args.max_runs or [default_max_runs[rule]]):
+            for max_error in (args.max_error or [default_max_error[rule]]):
+                jobs.extend((rule, max_runs, max_error, printer, start) for printer in printers)
+
+    started = time.time()
+    pool = multiprocessing.Pool(args.workers)
+    try:
+        results = []
+        for result in pool.imap_unordered(run_trial, jobs, chunksize=max(1, len(jobs) // (8*(args.workers or multiprocessing.cpu_count())))):
+            results.append(result)
+            if len(results) % 1000 == 0:
+                console.info('{0} of {1} trials'.format(len(results), len(jobs)))
+    finally:
+        pool.close()
+        pool.join()
+    console.info('{0} trials in {1:.1f} s\n'.format(len(results), time.time() - started))
+
+    summary = summarize(results)
+    print_summary(summary)
+    initial = np.array([r['initial'] for r in results])
+    console.info('\nPeak to valley before calibrating: median {0:.3f}, p90 {1:.3f}'.format(float(np.median(initial)), float(np.percentile(initial, 90))))
+    if args.json:
+        results.sort(key=lambda r: (rules.index(r['rule']), r['max_runs'], r['max_error'], r['printer']))
+        with open(args.json, 'w') as study_file:
+            json.dump({'settings': vars(args), 'summary': summary, 'trials': results}, study_file)
+        console.info('Wrote {0}'.format(args.json))
+
+
+if __name__ == '__main__':
+    main()
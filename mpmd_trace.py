@@ -0,0 +1,176 @@
+#!/usr/bin/python
+
+# Session timeline shared by the calibration scripts
+#
+# Phases (homing, heating, probing, host compute, config pushes) and passes are recorded as
+# nested spans and written in the Chrome trace event format, so a whole session can be opened
+# in chrome://tracing or https://ui.perfetto.dev to see where the time goes.
+#
+# The module level tracer does nothing until enable() is called, so the spans can stay in the
+# code for normal runs.
+#
+# A HostProfiler attached to the tracer only runs inside 'compute' spans, so the profile shows
+# the host side analysis without the time spent waiting on the printer.
+
+import threading
+import time
+import json
+import os
+import sys
+import cProfile
+import pstats
+import collections
+from contextlib import contextmanager
+
+
+class HostProfiler(object):
+
+    # interval: seconds between stack samples for the collapsed stack (flame graph) output
+    def __init__(self, interval=0.001):
+        self.profile = cProfile.Profile()
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.depth = 0
+        self.thread_id = None
+        self.sampling = threading.Event()
+        self.running = True
+        self.sampler = threading.Thread(target=self._sample_loop)
+        self.sampler.daemon = True
+        self.sampler.start()
+
+    # Compute spans can nest, only the outermost one switches the profiler
+    def resume(self):
+        self.depth += 1
+        if self.depth == 1:
+            self.thread_id = threading.current_thread().ident
+            self.profile.enable()
+            self.sampling.set()
+
+    def pause(self):
+        self.depth -= 1
+        if self.depth == 0:
+            self.sampling.clear()
+            self.profile.disable()
+
+    def _sample_loop(self):
+        while self.running:
+            self.sampling.wait(0.5)
+            if not self.sampling.is_set():
+                continue
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('{0}:{1}'.format(os.path.basename(code.co_filename), code.co_name))
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+            time.sleep(self.interval)
+
+    # Writes <prefix>.prof (cProfile stats, e.g. for snakeviz) and <prefix>.folded
+    # (collapsed stacks, one 'frame;frame;frame count' per line, for flamegraph.pl or speedscope)
+    def save(self, prefix):
+        self.running = False
+        self.sampling.set()
+        self.sampler.join(1.0)
+        self.profile.dump_stats(prefix + '.prof')
+        with open(prefix + '.folded', 'w') as folded_file:
+            for stack, count in sorted(self.stacks.items()):
+                folded_file.write('{0} {1}\n'.format(stack, count))
+
+    def print_stats(self, limit=15):
+        try:
+            pstats.Stats(self.profile).sort_stats('cumulative').print_stats(limit)
+        except TypeError:
+            # Nothing was profiled
+            print('No host computation was profiled')
+
+
+class Tracer(object):
+
+    def __init__(self):
+        self.enabled = False
+        self.events = []
+        self.lock = threading.Lock()
+        self.clock = time.time
+        self.start = self.clock()
+        self.profiler = None
+
+    # clock: function returning seconds, a dry run passes its simulated printer clock
+    def enable(self, clock=None):
+        self.enabled = True
+        self.events = []
+        if clock is not None:
+            self.clock = clock
+        self.start = self.clock()
+
+    # Back to the initial state, for several sessions in one process (mpmd_service)
+    def reset(self):
+        self.enabled = False
+        self.events = []
+        self.clock = time.time
+        self.profiler = None
+
+    def _event(self, phase, name, cat, args=None):
+        # Trace timestamps are in microseconds
+        event = {'name': name, 'cat': cat, 'ph': phase, 'ts': (self.clock() - self.start)*1e6,
+                 'pid': os.getpid(), 'tid': threading.current_thread().ident}
+        if args:
+            event['args'] = args
+        with self.lock:
+            self.events.append(event)
+
+    # Begin and end have to be paired on the same thread, spans nest by time
+    # cat: 'printer' for phases spent waiting on the printer, 'compute' for host computation
+    def begin(self, name, cat='printer', **args):
+        if self.enabled:
+            self._event('B', name, cat, args)
+        if self.profiler is not None and cat == 'compute':
+            self.profiler.resume()
+
+    def end(self, name, cat='printer', **args):
+        if self.profiler is not None and cat == 'compute':
+            self.profiler.pause()
+        if self.enabled:
+            self._event('E', name, cat, args)
+
+    # Single point in time, e.g. the calibration finishing
+    def instant(self, name, cat='printer', **args):
+        if self.enabled:
+            self._event('i', name, cat, args)
+
+    @contextmanager
+    def span(self, name, cat='printer', **args):
+        self.begin(name, cat, **args)
+        try:
+            yield
+        finally:
+            self.end(name, cat)
+
+    # Total seconds and count per span name, numbered spans ('pass 0', 'run 1') are added up together
+    # cat: only count spans of this category
+    def phase_totals(self, cat=None):
+        with self.lock:
+            events = list(self.events)
+        totals = collections.OrderedDict()
+        open_spans = []
+        for event in events:
+            if event['ph'] == 'B':
+                open_spans.append(event)
+            elif event['ph'] == 'E' and open_spans:
+                begin = open_spans.pop()
+                if cat is not None and begin['cat'] != cat:
+                    continue
+                name = begin['name'].rstrip('0123456789 ')
+                count, seconds = totals.get(name, (0, 0.0))
+                totals[name] = (count + 1, seconds + (event['ts'] - begin['ts'])/1e6)
+        return totals
+
+    def save(self, filename):
+        with self.lock:
+            events = list(self.events)
+        with open(filename, 'w') as trace_file:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, trace_file)
+
+
+tracer = Tracer()
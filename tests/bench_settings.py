@@ -0,0 +1,116 @@
+#!/usr/bin/python
+
+# Benchmark and fuzz harness of the M503 parser (mpmd_settings) over the synthetic reports in
+# tests/fixtures, stock firmware (M503 and M503 S0) and Marlin 1.1 / 2 alike. They are written in
+# each firmware's layout with the same made up values, not captured from real printers.
+#
+# Timing: parses every report over and over and prints the time per report and per line.
+# Fuzzing: mutates report lines (cut off, garbled characters, prefixes and comments added or
+# removed, line endings) and mixes the other lines a printer sends into a report (temperature
+# reports, busy keep-alives, section headings). parse_settings_line may reject a mutated line
+# but must never raise, and the noise lines must not change the settings of a clean report.
+# test_settings.py runs a short fuzz with a fixed seed.
+#
+# python3 tests/bench_settings.py
+# python3 tests/bench_settings.py --fuzz 100000 --seed 7
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from mpmd_settings import parse_settings, parse_settings_line, PrinterSettings
+
+fixtures = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+reports = ['stock_m503.txt', 'stock_m503_s0.txt', 'marlin_1_1_m503.txt', 'marlin_2_ubl_m503.txt', 'marlin_2_mbl_m503.txt']
+
+# Lines a printer sends while the report is coming in, none of them holds a setting
+noise_lines = ['T:60.00 /60.00 B:60.00 /60.00 @:0 B@:0', ' T:185.2 /185.0 B:59.9 /60.0 @:64 B@:0', 'echo:busy: processing',
+               'echo:Auto Bed Leveling:', 'echo:; Mesh Bed Leveling:', 'echo:Unified Bed Leveling System v1.01 inactive',
+               'echo:SD card ok', 'echo:; Z-Probe Offset:', 'Bed X: 0.000 Y: 0.000 Z: 0.123', 'echo:', '']
+
+
+def read_report(name):
+    with open(os.path.join(fixtures, name)) as report:
+        return [line.rstrip('\n') for line in report]
+
+
+def mutate(line, rng):
+    kind = rng.randrange(8)
+    if kind == 0 and line:
+        # Cut off (lost bytes at the end of a line)
+        return line[:rng.randrange(len(line))]
+    if kind == 1 and line:
+        position = rng.randrange(len(line))
+        return line[:position] + rng.choice('XYZ.-+;: \t*#e\x00\xff') + line[position + 1:]
+    if kind == 2:
+        return 'echo:' + line
+    if kind == 3:
+        return line.replace('echo:', '', 1)
+    if kind == 4:
+        return line + ' ; ' + rng.choice(['Leveling OFF', '(mm)', 'M665 L0', ''])
+    if kind == 5:
+        return line + '\r'
+    if kind == 6:
+        return line.replace(' ', '  ')
+    return ''.join(chr(rng.randrange(32, 127)) for ii in range(rng.randrange(40)))
+
+
+def check_line(line):
+    parsed = parse_settings_line(line)
+    if parsed is None:
+        return
+    code, values = parsed
+    assert code[0] in 'GM' and code[1:].isdigit(), (line, parsed)
+    for letter, value in values.items():
+        assert letter.isalpha() and (value is None or isinstance(value, float)), (line, parsed)
+
+
+# Mutated lines (count of them) and noisy reports, raises AssertionError on the first failure
+def fuzz(count, seed=0):
+    rng = random.Random(seed)
+    all_lines = [(name, line) for name in reports for line in read_report(name)]
+    for ii in range(count):
+        name, line = rng.choice(all_lines)
+        check_line(mutate(line, rng))
+    for name in reports:
+        report = read_report(name)
+        clean = parse_settings(report).codes
+        for ii in range(max(1, count // 100)):
+            noisy = []
+            for line in report[:-1]:
+                while rng.random() < 0.3:
+                    noisy.append(rng.choice(noise_lines))
+                noisy.append(line)
+            noisy.append(report[-1])
+            assert parse_settings(noisy).codes == clean, name
+
+
+def benchmark(repeat):
+    for name in reports:
+        report = read_report(name)
+        start = time.time()
+        for ii in range(repeat):
+            PrinterSettings().parse(report)
+        seconds = (time.time() - start) / repeat
+        print('{0:24} {1:3} lines {2:8.1f} us per report {3:6.2f} us per line'.format(name, len(report), seconds*1e6, seconds*1e6/len(report)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark and fuzz the M503 parser over the synthetic reports')
+    parser.add_argument('--repeat', type=int, default=2000, help='Parses of every report for the timing')
+    parser.add_argument('--fuzz', type=int, default=20000, help='Mutated lines to parse (0 = no fuzzing)')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed of the fuzzing')
+    args = parser.parse_args()
+
+    benchmark(args.repeat)
+    if args.fuzz:
+        start = time.time()
+        fuzz(args.fuzz, args.seed)
+        print('Fuzzed {0} lines in {1:.1f} s, no failures'.format(args.fuzz, time.time() - start))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+import os
+import re
+import sys
+import numpy as np
+import pytest
+
+# The scripts and mpmd_* modules live in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mpmd_dryrun import SimulatedPort
+from mpmd_serial import PrinterConnection
+
+
+# Dry run printer with a geometry error: G30 reports the height a flat bed probes at when the
+# firmware holds the M666/M665 values sent so far but the printer really has 'actual'
+class DeltaPort(SimulatedPort):
+
+    def __init__(self, actual, tower_flag=0, noise=0.0, seed=0):
+        SimulatedPort.__init__(self)
+        # Short reads, so closing the connection doesn't wait long on the reader
+        self.timeout = 0.05
+        self.actual = actual
+        self.tower_flag = tower_flag
+        self.noise = noise
+        self.angles = {'ax': 0.0, 'ay': 0.0, 'az': 0.0}
+        self.rng = np.random.default_rng(seed)
+
+    def firmware(self):
+        return dict(self.angles, x=self.settings['x'], y=self.settings['y'], z=self.settings['z'],
+                    r=self.model.radius, l=self.model.rod)
+
+    def _respond(self, command):
+        from auto_cal_p5 import delta_probe_heights
+        lines = SimulatedPort._respond(self, command)
+        code = command.split(' ')[0]
+        if code == 'M665':
+            for axis, value in re.findall(r'([XYZ])(-?[\d.]+)', command):
+                self.angles['a' + axis.lower()] = float(value)
+        elif code == 'G30':
+            x, y = self.model.position[0], self.model.position[1]
+            z = delta_probe_heights([x], [y], self.firmware(), self.actual, self.tower_flag)[0] + self.rng.normal(0.0, self.noise)
+            lines[0] = 'Bed X: {0:.3f} Y: {1:.3f} Z: {2:.3f}'.format(x, y, z)
+        return lines
+
+
+# delta_printer(actual, tower_flag, noise): a connection to a DeltaPort, closed after the test
+@pytest.fixture
+def delta_printer():
+    connections = []
+
+    def connect(actual, tower_flag=0, noise=0.0):
+        connection = PrinterConnection(DeltaPort(actual, tower_flag, noise), window=4, timeout=5.0)
+        connections.append(connection)
+        return connection
+
+    yield connect
+    for connection in connections:
+        connection.close()
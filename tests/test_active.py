@@ -0,0 +1,35 @@
+import numpy as np
+import pytest
+from auto_cal_p5 import run_active_calibration, probe_active, delta_probe_heights, get_grid
+from mpmd_trace import tracer
+
+grid = get_grid('P5')
+nominal = {'x': 0.0, 'y': 0.0, 'z': 0.0, 'r': 63.5, 'l': 123.0, 'ax': 0.0, 'ay': 0.0, 'az': 0.0}
+
+
+@pytest.fixture(autouse=True)
+def reset_tracer():
+    yield
+    tracer.reset()
+
+
+def test_probing_stops_before_the_whole_grid(delta_printer):
+    connection = delta_printer(dict(nominal, x=-0.2), noise=0.002)
+    table, delta, covariance, correction, correction_se = probe_active(connection, grid, nominal, 0, 1.96)
+    assert 4 <= len(table) < len(grid)
+    assert covariance.shape == (7, 7)
+    assert len(correction) == len(correction_se) == len(grid)
+    assert 1.96*np.max(correction_se) < 0.02
+
+
+@pytest.mark.parametrize('stat_confidence', [0.0, 0.95])
+def test_active_mode_calibrates_the_endstops(delta_printer, stat_confidence):
+    actual = dict(nominal, x=-0.3, y=-0.1)
+    connection = delta_printer(actual, noise=0.002)
+    result = run_active_calibration(connection, grid, 0.0, 0.0, 0.0, 123.0, 63.5, [0.0, 0.0, 0.0], 0, 6, 1.0, -1, 2,
+                                    stat_confidence, 57.14)
+    assert result[0]
+    z, x, y, l, r, angles = result[1:]
+    xy = np.array(grid)
+    heights = delta_probe_heights(xy[:, 0], xy[:, 1], dict(nominal, x=x, y=y, z=z, l=l, r=r, ax=angles[0], ay=angles[1], az=angles[2]), actual, 0)
+    assert np.ptp(heights) < 0.05
@@ -0,0 +1,136 @@
+import json
+import os
+import numpy as np
+import pytest
+from auto_cal_p5 import new_probe_table, get_grid
+from mpmd_archive import ProbeArchive, import_session_log, import_pass_file, pass_dtype, point_columns, version
+from mpmd_dryrun import g29_p2_points
+
+
+def probe_table(offset=0.0):
+    table = new_probe_table(get_grid('P5'))
+    table['z1'] = np.linspace(-0.1, 0.1, len(table)) + offset
+    table['z2'] = table['z1'] + 0.002
+    table['z_avg'] = (table['z1'] + table['z2'])/2.0
+    table['dz'] = table['z_avg'] - np.median(table['z_avg'])
+    return table
+
+
+def test_passes_round_trip(tmp_path):
+    path = str(tmp_path / 'fleet')
+    archive = ProbeArchive(path)
+    first = probe_table()
+    archive.append('mpmd-1', first, trial={'x': -0.1, 'y': 0.0, 'z': 0.0, 'l': 123.0, 'r': 63.5, 'angles': [0.2, -0.1, 0.0]},
+                   new={'x': -0.2, 'y': 0.0, 'z': 0.0, 'l': 123.0, 'r': 63.4}, run=1, bed_temp=60, timestamp=1000.0)
+    # Only the taps, z_avg and dz get worked out
+    archive.append('mpmd-2', {'x': [0.0, 10.0], 'y': [5.0, 5.0], 'z1': [0.5, 0.7], 'z2': [0.5, 0.9]}, run=1, calibrated=True, timestamp=2000.0)
+
+    reopened = ProbeArchive(path)
+    assert reopened.printer_names == ['mpmd-1', 'mpmd-2']
+    passes = reopened.passes()
+    assert passes.dtype == pass_dtype
+    assert list(passes['first']) == [0, len(first)]
+    assert list(passes['count']) == [len(first), 2]
+    assert list(passes['printer']) == [0, 1]
+    assert list(passes['calibrated']) == [0, 1]
+    assert passes[0]['bed_temp'] == 60.0 and np.isnan(passes[1]['bed_temp'])
+    assert passes[0]['trial_ax'] == pytest.approx(0.2)
+    assert passes[0]['new_r'] == pytest.approx(63.4)
+    # Values the script didn't have are NaN
+    assert np.isnan(passes[0]['new_ax']) and np.isnan(passes[1]['trial_x'])
+
+    points = reopened.pass_points(0)
+    for name in point_columns:
+        assert np.allclose(points[name], first[name], atol=1e-6), name
+    second = reopened.pass_points(1)
+    assert np.allclose(second['z_avg'], [0.5, 0.8])
+    assert np.allclose(second['dz'], [-0.15, 0.15])
+    # One column at a time
+    assert list(reopened.points(['dz'])) == ['dz']
+    assert len(reopened.points()['x']) == len(first) + 2
+
+
+def test_pass_cut_off_by_a_crash_is_dropped(tmp_path):
+    path = str(tmp_path / 'fleet')
+    archive = ProbeArchive(path)
+    archive.append('mpmd-1', probe_table())
+    # Points of a pass that never got its index record, the last of them only half written
+    with open(os.path.join(path, 'x.f32'), 'ab') as column:
+        column.write(np.zeros(3, dtype='<f4').tobytes()[:10])
+    with open(os.path.join(path, 'passes.idx'), 'ab') as index:
+        index.write(b'\0'*7)
+    assert len(archive.passes()) == 1
+    assert len(archive.points()['x']) == len(probe_table())
+
+    archive.append('mpmd-1', probe_table(0.3))
+    passes = archive.passes()
+    assert len(passes) == 2
+    assert os.path.getsize(os.path.join(path, 'passes.idx')) == 2*pass_dtype.itemsize
+    assert np.allclose(archive.pass_points(1)['z1'], probe_table(0.3)['z1'], atol=1e-6)
+
+
+def test_other_version_is_refused(tmp_path):
+    path = tmp_path / 'fleet'
+    ProbeArchive(str(path))
+    manifest = json.loads((path / 'archive.json').read_text())
+    manifest['version'] = version + 1
+    (path / 'archive.json').write_text(json.dumps(manifest))
+    with pytest.raises(ValueError):
+        ProbeArchive(str(path))
+
+
+def test_records_of_both_scripts(tmp_path):
+    archive = ProbeArchive(str(tmp_path / 'fleet'))
+    table = probe_table()
+    p5 = {'kind': 'pass', 't': 10.0, 'runs': 2, 'calibrated': True, 'bed_temp': 55,
+          'table': dict((name, table[name].tolist()) for name in table.dtype.names),
+          'trial': {'x': 0.0, 'y': -0.1, 'z': 0.0, 'l': 123.0, 'r': 63.5, 'angles': [0.0, 0.0, 0.0]}}
+    p2 = {'kind': 'pass', 't': 20.0, 'run': 1, 'averages': [0.1, 0.2, 0.3, 0.0], 'taps': [0.01, 0.0, 0.0, 0.0],
+          'trial': [0.0, -0.1, -0.2, 63.5], 'new': [0.0, -0.2, -0.3, 63.4]}
+    assert not archive.append_record('mpmd-1', {'kind': 'send', 'command': 'G30'})
+    assert archive.append_record('mpmd-1', p5)
+    assert archive.append_record('mpmd-1', p2)
+    passes = archive.passes()
+    assert list(passes['run']) == [2, 1]
+    assert list(passes['time']) == [10.0, 20.0]
+    assert passes[0]['bed_temp'] == 55.0
+    assert passes[1]['new_y'] == pytest.approx(-0.2)
+    p2_points = archive.pass_points(1)
+    assert np.allclose(p2_points['x'], [p[0] for p in g29_p2_points])
+    assert np.allclose(p2_points['z2'] - p2_points['z1'], [0.01, 0.0, 0.0, 0.0], atol=1e-6)
+
+
+def test_import_every_session_of_a_log(tmp_path):
+    log_file = tmp_path / 'session.jsonl'
+    table = probe_table()
+    record = {'kind': 'pass', 't': 1.0, 'runs': 1, 'table': dict((name, table[name].tolist()) for name in table.dtype.names)}
+    lines = [{'kind': 'session', 't': 0.0, 'args': {'printer_name': 'mpmd-1', 'bed_temp': 60}}, record,
+             {'kind': 'session', 't': 5.0, 'args': {'port': '/dev/ttyACM1', 'bed_temp': -1}}, record, record]
+    log_file.write_text(''.join(json.dumps(line) + '\n' for line in lines) + '{"kind": "pass", "t"')
+    archive = ProbeArchive(str(tmp_path / 'fleet'))
+    assert import_session_log(archive, str(log_file)) == 3
+    assert archive.printer_names == ['mpmd-1', '/dev/ttyACM1']
+    passes = archive.passes()
+    assert list(passes['printer']) == [0, 1, 1]
+    assert passes[0]['bed_temp'] == 60.0 and np.isnan(passes[2]['bed_temp'])
+    # A printer given for the import wins over the sessions'
+    assert import_session_log(archive, str(log_file), printer='bench') == 3
+    assert archive.printer_names[-1] == 'bench'
+
+
+def test_import_pass_file(tmp_path):
+    pass_file = tmp_path / 'auto_cal_p5_pass2.txt'
+    pass_file.write_text('M666 X-0.1 Y0.0 Z-0.2\nM665 L123.0 R63.5\n'
+                         'Bed X: 0.000 Y: 0.000 Z: 0.100\nBed X: 0.000 Y: 0.000 Z: 0.104\n'
+                         'Bed X: 25.000 Y: 0.000 Z: 0.200\nBed X: 25.000 Y: 0.000 Z: 0.200\n')
+    archive = ProbeArchive(str(tmp_path / 'fleet'))
+    assert import_pass_file(archive, str(pass_file), 'mpmd-1')
+    entry = archive.passes()[0]
+    assert entry['run'] == 3
+    assert entry['trial_x'] == pytest.approx(-0.1) and entry['trial_r'] == pytest.approx(63.5)
+    points = archive.pass_points(0)
+    assert np.allclose(points['x'], [0.0, 25.0])
+    assert np.allclose(points['z_avg'], [0.102, 0.2])
+    empty = tmp_path / 'empty.txt'
+    empty.write_text('nothing probed\n')
+    assert not import_pass_file(archive, str(empty), 'mpmd-1')
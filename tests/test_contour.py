@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+from auto_cal_p5 import calculate_contour, get_grid, new_probe_table, probe_xy, probe_spacing
+
+grids = ['P2', 'P4', 'P5', 'hex12', 'radial2']
+
+
+def contour(grid_name, heights, minterp):
+    table = new_probe_table(get_grid(grid_name))
+    table['dz'] = heights(table['x'], table['y'])
+    return calculate_contour(table, 1, [0, 0], [0, 0], [0, 0], minterp, 0)
+
+
+def test_probe_table_holds_the_grid():
+    grid = get_grid('P5')
+    table = new_probe_table(grid)
+    assert np.array_equal(probe_xy(table), np.array(grid, dtype=float))
+    assert np.all(table['dz'] == 0.0)
+    assert probe_spacing(probe_xy(table)) == pytest.approx(25.0)
+
+
+@pytest.mark.parametrize('minterp', [0, 1, 2])
+@pytest.mark.parametrize('grid_name', grids)
+def test_flat_bed_has_no_errors(grid_name, minterp):
+    TX, TY, TZ, THigh, BowlCenter, BowlOR = contour(grid_name, lambda x, y: 0.0*x, minterp)[:6]
+    assert [TX, TY, TZ, BowlCenter, BowlOR] == pytest.approx([0.0]*5, abs=1e-9)
+
+
+@pytest.mark.parametrize('minterp', [0, 1, 2])
+@pytest.mark.parametrize('grid_name', grids)
+def test_tilt_shows_on_the_x_and_y_towers(grid_name, minterp):
+    # Sloping up towards +x: the X tower (left) sits low, Y (right) high and Z (back) level
+    TX, TY, TZ, THigh, BowlCenter, BowlOR = contour(grid_name, lambda x, y: 0.01*x, minterp)[:6]
+    assert np.all(np.isfinite([TX, TY, TZ, THigh, BowlCenter, BowlOR]))
+    assert TX < -0.1 and TY > 0.1
+    assert abs(TZ) < 0.05
+    assert THigh == pytest.approx(TY)
+
+
+@pytest.mark.parametrize('grid_name', grids)
+def test_spreadsheet_matches_griddata_on_the_towers(grid_name):
+    # The spreadsheet's sample points follow the grid's extents, not the P5 layout
+    heights = lambda x, y: 0.004*x - 0.003*y + 1e-4*(x**2 + y**2)
+    spreadsheet = contour(grid_name, heights, 1)[:3]
+    linear = contour(grid_name, heights, 0)[:3]
+    assert np.allclose(spreadsheet, linear, atol=0.1)
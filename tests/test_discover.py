@@ -0,0 +1,79 @@
+import time
+import mpmd_discover
+from mpmd_discover import parse_m115, identify, discover, load_cache
+from mpmd_dryrun import TcpPrinterStandIn
+
+
+def test_m115_fields_and_capabilities():
+    info = parse_m115(['echo:start',
+                       'FIRMWARE_NAME:Marlin 1.1.0 (Github) SOURCE_CODE_URL:https://github.com/mcheah/Marlin4MPMD PROTOCOL_VERSION:1.0 '
+                       'MACHINE_TYPE:MP Mini Delta EXTRUDER_COUNT:1 UUID:cede2a2f-41a2-4748-9b12-c55c62f367ff',
+                       'Cap:EEPROM:1', 'Cap:AUTOREPORT_TEMP:1', 'ok'])
+    assert info['firmware_name'] == 'Marlin 1.1.0 (Github)'
+    assert info['source_code_url'] == 'https://github.com/mcheah/Marlin4MPMD'
+    assert info['machine_type'] == 'MP Mini Delta'
+    assert info['uuid'] == 'cede2a2f-41a2-4748-9b12-c55c62f367ff'
+    assert info['capabilities'] == {'EEPROM': '1', 'AUTOREPORT_TEMP': '1'}
+    # The stock firmware has no M115 report
+    assert parse_m115(['ok']) == {}
+
+
+def test_identify_over_a_network_bridge():
+    stand_in = TcpPrinterStandIn().start()
+    try:
+        info = identify('socket://{0}:{1}'.format(*stand_in.address), timeout=2.0)
+    finally:
+        stand_in.close()
+    assert info == {'firmware_name': 'Dry run'}
+
+
+def test_unreachable_port_is_an_error():
+    info = identify('socket://127.0.0.1:1', timeout=0.5)
+    assert 'error' in info
+
+
+class Identify(object):
+
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.devices = []
+
+    def __call__(self, device, speed=115200, timeout=2.0):
+        self.devices.append(device)
+        time.sleep(self.delay)
+        if device.endswith('dead'):
+            return {'error': 'No M115 reply within {0} s'.format(timeout)}
+        return {'firmware_name': 'Marlin', 'uuid': device[-1]}
+
+
+def test_cached_ports_are_not_opened_again(tmp_path, monkeypatch):
+    cache = str(tmp_path / 'ports.json')
+    probe = Identify()
+    monkeypatch.setattr(mpmd_discover, 'identify', probe)
+    ports = ['loop://a', 'loop://b', 'loop://dead']
+    first = discover(ports, cache=cache)
+    assert sorted(probe.devices) == sorted(ports)
+    assert first['loop://a']['uuid'] == 'a'
+    # Failed ports aren't cached, they're tried again
+    assert sorted(load_cache(cache)) == ['loop://a', 'loop://b']
+    probe.devices = []
+    second = discover(ports, cache=cache)
+    assert probe.devices == ['loop://dead']
+    assert second['loop://b']['uuid'] == 'b'
+    probe.devices = []
+    discover(ports, cache=cache, refresh=True)
+    assert sorted(probe.devices) == sorted(ports)
+
+
+def test_ports_are_probed_at_the_same_time(monkeypatch):
+    monkeypatch.setattr(mpmd_discover, 'identify', Identify(delay=0.3))
+    started = time.time()
+    results = discover(['loop://{0}'.format(ii) for ii in range(6)], cache=None)
+    assert len(results) == 6
+    assert time.time() - started < 1.0
+
+
+def test_port_that_hangs_is_reported(monkeypatch):
+    monkeypatch.setattr(mpmd_discover, 'identify', Identify(delay=3.0))
+    results = discover(['loop://x'], timeout=0.2, cache=None)
+    assert results['loop://x']['error'] == 'Opening the port did not return'
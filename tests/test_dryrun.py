@@ -0,0 +1,92 @@
+import json
+import pytest
+import auto_cal_p5
+from mpmd_dryrun import DeltaMotionModel, Heater, SimulatedPort, dry_run_model, latency_from_log
+from mpmd_trace import tracer
+
+
+def test_dwell_takes_its_time():
+    model = DeltaMotionModel(latency=0.0)
+    assert model.command_time('G4 P1500') == pytest.approx(1.5)
+    assert model.command_time('G4 S30') == pytest.approx(30.0)
+
+
+def test_bed_heats_at_its_rate_and_waits_the_residency():
+    model = DeltaMotionModel(latency=0.0, bed=Heater(0.5, 0.1, residency=10.0, temperature=25.0))
+    assert model.command_time('M140 S60') == 0.0
+    # Warming up while the printer does something else
+    model.command_time('G4 S20')
+    assert model.bed.temperature == pytest.approx(35.0)
+    assert model.command_time('M190 S60') == pytest.approx(25.0/0.5 + 10.0)
+    assert model.bed.temperature == pytest.approx(60.0)
+    # Already there, nothing to wait for
+    assert model.command_time('M190 S60') == 0.0
+
+
+def test_only_r_waits_for_cooling():
+    model = DeltaMotionModel(latency=0.0, bed=Heater(0.5, 0.1, residency=0.0, temperature=60.0))
+    assert model.command_time('M190 S50') == 0.0
+    model.bed.temperature = 60.0
+    assert model.command_time('M190 R50') == pytest.approx(100.0)
+
+
+def test_hotend_has_its_own_heater():
+    model = DeltaMotionModel(latency=0.0)
+    seconds = model.command_time('M109 S200')
+    assert seconds == pytest.approx((200.0 - 25.0)/model.hotend.heat_rate + model.hotend.residency)
+    assert model.bed.target == 25.0
+
+
+def test_simulated_port_clock_includes_heating():
+    port = SimulatedPort(DeltaMotionModel(latency=0.01))
+    port.write(b'M190 S45\n')
+    assert port.clock() == pytest.approx(0.01 + 20.0/0.4 + 10.0)
+
+
+def session(dry_run=0):
+    return {'kind': 'session', 't': 0.0, 'args': {'dry_run': dry_run}}
+
+
+def test_latency_from_lone_immediate_commands():
+    records = [session(),
+               {'kind': 'send', 't': 1.0, 'command': 'M115'},
+               {'kind': 'recv', 't': 1.02, 'line': 'FIRMWARE_NAME:Marlin'},
+               {'kind': 'recv', 't': 1.03, 'line': 'ok'},
+               # A move's ok comes after the move, that's not the round trip
+               {'kind': 'send', 't': 2.0, 'command': 'G28'},
+               {'kind': 'recv', 't': 12.0, 'line': 'ok'},
+               {'kind': 'send', 't': 13.0, 'command': 'M666 X0.0 Y0.0 Z0.0'},
+               {'kind': 'recv', 't': 13.05, 'line': 'ok'},
+               # Queued behind another command, the wait includes that one
+               {'kind': 'send', 't': 14.0, 'command': 'G30'},
+               {'kind': 'send', 't': 14.0, 'command': 'M105'},
+               {'kind': 'recv', 't': 16.0, 'line': 'ok'},
+               {'kind': 'recv', 't': 16.01, 'line': 'ok'},
+               {'kind': 'send', 't': 17.0, 'command': 'M105'},
+               {'kind': 'recv', 't': 17.04, 'line': 'ok T:25.0 /0.0 B:25.0 /0.0'}]
+    assert latency_from_log(records) == pytest.approx(0.04)
+
+
+def test_latency_skips_dry_runs():
+    records = [session(dry_run=1),
+               {'kind': 'send', 't': 1.0, 'command': 'M115'},
+               {'kind': 'recv', 't': 1.0, 'line': 'ok'}]
+    assert latency_from_log(records) is None
+
+
+def test_dry_run_model_reads_the_session_log(tmp_path):
+    log_file = str(tmp_path / 'session.jsonl')
+    with open(log_file, 'w') as log:
+        for record in [session(), {'kind': 'send', 't': 1.0, 'command': 'M115'}, {'kind': 'recv', 't': 1.25, 'line': 'ok'}]:
+            log.write(json.dumps(record) + '\n')
+    assert dry_run_model(log_file).latency == pytest.approx(0.25)
+    assert dry_run_model(str(tmp_path / 'missing.jsonl')).latency == DeltaMotionModel().latency
+
+
+def test_dry_run_writes_no_session_log(tmp_path):
+    log_file = tmp_path / 'session.jsonl'
+    try:
+        auto_cal_p5.main(['-dr', '1', '-ff', '1', '-cm', '1', '-lg', str(log_file)])
+    finally:
+        tracer.reset()
+    assert not log_file.exists()
@@ -0,0 +1,82 @@
+import numpy as np
+import pytest
+from auto_cal_p5 import (delta_forward, delta_inverse, delta_probe_heights, delta_jacobian, estimate_geometry,
+                         geometry_parameters, square_grid, corrected_values, corrections_settled, flattening_stalled)
+
+grid = np.array(square_grid(5))
+nominal = {'x': 0.0, 'y': 0.0, 'z': 0.0, 'r': 63.5, 'l': 123.0, 'ax': 0.0, 'ay': 0.0, 'az': 0.0}
+
+
+# Probes the printer (actual geometry) with the firmware set to geom and fits once, like a calibration pass
+def fit_passes(actual, passes, geom=nominal):
+    for ii in range(passes):
+        heights = delta_probe_heights(grid[:, 0], grid[:, 1], geom, actual, 0)
+        geom, correction, jac, covariance = estimate_geometry(grid[:, 0], grid[:, 1], heights - np.median(heights), geom, 0)
+    return geom
+
+
+@pytest.mark.parametrize('tower_flag', [0, 1, 2])
+def test_forward_inverts_inverse(tower_flag):
+    geom = dict(nominal, r=64.1, l=123.6, ax=0.2, ay=-0.3)
+    nozzle = np.column_stack((grid[:, 0], grid[:, 1], np.full(len(grid), 0.3)))
+    carriages = delta_inverse(nozzle[:, 0], nozzle[:, 1], nozzle[:, 2], geom, tower_flag)
+    assert np.allclose(delta_forward(carriages, geom, tower_flag), nozzle, atol=1e-9)
+
+
+def test_calibrated_printer_probes_flat():
+    heights = delta_probe_heights(grid[:, 0], grid[:, 1], nominal, nominal, 0)
+    assert np.allclose(heights, 0.0, atol=1e-9)
+
+
+def test_jacobian_matches_the_height_change():
+    step = dict(nominal, x=0.05)
+    expected = delta_probe_heights(grid[:, 0], grid[:, 1], step, nominal, 0)
+    jac = delta_jacobian(grid[:, 0], grid[:, 1], nominal, 0)
+    assert np.allclose(jac[:, geometry_parameters.index('x')]*0.05, expected, atol=1e-4)
+
+
+def test_fit_recovers_endstops_and_tower_angles():
+    # The highest endstop is kept at zero, so the printer's is too
+    actual = dict(nominal, x=-0.4, y=-0.15, ax=0.2, ay=-0.3)
+    geom = fit_passes(actual, 2)
+    for key in ['x', 'y', 'z', 'ax', 'ay']:
+        assert geom[key] == pytest.approx(actual[key], abs=0.005), key
+    assert geom['r'] == pytest.approx(actual['r'], abs=0.05)
+
+
+def test_fit_flattens_radius_and_rod_errors():
+    # Radius and rod length are nearly degenerate on a flat bed, the fit walks along that pair
+    # but the endstops and angles come out right and the bed ends up flat
+    actual = dict(nominal, x=-0.4, y=-0.15, r=64.1, l=123.6, ax=0.2, ay=-0.3)
+    geom = fit_passes(actual, 3)
+    for key in ['x', 'y', 'z', 'ax', 'ay']:
+        assert geom[key] == pytest.approx(actual[key], abs=0.005), key
+    before = delta_probe_heights(grid[:, 0], grid[:, 1], nominal, actual, 0)
+    after = delta_probe_heights(grid[:, 0], grid[:, 1], geom, actual, 0)
+    assert np.ptp(after) < 0.1*np.ptp(before)
+    assert abs(geom['r'] - actual['r']) < abs(nominal['r'] - actual['r'])
+
+
+def test_corrected_values_keep_the_highest_endstop_at_zero():
+    values = corrected_values(dict(nominal, x=-0.1), ['x', 'y', 'z', 'r'], [0.3, -0.2, 0.0, 0.123456])
+    assert values == dict(nominal, x=0.0, y=-0.4, z=-0.2, r=63.6235)
+
+
+def test_corrections_settle_below_the_noise_or_a_step():
+    correction = np.array([0.015, -0.03])
+    assert not corrections_settled(correction)
+    assert corrections_settled(correction, np.array([0.01, 0.02]), 2.0)
+    assert not corrections_settled(correction, np.array([0.01, 0.01]), 2.0)
+    # Nothing below a motor step can be set anyway
+    assert corrections_settled(correction, np.array([0.001, 0.001]), 2.0, step_floor=0.035)
+
+
+def test_stall_when_the_bed_stops_getting_flatter():
+    before = np.zeros(4, dtype=[('dz', 'f8')])
+    before['dz'] = [0.1, -0.1, 0.1, -0.1]
+    after = before.copy()
+    after['dz'] *= 0.95
+    assert not flattening_stalled(after, None)
+    assert flattening_stalled(after, before)
+    after['dz'] = before['dz']*0.5
+    assert not flattening_stalled(after, before)
@@ -0,0 +1,48 @@
+import json
+import numpy as np
+import pytest
+from auto_cal_p5 import get_grid, probe_grids, probe_radius, probe_extent
+from mpmd_dryrun import g29_p2_points, g29_p5_points
+
+
+@pytest.mark.parametrize('name, count', [('P2', 4), ('P3', 5), ('P4', 12), ('P5', 21), ('P6', 24), ('P7', 37),
+                                         ('hex10', 121), ('hex25', 19), ('radial2', 19), ('radial3', 37)])
+def test_point_counts(name, count):
+    assert len(get_grid(name)) == count
+
+
+@pytest.mark.parametrize('name', ['P3', 'P4', 'P5', 'P6', 'P7', 'hex10', 'hex25', 'radial2', 'radial3'])
+def test_points_are_inside_the_probe_radius(name):
+    grid = np.array(get_grid(name))
+    assert np.all(np.hypot(grid[:, 0], grid[:, 1]) <= probe_radius + 1e-9)
+    assert np.all(np.abs(grid) <= probe_radius)
+    # No point probed twice
+    assert len(set(map(tuple, grid.tolist()))) == len(grid)
+
+
+@pytest.mark.parametrize('name', ['P3', 'P4', 'P5', 'P6'])
+def test_square_grids_are_walked_in_a_serpentine(name):
+    grid = np.array(get_grid(name))
+    assert np.max(np.abs(grid)) == pytest.approx(probe_extent)
+    # One step at a time, a row change never goes back across the bed
+    steps = np.hypot(*np.diff(grid, axis=0).T)
+    assert np.max(steps) < 2.0*probe_extent
+
+
+def test_stock_firmware_grids_match_g29():
+    assert probe_grids['P5'] == [list(point) for point in g29_p5_points]
+    assert probe_grids['P2'] == [list(point) for point in g29_p2_points]
+
+
+def test_json_grid(tmp_path):
+    points = [[-40.0, -20.0], [40.0, -20.0], [0.0, 45.0], [0.0, 0.0], [10.0, 10.0]]
+    filename = tmp_path / 'grid.json'
+    filename.write_text(json.dumps(points))
+    assert get_grid(str(filename)) == points
+
+
+@pytest.mark.parametrize('name', ['P2x', 'P1', 'P0', 'hex0', 'hex200', 'radial0', 'square5'])
+def test_unusable_grids_exit(name):
+    # A message instead of a traceback, and never a grid too small to solve for the endstops and R
+    with pytest.raises(SystemExit):
+        get_grid(name)
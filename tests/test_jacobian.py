@@ -0,0 +1,96 @@
+import logging
+import numpy as np
+import pytest
+from auto_cal_p5 import (load_jacobian, save_jacobian, measure_jacobian, jacobian_dead_parameters, jacobian_parameters,
+                         solve_jacobian, calibrate_jacobian, delta_jacobian, geometry_parameters, new_probe_table, get_grid)
+from mpmd_log import console
+
+grid = get_grid('P5')
+nominal = {'x': 0.0, 'y': 0.0, 'z': 0.0, 'r': 63.5, 'l': 123.0, 'ax': 0.0, 'ay': 0.0, 'az': 0.0}
+
+
+# Model Jacobian in the layout measure_jacobian caches
+def model_entry(parameters, grid=grid, tower_flag=0):
+    xy = np.array(grid)
+    columns = [geometry_parameters.index(param) for param in parameters]
+    return {'grid': grid, 'tower_flag': tower_flag, 'parameters': parameters, 'steps': {}, 'trial': {},
+            'measured': '2026-10-19 12:00:00', 'jacobian': delta_jacobian(xy[:, 0], xy[:, 1], nominal, tower_flag)[:, columns]}
+
+
+@pytest.fixture
+def console_lines():
+    lines = []
+    handler = logging.Handler()
+    handler.emit = lambda record: lines.append(record.getMessage())
+    console.logger.addHandler(handler)
+    yield lines
+    console.logger.removeHandler(handler)
+
+
+def test_cache_round_trip(tmp_path):
+    cache = str(tmp_path / 'jacobian.json')
+    assert load_jacobian(cache, 'mpmd', grid, 0) is None
+    entry = model_entry(jacobian_parameters(grid))
+    save_jacobian(cache, 'mpmd', entry)
+    save_jacobian(cache, 'other', model_entry(['x', 'y', 'z', 'r'], get_grid('P2')))
+    loaded = load_jacobian(cache, 'mpmd', grid, 0)
+    assert loaded['parameters'] == ['x', 'y', 'z', 'r', 'l']
+    assert np.allclose(loaded['jacobian'], entry['jacobian'])
+    # Cached for another printer, grid or tower setup, it has to be measured again
+    assert load_jacobian(cache, 'unknown', grid, 0) is None
+    assert load_jacobian(cache, 'mpmd', get_grid('P2'), 0) is None
+    assert load_jacobian(cache, 'mpmd', grid, 1) is None
+    assert load_jacobian(cache, 'other', get_grid('P2'), 0)['parameters'] == ['x', 'y', 'z', 'r']
+
+
+def test_broken_cache_is_ignored_and_replaced(tmp_path):
+    cache = tmp_path / 'jacobian.json'
+    cache.write_text('{"mpmd": ')
+    assert load_jacobian(str(cache), 'mpmd', grid, 0) is None
+    save_jacobian(str(cache), 'mpmd', model_entry(['x', 'y', 'z', 'r', 'l']))
+    assert load_jacobian(str(cache), 'mpmd', grid, 0) is not None
+
+
+def test_dead_parameters():
+    entry = model_entry(['x', 'y', 'z', 'r', 'l'])
+    assert jacobian_dead_parameters(entry) == []
+    entry['jacobian'][:, 3] = 0.5
+    assert jacobian_dead_parameters(entry) == ['r']
+
+
+def test_solve_takes_out_an_endstop_error():
+    entry = model_entry(['x', 'y', 'z', 'r'])
+    # Heights of an X endstop 0.2 too high, the correction lowers it again
+    dz = entry['jacobian'][:, 0]*0.2
+    delta, correction, jac, covariance = solve_jacobian(entry['jacobian'], dz)
+    # Heights are relative, a common endstop shift doesn't show, only the endstops relative to each other
+    assert delta[0] - delta[1] == pytest.approx(-0.2, abs=1e-3)
+    assert delta[1] - delta[2] == pytest.approx(0.0, abs=1e-3)
+    assert delta[3] == pytest.approx(0.0, abs=1e-3)
+    assert np.allclose(correction, -(dz - np.mean(dz)), atol=1e-3)
+    assert covariance.shape == (4, 4)
+
+
+def test_measured_jacobian_matches_the_model(delta_printer):
+    connection = delta_printer(nominal)
+    entry, base = measure_jacobian(connection, 1, grid, 0.0, 0.0, 0.0, 123.0, 63.5, 0)
+    assert entry['parameters'] == ['x', 'y', 'z', 'r', 'l']
+    assert np.allclose(base['dz'], 0.0, atol=1e-3)
+    # Probe heights are relative, so are the columns
+    model = model_entry(entry['parameters'])['jacobian']
+    measured = entry['jacobian']
+    assert np.allclose(measured - np.mean(measured, axis=0), model - np.mean(model, axis=0), atol=0.02)
+    # The trial values are put back
+    firmware = connection.port.firmware()
+    assert [firmware[key] for key in 'xyzrl'] == [0.0, 0.0, 0.0, 63.5, 123.0]
+
+
+@pytest.mark.parametrize('parameters, rod', [(['x', 'y', 'z', 'r', 'l'], True), (['x', 'y', 'z', 'r'], False)])
+def test_calibrated_pass_prints_the_confidence_interval(console_lines, parameters, rod):
+    table = new_probe_table(grid)
+    calibrated = calibrate_jacobian(None, table, model_entry(parameters), 0.0, 0.0, 0.0, 123.0, 63.5, sigma_avg=0.005, zscore=1.96)
+    assert calibrated[0]
+    interval = [line for line in console_lines if line.startswith('Confidence interval')]
+    assert len(interval) == 1
+    assert ('L+/-' in interval[0]) == rod
+    assert 'R+/-' in interval[0]
@@ -0,0 +1,279 @@
+import os
+import threading
+import time
+import pytest
+from mpmd_serial import PrinterConnection, Timeout, classify_line, PROBE, SETTINGS, OK, OTHER
+
+fixtures = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+marlin_reports = ['marlin_1_1_m503.txt', 'marlin_2_ubl_m503.txt', 'marlin_2_mbl_m503.txt']
+
+
+def read_fixture(name):
+    with open(os.path.join(fixtures, name)) as fixture:
+        return [line.rstrip('\n') for line in fixture]
+
+
+# Answers M503 with a fixture report and G30 with a probe result, like the firmware would
+class ReportPort(object):
+
+    def __init__(self, report):
+        self.report = report
+        self.buffer = b''
+        self.condition = threading.Condition()
+        self.written = []
+
+    def write(self, data):
+        command = data.decode().strip()
+        self.written.append(command)
+        if command == 'M503':
+            lines = self.report
+        elif command == 'G30':
+            lines = ['Bed X: 0.000 Y: 0.000 Z: 0.123', 'ok']
+        else:
+            lines = ['ok']
+        with self.condition:
+            self.buffer += ''.join(line + '\n' for line in lines).encode()
+            self.condition.notify_all()
+        return len(data)
+
+    @property
+    def in_waiting(self):
+        return len(self.buffer)
+
+    def read(self, size=1):
+        with self.condition:
+            if not self.buffer:
+                self.condition.wait(0.05)
+            data, self.buffer = self.buffer[:size], self.buffer[size:]
+            return data
+
+    def close(self):
+        pass
+
+
+@pytest.mark.parametrize('name', marlin_reports)
+def test_marlin_m503_has_no_probe_lines(name):
+    report = read_fixture(name)
+    types = [classify_line(line.strip()) for line in report]
+    assert PROBE not in types
+    assert types[-1] == OK
+    for line, line_type in zip(report, types):
+        if line.replace('echo:', '').strip()[:5] in ('M665 ', 'M666 ', 'M92 X'):
+            assert line_type == SETTINGS, line
+
+
+def test_probe_results():
+    assert classify_line('Bed X: -43.30 Y: -25.00 Z: 0.3700') == PROBE
+    assert classify_line('Bed X: 0.000 Y: 0.000 Z: -0.012') == PROBE
+    for heading in ['echo:Auto Bed Leveling:', 'echo:; Mesh Bed Leveling:', 'echo:; Unified Bed Leveling:',
+                    'echo:Unified Bed Leveling System v1.01 inactive', 'Bed X:']:
+        assert classify_line(heading) == OTHER, heading
+
+
+def test_full_queue_keeps_typed_lines():
+    report = ['echo:busy start', 'Bed X: 0.000 Y: 0.000 Z: 0.001', 'echo:filler', 'Bed X: 0.000 Y: 0.000 Z: 0.002',
+              'Bed X: 0.000 Y: 0.000 Z: 0.003', 'Bed X: 0.000 Y: 0.000 Z: 0.004', 'ok']
+    connection = PrinterConnection(ReportPort(report), max_events=3, timeout=5.0)
+    try:
+        connection.write('M503')
+        connection.wait_for_ok()
+        # Only the untyped lines made room, every probe result is still there
+        assert connection.discarded == 2
+        assert [line[-5:] for line in connection.drain(PROBE)] == ['0.001', '0.002', '0.003', '0.004']
+        assert connection.overfull
+    finally:
+        connection.close()
+
+
+@pytest.mark.parametrize('name', marlin_reports)
+def test_read_state_leaves_nothing_queued(name):
+    connection = PrinterConnection(ReportPort(read_fixture(name)), timeout=5.0)
+    try:
+        state = connection.read_state()
+        assert state.endstop_adjustments == (-0.3, -0.12, 0.0)
+        assert state.diagonal_rod == 123.0
+        assert state.delta_radius == 63.5
+        assert len(connection.events) == 0
+        # The first probe after reading the settings gets the probe result, not a report line
+        connection.write('G30')
+        assert connection.wait_for(PROBE).split(' ')[6] == '0.123'
+    finally:
+        connection.close()
+
+
+# Line numbered firmware that only processes the lines written so far when step() is called,
+# everything written in between is in flight. Line 'corrupt' fails its checksum the first time.
+class InFlightPort(object):
+
+    def __init__(self, corrupt):
+        self.corrupt = corrupt
+        self.last = 0
+        self.pending = []
+        self.received = []
+        self.buffer = b''
+        self.condition = threading.Condition()
+
+    def write(self, data):
+        with self.condition:
+            self.pending.append(data.decode().strip())
+        return len(data)
+
+    def step(self):
+        with self.condition:
+            lines, self.pending = self.pending, []
+        out = []
+        for line in lines:
+            self.received.append(line)
+            number = int(line.split(' ')[0][1:])
+            if number == 0:
+                self.last = 0
+            elif number == self.corrupt:
+                self.corrupt = None
+                out += ['Error:checksum mismatch, Last Line: {0}'.format(self.last), 'Resend: {0}'.format(self.last + 1)]
+            elif number != self.last + 1:
+                out += ['Error:Line Number is not Last Line Number+1, Last Line: {0}'.format(self.last), 'Resend: {0}'.format(self.last + 1)]
+            else:
+                self.last = number
+            out.append('ok')
+        with self.condition:
+            self.buffer += ''.join(line + '\n' for line in out).encode()
+            self.condition.notify_all()
+
+    @property
+    def in_waiting(self):
+        return len(self.buffer)
+
+    def read(self, size=1):
+        with self.condition:
+            if not self.buffer:
+                self.condition.wait(0.05)
+            data, self.buffer = self.buffer[:size], self.buffer[size:]
+            return data
+
+    def close(self):
+        pass
+
+
+def test_resend_replays_in_flight_lines_once():
+    port = InFlightPort(corrupt=2)
+    connection = PrinterConnection(port, reliable=True, timeout=5.0)
+    try:
+        for ii in range(6):
+            connection.write('G4 P{0}'.format(ii))
+        # Line 2 is rejected, lines 3-6 behind it each get a resend request for line 2 as well
+        for ii in range(20):
+            port.step()
+            if connection._wait_until(lambda: connection.acknowledged >= connection.sent, time.time() + 0.2, 'test'):
+                break
+        assert port.last == 6
+        assert connection.resends == 5
+        assert [line.split(' ')[0] for line in port.received[7:]] == ['N2', 'N3', 'N4', 'N5', 'N6']
+    finally:
+        connection.close()
+
+
+def test_set_parameters_sends_values_known_only_from_m503():
+    port = ReportPort(read_fixture('marlin_1_1_m503.txt'))
+    connection = PrinterConnection(port, timeout=5.0)
+    try:
+        connection.read_state()
+        # The report says X-0.30, the printer may hold X-0.3012
+        assert connection.set_parameters('M666', X=-0.3, Y=-0.12, Z=0.0) == 'M666 X-0.3 Y-0.12 Z0.0'
+        assert connection.set_parameters('M666', X=-0.3, Y=-0.12, Z=0.0) is None
+        assert connection.set_parameters('M666', X=-0.3, Y=-0.1234, Z=0.0) == 'M666 Y-0.1234'
+        # Reading the report again keeps the values it rounds to, -0.1234 shows up as -0.12
+        connection.read_state()
+        assert connection.set_parameters('M666', Y=-0.1234) is None
+        connection.wait_for_ok()
+    finally:
+        connection.close()
+
+
+# Firmware that works through its queue only when step() is called, numbering its probe results
+class QueuedPort(object):
+
+    def __init__(self):
+        self.pending = []
+        self.probes = 0
+        self.buffer = b''
+        self.condition = threading.Condition()
+
+    def write(self, data):
+        with self.condition:
+            self.pending.append(data.decode().strip())
+        return len(data)
+
+    def step(self):
+        with self.condition:
+            lines, self.pending = self.pending, []
+        out = []
+        for line in lines:
+            if line == 'G30':
+                self.probes += 1
+                out.append('Bed X: 0.000 Y: 0.000 Z: {0:.3f}'.format(self.probes/1000.0))
+            out.append('ok')
+        with self.condition:
+            self.buffer += ''.join(line + '\n' for line in out).encode()
+            self.condition.notify_all()
+
+    @property
+    def in_waiting(self):
+        return len(self.buffer)
+
+    def read(self, size=1):
+        with self.condition:
+            if not self.buffer:
+                self.condition.wait(0.05)
+            data, self.buffer = self.buffer[:size], self.buffer[size:]
+            return data
+
+    def close(self):
+        pass
+
+
+def test_resume_lets_queued_commands_run_out():
+    port = QueuedPort()
+    connection = PrinterConnection(port, window=4, timeout=5.0)
+    stepping = threading.Event()
+
+    def firmware():
+        while not stepping.is_set():
+            port.step()
+            time.sleep(0.05)
+
+    try:
+        for command in ['G28', 'G30', 'G30']:
+            connection.write(command)
+        connection.cancel()
+        # The cancelled job's commands are still queued on the printer when resume() starts
+        stepper = threading.Thread(target=firmware)
+        stepper.start()
+        assert connection.resume()
+        assert len(connection.events) == 0
+        connection.write('G30')
+        assert connection.wait_for(PROBE).split(' ')[6] == '0.003'
+        connection.wait_for_ok()
+        assert connection.acknowledged == connection.sent
+    finally:
+        stepping.set()
+        connection.close()
+
+
+def test_wait_for_says_whether_the_printer_is_still_there():
+    # Answers M400 but never probes
+    connection = PrinterConnection(ReportPort(['ok']), timeout=0.5)
+    try:
+        with pytest.raises(Timeout) as answered:
+            connection.wait_for(PROBE, deadline=time.time() + 0.2)
+        assert str(answered.value) == 'No probe line in time'
+        assert connection.port.written == ['M400']
+    finally:
+        connection.close()
+    # QueuedPort without stepping never answers anything
+    connection = PrinterConnection(QueuedPort(), timeout=0.5)
+    try:
+        with pytest.raises(Timeout) as silent:
+            connection.wait_for(PROBE, contains='Z', deadline=time.time() + 0.2)
+        assert str(silent.value) == "No probe line with 'Z' in time and no answer to M400"
+    finally:
+        connection.close()
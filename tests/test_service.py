@@ -0,0 +1,112 @@
+import pytest
+from conftest import DeltaPort
+from mpmd_log import session
+from mpmd_serial import PrinterConnection
+from mpmd_service import (CalibrationService, is_dry_run, INVALID_REQUEST, METHOD_NOT_FOUND, INVALID_PARAMS,
+                          SERVICE_ERROR)
+
+nominal = {'x': 0.0, 'y': 0.0, 'z': 0.0, 'r': 63.5, 'l': 123.0, 'ax': 0.0, 'ay': 0.0, 'az': 0.0}
+
+
+@pytest.fixture
+def service():
+    services = []
+
+    def create(connection=None):
+        services.append(CalibrationService(connection))
+        return services[-1]
+
+    yield create
+    for created in services:
+        session.listeners.remove(created._record)
+
+
+def rpc(service, method, **params):
+    return service.call({'jsonrpc': '2.0', 'id': 7, 'method': method, 'params': params})
+
+
+# Events until the job ends
+def wait_for_job(service, job):
+    since = 0
+    events = []
+    while True:
+        update = service.events(job, since, 30.0)
+        events += update['events']
+        since += len(update['events'])
+        if update['state'] != 'running' and not update['events']:
+            return update['state'], events
+
+
+def test_dry_run_flag_needs_its_value():
+    assert is_dry_run(['-ff', '1', '-dr', '1'])
+    assert is_dry_run(['--dry-run=1'])
+    assert not is_dry_run(['-dr', '0'])
+    assert not is_dry_run(['-ff', '1'])
+
+
+def test_rpc_errors(service):
+    calibration = service()
+    assert calibration.call({'id': 1})['error']['code'] == INVALID_REQUEST
+    assert calibration.call([1, 2])['error']['code'] == INVALID_REQUEST
+    assert rpc(calibration, 'shutdown')['error']['code'] == METHOD_NOT_FOUND
+    assert rpc(calibration, 'status', colour='red')['error']['code'] == INVALID_PARAMS
+    assert rpc(calibration, 'status')['error']['code'] == SERVICE_ERROR
+    assert rpc(calibration, 'status', job=3)['error']['code'] == INVALID_PARAMS
+    assert rpc(calibration, 'start', script='p7')['error']['code'] == INVALID_PARAMS
+    # Notifications get no response
+    assert calibration.call({'jsonrpc': '2.0', 'method': 'status'}) is None
+
+
+@pytest.mark.parametrize('args', [['-ff', '1'], ['-ff', '1', '-dr', '0'], ['-dr', 'x']])
+def test_without_a_printer_only_dry_runs_start(service, args):
+    response = rpc(service(), 'start', script='p5', args=args)
+    assert response['error']['code'] in (SERVICE_ERROR, INVALID_PARAMS)
+
+
+@pytest.mark.parametrize('script, args', [('p5', ['-ff', '1', '-cm', '1']), ('p5', ['-ff', '1', '-ov', '1']), ('p2', [])])
+def test_dry_run_job_reports_progress(service, script, args):
+    calibration = service()
+    started = rpc(calibration, 'start', script=script, args=args + ['-dr', '1'])['result']
+    assert started['state'] == 'running'
+    state, events = wait_for_job(calibration, started['job'])
+    assert state == 'finished'
+    kinds = [event['kind'] for event in events]
+    assert kinds[0] == 'job' and kinds[-1] == 'job'
+    assert 'session' not in kinds or kinds.index('session') < kinds.index('pass')
+    assert [event['seq'] for event in events] == list(range(1, len(events) + 1))
+    results = rpc(calibration, 'results', job=started['job'])['result']
+    assert results['state'] == 'finished'
+    assert len(results['passes']) >= 1
+    assert results['result']['calibrated']
+    # A second job can start once the first one is done
+    assert rpc(calibration, 'start', script=script, args=args + ['-dr', '1'])['result']['job'] == started['job'] + 1
+    wait_for_job(calibration, started['job'] + 1)
+
+
+# Never answers a probe, the calibration hangs until it's cancelled
+class StuckPort(DeltaPort):
+
+    def _respond(self, command):
+        if command.split(' ')[0] == 'G30':
+            return []
+        return DeltaPort._respond(self, command)
+
+
+def test_cancel_stops_the_job_and_frees_the_printer(service):
+    port = StuckPort(nominal)
+    connection = PrinterConnection(port, window=4, timeout=1.0, on_line=session.received, on_write=session.sent)
+    try:
+        calibration = service(connection)
+        job = rpc(calibration, 'start', script='p5', args=['-ff', '1', '-cm', '1', '-lg', ''])['result']['job']
+        # Wait until it's probing
+        while 'G30' not in port.commands:
+            calibration.events(job, 0, 0.05)
+        assert rpc(calibration, 'cancel', job=job)['result']['job'] == job
+        state, events = wait_for_job(calibration, job)
+        assert state == 'cancelled'
+        assert events[-1] == dict(events[-1], kind='job', state='cancelled')
+        # Back in step with the printer, nothing of the job left queued
+        assert port.commands[-1] == 'M400'
+        assert len(connection.events) == 0
+    finally:
+        connection.close()
@@ -0,0 +1,43 @@
+import pytest
+from mpmd_settings import parse_settings, parse_settings_line
+from bench_settings import read_report, reports, fuzz
+
+# Values of the synthetic reports: M92 X, M666 X Y Z, M665 L R, M206 X, M301 P
+expected = {
+    'stock_m503.txt': (57.14, (-0.3, -0.12, 0.0), 120.8, 63.0, 0.0, 22.2),
+    'stock_m503_s0.txt': (57.14, (-0.3, -0.12, 0.0), 120.8, 63.0, 0.0, 22.2),
+    'marlin_1_1_m503.txt': (57.14, (-0.3, -0.12, 0.0), 123.0, 63.5, 0.0, 22.2),
+    'marlin_2_ubl_m503.txt': (57.14, (-0.3, -0.12, 0.0), 123.0, 63.5, 0.0, 22.2),
+    'marlin_2_mbl_m503.txt': (57.14, (-0.3, -0.12, 0.0), 123.0, 63.5, 0.0, 22.2),
+}
+
+
+@pytest.mark.parametrize('name', reports)
+def test_reports(name):
+    settings = parse_settings(read_report(name))
+    steps, endstops, rod, radius, home_x, pid_p = expected[name]
+    assert settings.steps_per_unit[0] == steps
+    assert settings.endstop_adjustments == endstops
+    assert settings.diagonal_rod == rod
+    assert settings.delta_radius == radius
+    assert settings.home_offsets[0] == home_x
+    assert settings.get('M301', 'P') == pid_p
+
+
+def test_indexed_codes_and_comments():
+    settings = parse_settings(read_report('marlin_2_ubl_m503.txt'))
+    assert settings.get('M145 S0', 'H') == 180.0
+    assert settings.get('M145 S1', 'B') == 110.0
+    assert settings.get('M420', 'Z') == 10.0
+    assert settings.get('M851', 'Z') == 0.0
+    assert parse_settings_line('echo:  M149 C ; Units in Celsius') == ('M149', {'C': None})
+    assert parse_settings_line('echo:; Delta config:') is None
+
+
+def test_report_ends_at_ok():
+    settings = parse_settings(['echo:  M665 L123.00 R63.50', 'ok', 'echo:  M665 L0.00 R0.00'])
+    assert settings.delta_radius == 63.5
+
+
+def test_fuzz():
+    fuzz(5000, seed=1)
@@ -0,0 +1,26 @@
+import pytest
+from mpmd_stats import normal_quantile, t_quantile, confidence_zscore
+
+
+def test_normal_quantiles():
+    assert normal_quantile(0.5) == pytest.approx(0.0, abs=1e-9)
+    assert normal_quantile(0.975) == pytest.approx(1.959964, abs=1e-6)
+    assert normal_quantile(0.995) == pytest.approx(2.575829, abs=1e-6)
+    # Lower tail
+    assert normal_quantile(0.001) == pytest.approx(-3.090232, abs=1e-6)
+    with pytest.raises(ValueError):
+        normal_quantile(1.0)
+
+
+# Table values of Student's t
+@pytest.mark.parametrize('p, dof, expected', [(0.975, 1, 12.7062), (0.975, 2, 4.3027), (0.975, 3, 3.1824), (0.975, 4, 2.7764),
+                                              (0.975, 12, 2.1788), (0.95, 5, 2.0150), (0.995, 8, 3.3554), (0.975, 84, 1.9886)])
+def test_t_quantiles(p, dof, expected):
+    assert t_quantile(p, dof) == pytest.approx(expected, rel=2e-3)
+
+
+def test_small_samples_widen_the_interval():
+    assert confidence_zscore(0.95) == pytest.approx(1.959964, abs=1e-6)
+    widths = [confidence_zscore(0.95, dof) for dof in (4, 8, 21, 100)]
+    assert widths == sorted(widths, reverse=True)
+    assert widths[-1] > confidence_zscore(0.95)
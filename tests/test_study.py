@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+from mpmd_study import (sample_printers, VirtualPrinter, run_trial, summarize, p2_errors, tap_averages, rules,
+                        default_max_runs, default_max_error)
+
+start = {'x': 0.0, 'y': 0.0, 'z': 0.0, 'r': 63.5, 'l': 123.0, 'ax': 0.0, 'ay': 0.0, 'az': 0.0}
+
+
+def test_same_seed_samples_the_same_printers():
+    assert sample_printers(5, start, seed=4) == sample_printers(5, start, seed=4)
+    assert sample_printers(5, start, seed=4) != sample_printers(5, start, seed=5)
+    printers = sample_printers(400, start, seed=1, endstop_sd=0.3, noise=0.005)
+    endstops = np.array([[p['actual'][key] for key in 'xyz'] for p in printers])
+    assert np.std(endstops) == pytest.approx(0.3, rel=0.1)
+    noise = np.array([p['noise'] for p in printers])
+    assert noise.min() >= 0.0025 and noise.max() <= 0.0075
+    # The Z tower angle is the reference
+    assert all(p['actual']['az'] == 0.0 for p in printers)
+
+
+def test_virtual_printer_probes_like_the_firmware():
+    printer = VirtualPrinter(start, 0.005, start, seed=0)
+    taps = printer.probe(np.array([[0.0, 0.0], [25.0, 25.0]]))
+    assert taps.shape == (2, 2)
+    # Three decimals, like the firmware reports them
+    assert np.allclose(taps, np.round(taps, 3))
+    assert printer.taps == 4
+    # A calibrated printer is flat
+    assert printer.flatness()[0] == pytest.approx(0.0, abs=1e-9)
+    printer.set_values(x=0.3)
+    assert printer.flatness()[0] > 0.1
+
+
+def test_p2_errors_are_relative_to_the_highest_tower():
+    assert p2_errors(0.1, 0.3, 0.2, 0.05) == (-0.2, 0.0, -0.1, -0.15)
+    assert tap_averages([(0.1, 0.2), (0.0, 0.001)]) == [0.15, 0.001]
+
+
+@pytest.mark.parametrize('rule', rules)
+def test_calibrated_printer_needs_one_pass(rule):
+    printer = {'number': 0, 'actual': dict(start), 'noise': 0.0, 'seed': 0}
+    result = run_trial((rule, default_max_runs[rule], default_max_error[rule], printer, start))
+    assert (result['outcome'], result['passes']) == ('calibrated', 1)
+    assert result['firmware'] == start
+
+
+@pytest.mark.parametrize('rule', ['p2', 'p5'])
+def test_endstop_errors_get_calibrated_out(rule):
+    printer = {'number': 0, 'actual': dict(start, x=-0.2, y=-0.1), 'noise': 0.002, 'seed': 3}
+    result = run_trial((rule, default_max_runs[rule], default_max_error[rule], printer, start))
+    assert result['outcome'] == 'calibrated'
+    assert result['peak'] < result['initial']
+
+
+def test_summary_per_rule_and_setting():
+    results = [{'rule': 'p5', 'max_runs': 10, 'max_error': 1.0, 'outcome': 'calibrated', 'passes': 3, 'peak': 0.02},
+               {'rule': 'p5', 'max_runs': 10, 'max_error': 1.0, 'outcome': 'max_runs', 'passes': 10, 'peak': 0.08},
+               {'rule': 'p5', 'max_runs': 10, 'max_error': 1.0, 'outcome': 'error', 'passes': 0, 'peak': 9.0},
+               {'rule': 'p2', 'max_runs': 15, 'max_error': 0.02, 'outcome': 'calibrated', 'passes': 2, 'peak': 0.03}]
+    summary = summarize(results)
+    # In rule order
+    assert [entry['rule'] for entry in summary] == ['p2', 'p5']
+    p5 = summary[1]
+    assert p5['printers'] == 3
+    assert p5['outcomes'] == {'calibrated': 1, 'max_runs': 1, 'aborted': 0, 'error': 1}
+    # Failed trials count as outcomes but not in the pass and flatness statistics
+    assert p5['passes_mean'] == 6.5
+    assert p5['pass_histogram'][2] == 1 and p5['pass_histogram'][9] == 1
+    assert p5['within_0.05'] == 0.5
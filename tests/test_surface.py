@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+from auto_cal_p5 import fit_surface, surface_height, zernike_terms, zernike_matrix, square_grid, hex_grid
+
+
+def test_fit_recovers_the_zernike_terms():
+    points = np.array(hex_grid(12.0))
+    x = points[:, 0]
+    y = points[:, 1]
+    scale = float(np.max(np.hypot(x, y)))
+    coeffs = np.linspace(0.1, -0.05, len(zernike_terms))
+    heights = zernike_matrix(x, y, scale) @ coeffs
+    fitted, fitted_scale = fit_surface(x, y, heights)
+    assert fitted_scale == pytest.approx(scale)
+    assert np.allclose(fitted, coeffs, atol=1e-9)
+
+
+def test_surface_follows_a_bowl_between_the_points():
+    points = np.array(square_grid(5))
+    x = points[:, 0]
+    y = points[:, 1]
+    # A bowl and a tilt, both inside the fitted terms
+    bowl = lambda xq, yq: 1e-4*(xq**2 + yq**2) + 0.002*xq
+    coeffs, scale = fit_surface(x, y, bowl(x, y))
+    for xq, yq in [(0.0, 0.0), (12.5, -12.5), (-37.5, 10.0), (30.0, 30.0)]:
+        assert surface_height(coeffs, scale, xq, yq) == pytest.approx(bowl(xq, yq), abs=1e-9)
+
+
+def test_noise_is_smoothed_out():
+    points = np.array(square_grid(6))
+    rng = np.random.default_rng(3)
+    noise = rng.normal(0.0, 0.01, len(points))
+    coeffs, scale = fit_surface(points[:, 0], points[:, 1], noise)
+    fitted = np.array([surface_height(coeffs, scale, x, y) for x, y in points])
+    # A least squares fit never leaves more than the data it was given
+    assert np.std(fitted) < np.std(noise)
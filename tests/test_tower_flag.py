@@ -0,0 +1,28 @@
+import numpy as np
+import pytest
+from auto_cal_p5 import detect_tower_flag, tower_flag_response, get_grid, tower_flag_trial
+
+grid = np.array(get_grid('P5'))
+nominal = {'x': 0.0, 'y': 0.0, 'z': 0.0, 'r': 63.5, 'l': 123.0, 'ax': 0.0, 'ay': 0.0, 'az': 0.0}
+
+
+def test_each_tower_setup_predicts_its_own_tilt():
+    trial = dict(nominal, x=tower_flag_trial)
+    responses = [tower_flag_response(grid[:, 0], grid[:, 1], nominal, trial, flag) for flag in range(3)]
+    for response in responses:
+        # Moving an endstop tilts the bed, it doesn't just shift it
+        assert np.ptp(response) > 0.1
+    for one in range(3):
+        for other in range(one + 1, 3):
+            difference = (responses[one] - np.mean(responses[one])) - (responses[other] - np.mean(responses[other]))
+            assert np.sqrt(np.mean(difference**2)) > 0.05
+
+
+@pytest.mark.parametrize('tower_flag', [0, 1, 2])
+def test_detects_the_tower_setup(delta_printer, tower_flag):
+    actual = dict(nominal, x=-0.3, y=-0.1, r=63.2)
+    connection = delta_printer(actual, tower_flag, noise=0.005)
+    assert detect_tower_flag(connection, 1, get_grid('P5'), 0.0, 0.0, 0.0, 123.0, 63.5, [0.0, 0.0, 0.0]) == tower_flag
+    # The trial values are put back
+    firmware = connection.port.firmware()
+    assert [firmware['x'], firmware['y'], firmware['z']] == [0.0, 0.0, 0.0]
@@ -0,0 +1,99 @@
+import json
+import os
+import time
+from mpmd_trace import Tracer, HostProfiler
+
+
+class StepClock(object):
+
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_disabled_tracer_records_nothing():
+    tracer = Tracer()
+    with tracer.span('home'):
+        tracer.instant('done')
+    assert tracer.events == []
+    assert tracer.phase_totals() == {}
+
+
+def test_phase_totals_add_up_numbered_spans():
+    clock = StepClock()
+    tracer = Tracer()
+    tracer.enable(clock)
+    for ii in range(3):
+        with tracer.span('pass {0}'.format(ii)):
+            with tracer.span('probe'):
+                clock.now += 2.0
+            with tracer.span('analysis', cat='compute'):
+                clock.now += 0.5
+    totals = tracer.phase_totals()
+    assert totals['pass'] == (3, 7.5)
+    assert totals['probe'] == (3, 6.0)
+    assert totals['analysis'] == (3, 1.5)
+    assert list(tracer.phase_totals('compute').keys()) == ['analysis']
+
+
+def test_span_ends_when_the_body_raises():
+    clock = StepClock()
+    tracer = Tracer()
+    tracer.enable(clock)
+    try:
+        with tracer.span('home'):
+            clock.now += 1.0
+            raise RuntimeError('no answer')
+    except RuntimeError:
+        pass
+    assert [event['ph'] for event in tracer.events] == ['B', 'E']
+    assert tracer.phase_totals()['home'] == (1, 1.0)
+
+
+def test_save_writes_chrome_trace_events(tmp_path):
+    clock = StepClock()
+    tracer = Tracer()
+    tracer.enable(clock)
+    with tracer.span('pass 0', run=0):
+        clock.now += 0.25
+    tracer.instant('calibrated')
+    filename = str(tmp_path / 'trace.json')
+    tracer.save(filename)
+    with open(filename) as trace_file:
+        trace = json.load(trace_file)
+    events = trace['traceEvents']
+    assert [event['ph'] for event in events] == ['B', 'E', 'i']
+    assert events[0]['args'] == {'run': 0}
+    # Microseconds from the start of the session
+    assert events[1]['ts'] - events[0]['ts'] == 250000.0
+
+
+def test_profiler_only_runs_in_compute_spans(tmp_path):
+    tracer = Tracer()
+    profiler = HostProfiler(interval=0.0005)
+    tracer.profiler = profiler
+
+    def analysis():
+        end = time.time() + 0.05
+        while time.time() < end:
+            sum(range(100))
+
+    def waiting():
+        time.sleep(0.05)
+
+    with tracer.span('probe'):
+        waiting()
+    with tracer.span('analysis', cat='compute'):
+        with tracer.span('fit', cat='compute'):
+            analysis()
+        assert profiler.depth == 1
+    assert profiler.depth == 0
+    prefix = str(tmp_path / 'host')
+    profiler.save(prefix)
+    assert os.path.exists(prefix + '.prof')
+    with open(prefix + '.folded') as folded_file:
+        stacks = folded_file.read()
+    assert 'test_trace.py:analysis' in stacks
+    assert 'test_trace.py:waiting' not in stacks
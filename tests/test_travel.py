@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+from auto_cal_p5 import (travel_height, probe_moves, get_current_values, get_grid, new_probe_table, safe_height,
+                         travel_clearance, travel_feed)
+from mpmd_serial import PrinterConnection
+from mpmd_dryrun import SimulatedPort, g29_p5_points
+
+
+def previous_table(highest):
+    table = new_probe_table(get_grid('P5'))
+    table['z1'] = np.linspace(-0.2, highest, len(table))
+    table['z2'] = table['z1'] - 0.01
+    return table
+
+
+def test_travel_height_clears_the_previous_mesh():
+    assert travel_height() is None
+    assert travel_height(previous_table(0.4)) == pytest.approx(0.4 + travel_clearance)
+    # Never higher than the first move after homing
+    assert travel_height(previous_table(40.0)) == safe_height
+
+
+def test_first_pass_moves_at_the_safe_height():
+    grid = get_grid('P2')
+    moves = probe_moves(grid)
+    assert moves[0] == 'G1 X{0} Y{1} Z{2} F{3}'.format(grid[0][0], grid[0][1], safe_height, travel_feed)
+    # After that G30 leaves the nozzle where it can travel from
+    assert all(' Z' not in move for move in moves[1:])
+    assert len(moves) == len(grid)
+
+
+def test_later_passes_move_in_one_xyz_move():
+    grid = get_grid('P5')
+    moves = probe_moves(grid, 3.4)
+    assert moves == ['G1 X{0} Y{1} Z3.4 F{2}'.format(x, y, travel_feed) for x, y in grid]
+
+
+def probe(firmFlag, z_travel=None):
+    port = SimulatedPort(g29_grids={5: g29_p5_points})
+    # Short reads, so closing the connection doesn't wait long on the reader
+    port.timeout = 0.05
+    connection = PrinterConnection(port, window=4, timeout=5.0)
+    try:
+        table = get_current_values(connection, firmFlag, get_grid('P5'), z_travel)
+    finally:
+        connection.close()
+    return port, table
+
+
+def test_marlin_probing_queues_two_taps_per_point():
+    port, table = probe(1, 3.0)
+    assert port.commands[0] == 'G28'
+    assert port.commands[1:4] == [probe_moves(get_grid('P5'), 3.0)[0], 'G30', 'G30']
+    assert port.commands.count('G30') == 2*len(table)
+    # The simulated printer is flat
+    assert np.all(table['dz'] == 0.0)
+    assert np.all(table['dtap'] == 0.0)
+
+
+def test_stock_firmware_probes_with_g29():
+    port, table = probe(0)
+    assert port.commands == ['G28', 'G29 P5 V4']
+    assert len(table) == 21
+
+
+def test_lower_travel_is_faster():
+    # A dry run's clock is the printer's time
+    first = probe(1)[0].clock()
+    later = probe(1, travel_height(previous_table(0.4)))[0].clock()
+    assert later < first